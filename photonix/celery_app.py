@@ -1,6 +1,7 @@
 import os
 
 from celery import Celery
+from celery.signals import worker_process_init
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'photonix.web.settings')
@@ -17,6 +18,22 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 
+@worker_process_init.connect
+def resolve_external_tools(**kwargs):
+    # Look up binaries and their versions once per worker process rather than on every raw file processed
+    from photonix.photos.utils.system import tools
+    tools.refresh()
+
+
+@worker_process_init.connect
+def preload_classifier_models(**kwargs):
+    # Models are loaded into the registry once per worker process and shared by all the tasks it runs
+    from django.conf import settings
+
+    from photonix.classifiers.registry import model_registry
+    model_registry.warm(settings.CLASSIFIER_PRELOAD_MODELS)
+
+
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
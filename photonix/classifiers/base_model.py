@@ -6,6 +6,7 @@ import random
 import shutil
 import subprocess
 import tempfile
+import threading
 from pathlib import Path
 
 import requests
@@ -14,6 +15,10 @@ from redis_lock import Lock
 from photonix.photos.utils import redis
 
 graph_cache = {}
+# TensorFlow sessions and the input/output tensors resolved from their graphs, kept for the life of the process like
+# the graphs themselves
+session_cache = {}
+session_cache_lock = threading.Lock()
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +26,7 @@ logger = logging.getLogger(__name__)
 class BaseModel:
     def __init__(self, model_dir=None):
         self.graph_cache = graph_cache
+        self.session_cache = session_cache
 
         if model_dir:
             self.model_dir = model_dir
@@ -32,6 +38,26 @@ class BaseModel:
                 self.model_dir = str(
                     Path(__file__).parent.parent.parent / 'data' / 'models')
 
+    def get_session(self, resolve_tensors):
+        '''
+        Returns a (session, tensors) tuple for this model's graph. The session is created, and resolve_tensors(graph)
+        called to look up the tensors to feed and fetch, only the first time. The graph is then finalized so
+        anything that would add ops to it during inference (and grow memory with every prediction) raises an error.
+        '''
+        with session_cache_lock:
+            graph, session, tensors = self.session_cache.get(self.graph_cache_key, (None, None, None))
+            if graph is not self.graph:
+                import tensorflow as tf
+                tensors = resolve_tensors(self.graph)
+                self.graph.finalize()
+                session = tf.compat.v1.Session(graph=self.graph)
+                self.session_cache[self.graph_cache_key] = (self.graph, session, tensors)
+            return session, tensors
+
+    def predict_batch(self, images, **kwargs):
+        # Models that can run several images through one inference override this
+        return [self.predict(image, **kwargs) for image in images]
+
     @property
     def graph_cache_key(self):
         return '{}:{}'.format(self.name, self.model_dir)
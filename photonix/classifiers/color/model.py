@@ -1,12 +1,38 @@
 import operator
 import sys
-from collections import defaultdict
 from colorsys import rgb_to_hsv
 from pathlib import Path
 
 import numpy as np
 from PIL import Image
 
+from photonix.classifiers.registry import model_registry
+from photonix.photos.utils.image import decode_image
+
+
+def rgb_to_hsv_array(rgb):
+    '''
+    colorsys.rgb_to_hsv() for an array of 0-255 RGB values of shape (..., 3), doing the same floating point operations
+    so the results are exactly the same.
+    '''
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maxc = rgb.max(axis=-1)
+    minc = rgb.min(axis=-1)
+    rangec = maxc - minc
+    v = maxc
+    grey = minc == maxc
+    # Avoid dividing by zero for greys, their hue and saturation are 0 anyway
+    safe_maxc = np.where(grey, 1.0, maxc)
+    safe_rangec = np.where(grey, 1.0, rangec)
+    s = np.where(grey, 0.0, rangec / safe_maxc)
+    rc = (maxc - r) / safe_rangec
+    gc = (maxc - g) / safe_rangec
+    bc = (maxc - b) / safe_rangec
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(grey, 0.0, (h / 6.0) % 1.0)
+    return np.stack([h, s, v], axis=-1)
+
 
 class ColorModel:
     version = 20210206
@@ -37,33 +63,52 @@ class ColorModel:
             'Black':                ((0, 0, 0),         17),
         }
 
+        self.names = list(self.colors)
+        self.colors_hsv = rgb_to_hsv_array(np.array([target for target, _ in self.colors.values()]))
+
     def predict(self, image_file, image_size=32, min_score=0.005):
-        image = Image.open(image_file)
-        image = image.resize((image_size, image_size), Image.BICUBIC)
-        pixels = np.asarray(image)
-        pixels = [j for i in pixels for j in i]
-
-        summed_results = defaultdict(int)
-        for i, pixel in enumerate(pixels):
-            best_color = None
-            best_score = 0
-            for name, (target, _) in self.colors.items():
-                score = self.color_distance(pixel, target)
-                if score > best_score:
-                    best_color = name
-                    best_score = score
-            if best_color:
-                summed_results[best_color] += 1
-
-        averaged_results = {}
-        for key, val in summed_results.items():
-            val = val / (image_size * image_size)
-            if val >= min_score:
-                averaged_results[key] = val
-
-        sorted_results = sorted(averaged_results.items(
-        ), key=operator.itemgetter(1), reverse=True)
-        return sorted_results
+        return self.predict_batch([image_file], image_size, min_score)[0]
+
+    def predict_batch(self, images, image_size=32, min_score=0.005):
+        # Scores every pixel of every image against every color in one go
+        pixels = np.stack([
+            np.asarray(decode_image(image_file).resized((image_size, image_size), Image.BICUBIC)).reshape(image_size * image_size, -1)[:, :3]
+            for image_file in images
+        ])
+        best_colors = self.best_colors(pixels)
+
+        results = []
+        for image_best_colors in best_colors:
+            image_best_colors = image_best_colors[image_best_colors >= 0]
+            counts = np.bincount(image_best_colors, minlength=len(self.names))
+            # Ties are listed in the order the colors were first seen in the image
+            seen, first_seen = np.unique(image_best_colors, return_index=True)
+            averaged_results = {}
+            for i in seen[np.argsort(first_seen)]:
+                val = int(counts[i]) / (image_size * image_size)
+                if val >= min_score:
+                    averaged_results[self.names[i]] = val
+
+            sorted_results = sorted(averaged_results.items(
+            ), key=operator.itemgetter(1), reverse=True)
+            results.append(sorted_results)
+        return results
+
+    def best_colors(self, pixels):
+        # Index of the best scoring color for each pixel in an array of RGB values, -1 where no color scores above 0
+        scores = self.color_distances(rgb_to_hsv_array(pixels))
+        best = np.argmax(scores, axis=-1)
+        best[np.take_along_axis(scores, best[..., np.newaxis], axis=-1)[..., 0] <= 0] = -1
+        return best
+
+    def color_distances(self, pixels_hsv):
+        # Same as color_distance() between each pixel and every color, as an array of shape (..., number of colors)
+        a = pixels_hsv[..., np.newaxis, :]
+        b = self.colors_hsv
+        diff_h = 1 - np.abs(a[..., 0] - b[..., 0])
+        diff_s = 1 - np.abs(a[..., 1] - b[..., 1]) * 0.5
+        diff_v = 1 - np.abs(a[..., 2] - b[..., 2]) * 0.25
+        return diff_h * diff_s * diff_v
 
     def color_distance(self, a, b):
         # Colors are list of 3 floats (RGB) from 0.0 to 1.0
@@ -77,12 +122,12 @@ class ColorModel:
         return score
 
 
-def run_on_photo(photo_id):
-    model = ColorModel()
+def run_on_photo(photo_id, image=None):
+    model = model_registry.get('color')
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
     from photonix.classifiers.runners import (get_or_create_tag,
                                               results_for_model_on_photo)
-    photo, results = results_for_model_on_photo(model, photo_id)
+    photo, results = results_for_model_on_photo(model, photo_id, image)
 
     if photo:
         from photonix.photos.models import PhotoTag
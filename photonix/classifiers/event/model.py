@@ -2,7 +2,9 @@ import datetime
 import sys
 from pathlib import Path
 
-from photonix.photos.utils.metadata import PhotoMetadata, parse_datetime
+from photonix.classifiers.registry import model_registry
+from photonix.photos.utils.image import decode_image
+from photonix.photos.utils.metadata import parse_datetime
 
 
 class EventModel:
@@ -11,7 +13,7 @@ class EventModel:
     max_num_workers = 2
 
     def predict(self, image_file):
-        metadata = PhotoMetadata(image_file)
+        metadata = decode_image(image_file).metadata
         date_taken = None
         possible_date_keys = ['Date/Time Original', 'Date Time Original', 'Date/Time',
                               'Date Time', 'GPS Date/Time', 'Modify Date', 'File Modification Date/Time']
@@ -36,13 +38,13 @@ class EventModel:
         return []
 
 
-def run_on_photo(photo_id):
-    model = EventModel()
+def run_on_photo(photo_id, image=None):
+    model = model_registry.get('event')
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
     from photonix.classifiers.runners import (get_or_create_tag,
                                               results_for_model_on_photo)
 
-    photo, results = results_for_model_on_photo(model, photo_id)
+    photo, results = results_for_model_on_photo(model, photo_id, image)
     if photo:
         from photonix.photos.models import PhotoTag
         photo.clear_tags(source='C', type='E')
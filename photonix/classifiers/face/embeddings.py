@@ -0,0 +1,206 @@
+import threading
+from datetime import timedelta
+
+import numpy as np
+
+
+# FaceNet output size
+EMBEDDING_SIZE = 128
+# Rows updated this long before the newest one already loaded are fetched again on refresh in case a transaction
+# that started earlier committed after we last looked
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+def embedding_to_bytes(embedding):
+    # Stored on PhotoTag.embedding as little-endian float32s, 512 bytes for a FaceNet embedding
+    return np.asarray(embedding, dtype='<f4').tobytes()
+
+
+def embedding_from_bytes(data):
+    # A read-only view onto the stored bytes rather than a copy
+    return np.frombuffer(data, dtype='<f4')
+
+
+class EmbeddingMatrix:
+    '''
+    Face embeddings held as rows of one float32 matrix alongside the tag ID and creation time of each, so the closest
+    faces to any number of new embeddings are found with a single matrix product rather than a Python loop.
+    '''
+
+    def __init__(self, size=EMBEDDING_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.clear()
+
+    @classmethod
+    def from_data(cls, data):
+        # data is a list of (tag_id, embedding) pairs
+        matrix = cls(size=len(data[0][1]) if data else EMBEDDING_SIZE)
+        matrix.add([None] * len(data), [tag_id for tag_id, _ in data], [embedding for _, embedding in data],
+                   np.zeros(len(data)))
+        return matrix
+
+    def clear(self):
+        self.count = 0
+        self.embeddings = np.zeros((0, self.size), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.tag_ids = np.zeros(0, dtype=object)
+        self.created_at = np.zeros(0, dtype=np.float64)
+        self.photo_tag_ids = np.zeros(0, dtype=object)
+        self.rows = {}  # PhotoTag ID -> row number
+        self.updated_at = None
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, count):
+        # Capacity grows by doubling so adding a few faces at a time doesn't copy the whole matrix each time
+        if count <= len(self.embeddings):
+            return
+        capacity = max(count, len(self.embeddings) * 2, 64)
+        embeddings = np.zeros((capacity, self.size), dtype=np.float32)
+        embeddings[:self.count] = self.embeddings[:self.count]
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:self.count] = self.norms[:self.count]
+        tag_ids = np.zeros(capacity, dtype=object)
+        tag_ids[:self.count] = self.tag_ids[:self.count]
+        created_at = np.zeros(capacity, dtype=np.float64)
+        created_at[:self.count] = self.created_at[:self.count]
+        photo_tag_ids = np.zeros(capacity, dtype=object)
+        photo_tag_ids[:self.count] = self.photo_tag_ids[:self.count]
+        self.embeddings, self.norms, self.tag_ids, self.created_at = embeddings, norms, tag_ids, created_at
+        self.photo_tag_ids = photo_tag_ids
+
+    def add(self, photo_tag_ids, tag_ids, embeddings, created_at):
+        # Rows for PhotoTags already in the matrix are replaced (their tag may have been changed), the rest appended
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.size)
+        rows = []
+        count = self.count
+        for photo_tag_id in photo_tag_ids:
+            row = self.rows.get(photo_tag_id) if photo_tag_id is not None else None
+            if row is None:
+                row = count
+                count += 1
+            if photo_tag_id is not None:
+                self.rows[photo_tag_id] = row
+            rows.append(row)
+        self.reserve(count)
+        rows = np.array(rows, dtype=np.int64)
+        self.embeddings[rows] = embeddings
+        self.norms[rows] = np.einsum('ij,ij->i', embeddings, embeddings)
+        self.tag_ids[rows] = tag_ids
+        self.created_at[rows] = created_at
+        self.photo_tag_ids[rows] = photo_tag_ids
+        self.count = count
+
+    def remove(self, photo_tag_ids):
+        # Each removed row is filled with the last one so the matrix stays contiguous without copying it
+        for photo_tag_id in photo_tag_ids:
+            row = self.rows.pop(photo_tag_id, None)
+            if row is None:
+                continue
+            last = self.count - 1
+            if row != last:
+                self.embeddings[row] = self.embeddings[last]
+                self.norms[row] = self.norms[last]
+                self.tag_ids[row] = self.tag_ids[last]
+                self.created_at[row] = self.created_at[last]
+                self.photo_tag_ids[row] = self.photo_tag_ids[last]
+                self.rows[self.photo_tag_ids[row]] = row
+            self.tag_ids[last] = None
+            self.photo_tag_ids[last] = None
+            self.count = last
+
+    def refresh(self, photo_tags):
+        '''
+        Brings the matrix up to date with a queryset of face PhotoTags. Only rows updated since the last refresh are
+        fetched and parsed. If the number of rows then differs from the database, just the IDs are fetched to find the
+        ones that have been deleted (faces are deleted and recreated each time a photo is classified) or missed.
+        '''
+        with self.lock:
+            total = photo_tags.count()
+
+            changed = photo_tags
+            if self.updated_at:
+                changed = changed.filter(updated_at__gte=self.updated_at - REFRESH_OVERLAP)
+            self.load(changed.values_list('id', 'tag_id', 'embedding', 'created_at', 'updated_at'))
+
+            if len(self.rows) != total:
+                current_ids = set(photo_tags.values_list('id', flat=True))
+                self.remove([photo_tag_id for photo_tag_id in self.rows if photo_tag_id not in current_ids])
+                # Rows committed with an updated_at older than the overlap
+                missing_ids = current_ids.difference(self.rows)
+                if missing_ids:
+                    self.load(photo_tags.filter(id__in=missing_ids).values_list(
+                        'id', 'tag_id', 'embedding', 'created_at', 'updated_at'))
+
+    def load(self, values):
+        photo_tag_ids = []
+        tag_ids = []
+        embeddings = []
+        created_at = []
+        for photo_tag_id, tag_id, data, created, updated in values:
+            if self.updated_at is None or updated > self.updated_at:
+                self.updated_at = updated
+            embedding = embedding_from_bytes(data) if data else None
+            if embedding is None or len(embedding) != self.size:
+                # Still counted so the total matches the database
+                self.remove([photo_tag_id])
+                self.rows[photo_tag_id] = None
+                continue
+            photo_tag_ids.append(photo_tag_id)
+            tag_ids.append(str(tag_id))
+            embeddings.append(embedding)
+            created_at.append(created.timestamp())
+        if photo_tag_ids:
+            self.add(photo_tag_ids, tag_ids, np.stack(embeddings), created_at)
+
+    def nearest(self, embeddings, oldest_date=None):
+        '''
+        Returns a (tag_id, distance) tuple for the closest row to each embedding, (None, 999) where there's nothing to
+        compare against. With oldest_date only rows created after it are considered.
+        '''
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(-1, self.size)
+        count = self.count
+        candidates = self.embeddings[:count]
+        norms = self.norms[:count]
+        tag_ids = self.tag_ids[:count]
+        if oldest_date:
+            recent = self.created_at[:count] > oldest_date.timestamp()
+            candidates, norms, tag_ids = candidates[recent], norms[recent], tag_ids[recent]
+        if not len(candidates) or not len(embeddings):
+            return [(None, 999) for _ in embeddings]
+
+        # |a - b|^2 = |a|^2 + |b|^2 - 2a.b for every pair at once, the product being the only expensive part
+        squared = norms[np.newaxis, :] - 2 * (embeddings @ candidates.T)
+        closest = np.argmin(squared, axis=1)
+        # The expanded form above loses precision so distances to the chosen rows are measured directly
+        distances = np.linalg.norm(embeddings.astype(np.float64) - candidates[closest], axis=1)
+        return [(tag_ids[index], float(distance)) for index, distance in zip(closest, distances)]
+
+
+class EmbeddingMatrixCache:
+    '''
+    One EmbeddingMatrix per library kept for the life of the process and refreshed from the database before use.
+    '''
+
+    def __init__(self):
+        self.matrices = {}
+        self.lock = threading.Lock()
+
+    def get(self, library_id):
+        from photonix.photos.models import PhotoTag
+
+        with self.lock:
+            matrix = self.matrices.get(library_id)
+            if matrix is None:
+                matrix = self.matrices[library_id] = EmbeddingMatrix()
+        matrix.refresh(PhotoTag.objects.filter(photo__library_id=library_id, tag__type='F'))
+        return matrix
+
+    def clear(self):
+        with self.lock:
+            self.matrices = {}
+
+
+embedding_matrices = EmbeddingMatrixCache()
@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from annoy import AnnoyIndex
+from redis_lock import Lock
+
+from photonix.classifiers.face.embeddings import (EMBEDDING_SIZE,
+                                                  EmbeddingMatrix)
+from photonix.photos.utils import redis
+
+
+# The delta segment is folded into a new base once it holds this many changes, or this fraction of the base's size
+# if that's larger, as from then on an approximate search over everything beats an exact search over the delta
+COMPACT_MIN_SIZE = 1000
+COMPACT_FRACTION = 0.1
+# Base items that have since changed or been deleted are skipped when searching, up to this many extra neighbours
+# are asked for to make up for them
+MAX_REMOVED_NEIGHBOURS = 100
+
+
+def index_paths(library_id):
+    # ANN index, tag IDs and retrained version files written by FaceModel.retrain_face_similarity_index
+    from django.conf import settings
+    directory = Path(settings.MODEL_DIR) / 'face'
+    return (
+        directory / f'{library_id}_faces.ann',
+        directory / f'{library_id}_faces_tag_ids.json',
+        directory / f'{library_id}_retrained_version.txt',
+    )
+
+
+def segment_paths(library_id):
+    # Which PhotoTags the base segment was built from and when, and the delta segment of changes since then
+    from django.conf import settings
+    directory = Path(settings.MODEL_DIR) / 'face'
+    return (
+        directory / f'{library_id}_faces_base.json',
+        directory / f'{library_id}_faces_delta.npz',
+    )
+
+
+def version_file_key(version_path):
+    # Retraining replaces the version file so any change to it shows up in its stat
+    try:
+        stat = os.stat(version_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def replace_file(path, write, mode='w'):
+    # Written alongside and then renamed into place. Workers may have the current files memory-mapped and overwriting
+    # them in place would change them underneath them.
+    temp_path = f'{path}.tmp'
+    with open(temp_path, mode) as f:
+        write(f)
+    os.replace(temp_path, path)
+
+
+def load_base_info(library_id):
+    base_info_path = segment_paths(library_id)[0]
+    if not os.path.exists(base_info_path) or not os.path.exists(index_paths(library_id)[0]):
+        return None
+    with open(base_info_path) as f:
+        return json.loads(f.read())
+
+
+def indexed_face_count(library_id):
+    # Number of face PhotoTags the library had when its index was last retrained
+    delta_path = segment_paths(library_id)[1]
+    if not os.path.exists(delta_path):
+        return None
+    with np.load(delta_path) as delta:
+        return int(delta['count'])
+
+
+def build_base(items):
+    '''
+    Builds an ANN index from (photo_tag_id, tag_id, embedding) items. Returns the index saved to a temporary file
+    alongside its tag IDs and PhotoTag IDs.
+    '''
+    index = AnnoyIndex(EMBEDDING_SIZE, 'euclidean')
+    tag_ids = []
+    photo_tag_ids = []
+    for photo_tag_id, tag_id, embedding in items:
+        index.add_item(len(tag_ids), embedding)
+        tag_ids.append(tag_id)
+        photo_tag_ids.append(photo_tag_id)
+    index.build(3)  # Number of random forest trees
+    return index, tag_ids, photo_tag_ids
+
+
+def save_segments(library_id, retrained_version, count, base=None, built_at=None, delta_items=(), removed=()):
+    '''
+    Writes the index files for a library. The base segment is only written when a new one has been built, the delta
+    segment and version file every time.
+    '''
+    ann_path, tag_ids_path, version_path = index_paths(library_id)
+    base_info_path, delta_path = segment_paths(library_id)
+
+    if base:
+        ann_temp_path = f'{ann_path}.tmp'
+        base[0].save(ann_temp_path)
+
+    embeddings = np.zeros((len(delta_items), EMBEDDING_SIZE), dtype=np.float32)
+    for i, (_, _, embedding) in enumerate(delta_items):
+        embeddings[i] = embedding
+
+    # Aquire lock to save the files atomically
+    with Lock(redis.redis_connection, 'face_model_retrain'):
+        if base:
+            _, tag_ids, photo_tag_ids = base
+            os.replace(ann_temp_path, ann_path)
+            # Annoy only supports integer IDs so we have to do the mapping to tag IDs ourselves
+            replace_file(tag_ids_path, lambda f: f.write(json.dumps(tag_ids)))
+            replace_file(base_info_path, lambda f: f.write(json.dumps({
+                'built_at': built_at.isoformat(),
+                'photo_tag_ids': photo_tag_ids,
+            })))
+
+        replace_file(delta_path, lambda f: np.savez(
+            f,
+            embeddings=embeddings,
+            tag_ids=np.array([tag_id for _, tag_id, _ in delta_items], dtype=str),
+            removed=np.array(sorted(removed), dtype=np.int64),
+            count=count,
+        ), mode='wb')
+
+        # Save version of retrained model to text file - used to save against on PhotoTag model and to determine
+        # whether retraining is required
+        replace_file(version_path, lambda f: f.write(retrained_version))
+
+
+class FaceIndex:
+    '''
+    A library's trained face index: a large ANN base segment (memory-mapped by Annoy) built now and again, plus a
+    small delta segment of faces added or changed since, searched exactly. Base items that the delta replaces or
+    that have been deleted are skipped. Instances are never modified once loaded so any number of threads can query
+    one while a newer version is being loaded.
+    '''
+
+    def __init__(self, key, version=0, index=None, tag_ids=None, delta=None, removed=()):
+        self.key = key
+        self.version = version
+        self.index = index
+        self.tag_ids = tag_ids or []
+        self.delta = delta
+        self.removed = frozenset(removed)
+
+    @classmethod
+    def load(cls, library_id):
+        ann_path, tag_ids_path, version_path = index_paths(library_id)
+        delta_path = segment_paths(library_id)[1]
+        # Ensure the index files can't be updated while we are reading
+        with Lock(redis.redis_connection, 'face_model_retrain'):
+            key = version_file_key(version_path)
+            if key is None or not os.path.exists(ann_path) or not os.path.exists(tag_ids_path):
+                return cls(key)
+            with open(version_path) as f:
+                version = int(datetime.strptime(f.read().strip(), '%Y%m%d%H%M%S').strftime('%Y%m%d%H%M%S'))
+            index = AnnoyIndex(EMBEDDING_SIZE, 'euclidean')
+            index.load(str(ann_path))
+            with open(tag_ids_path) as f:
+                tag_ids = json.loads(f.read())
+            delta = None
+            removed = ()
+            if os.path.exists(delta_path):
+                with np.load(delta_path) as data:
+                    delta = EmbeddingMatrix.from_data(list(zip(data['tag_ids'].tolist(), data['embeddings'])))
+                    removed = data['removed'].tolist()
+        return cls(key, version, index, tag_ids, delta, removed)
+
+    def nearest(self, embedding):
+        result = (None, 999)
+        if self.index is not None:
+            num_neighbours = 1 + min(len(self.removed), MAX_REMOVED_NEIGHBOURS)
+            for item, distance in zip(*self.index.get_nns_by_vector(embedding, num_neighbours, include_distances=True)):
+                if item not in self.removed:
+                    result = (self.tag_ids[item], distance)
+                    break
+        if self.delta is not None and len(self.delta):
+            delta_result = self.delta.nearest([embedding])[0]
+            if delta_result[0] is not None and delta_result[1] < result[1]:
+                result = delta_result
+        return result
+
+
+class FaceIndexCache:
+    '''
+    The loaded FaceIndex for each library, kept for the life of the process. get() only stats the version file unless
+    the index has been retrained, in which case the new one is loaded and swapped in while queries carry on using the
+    old one.
+    '''
+
+    def __init__(self):
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get(self, library_id):
+        key = version_file_key(index_paths(library_id)[2])
+        index = self.indexes.get(library_id)
+        if index and index.key == key:
+            return index
+        if key is None:
+            return None
+
+        with self.lock:
+            index = self.indexes.get(library_id)
+            if not index or index.key != key:
+                index = FaceIndex.load(library_id)
+                self.indexes[library_id] = index
+        return index
+
+    def clear(self):
+        with self.lock:
+            self.indexes = {}
+
+
+face_indexes = FaceIndexCache()
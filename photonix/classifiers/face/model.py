@@ -1,24 +1,30 @@
-import json
+import copy
 import os
 import sys
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 from random import randint
 
 import numpy as np
-from annoy import AnnoyIndex
-from django.utils import timezone
-from PIL import Image
 from redis_lock import Lock
 
 from photonix.classifiers.base_model import BaseModel
+from photonix.classifiers.face.embeddings import (EMBEDDING_SIZE,
+                                                  REFRESH_OVERLAP,
+                                                  EmbeddingMatrix,
+                                                  embedding_from_bytes,
+                                                  embedding_matrices,
+                                                  embedding_to_bytes)
 from photonix.classifiers.face.deepface import DeepFace
-from photonix.classifiers.face.deepface.commons.distance import \
-    findEuclideanDistance
 from photonix.classifiers.face.deepface.DeepFace import build_model
+from photonix.classifiers.face.index import (COMPACT_FRACTION,
+                                             COMPACT_MIN_SIZE, build_base,
+                                             face_indexes, index_paths,
+                                             load_base_info, save_segments)
 from photonix.classifiers.face.mtcnn import MTCNN
+from photonix.classifiers.registry import model_registry
 from photonix.photos.utils import redis
-from photonix.photos.utils.metadata import PhotoMetadata
+from photonix.photos.utils.image import decode_image, decode_photo, unrotate_box
 
 GRAPH_FILE = os.path.join('face', 'mtcnn_weights.npy')
 DISTANCE_THRESHOLD = 10
@@ -42,48 +48,33 @@ class FaceModel(BaseModel):
             self.graph = self.load_graph(graph_file)
 
     def load_graph(self, graph_file):
+        # MTCNN and Facenet are loaded once per process and model_dir, under the
+        # same key ensure_downloaded() checks so later instances skip it too
         with Lock(redis.redis_connection, 'classifier_{}_load_graph'.format(self.name)):
-            # Load MTCNN
-            mtcnn_graph = None
-            mtcnn_key = '{self.graph_cache_key}:mtcnn'
-            if mtcnn_key in self.graph_cache:
-                mtcnn_graph = self.graph_cache[mtcnn_key]
-            else:
-                mtcnn_graph = MTCNN(weights_file=graph_file)
-                self.graph_cache[mtcnn_key] = mtcnn_graph
-
-            # Load Facenet
-            facenet_graph = None
-            facenet_key = '{self.graph_cache_key}:facenet'
-            if facenet_key in self.graph_cache:
-                facenet_graph = self.graph_cache[facenet_key]
-            else:
-                facenet_graph = build_model('Facenet')
-                self.graph_cache[facenet_key] = facenet_graph
-
-            # Store version number of retrained model (ANN) if it has been computed
-            self.reload_retrained_model_version()
-
-            return {
-                'mtcnn': mtcnn_graph,
-                'facenet': facenet_graph,
-            }
+            graph = self.graph_cache.get(self.graph_cache_key)
+            if graph is None:
+                graph = {
+                    'mtcnn': MTCNN(weights_file=graph_file),
+                    'facenet': build_model('Facenet'),
+                }
+                self.graph_cache[self.graph_cache_key] = graph
+
+        # Store version number of retrained model (ANN) if it has been computed
+        self.reload_retrained_model_version()
+
+        return graph
+
+    def for_library(self, library_id):
+        # The loaded model is shared by the whole process so library specific state goes on a cheap copy of it
+        model = copy.copy(self)
+        model.library_id = library_id
+        model.retrained_version = 0
+        model.reload_retrained_model_version()
+        return model
 
     def predict(self, image_file, min_score=0.99):
-        # Detects face bounding boxes
-        image = Image.open(image_file)
-
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-
-        # Perform rotations if decalared in metadata
-        metadata = PhotoMetadata(image_file)
-        if metadata.get('Orientation') in ['Rotate 90 CW', 'Rotate 270 CCW']:
-            image = image.rotate(-90, expand=True)
-        elif metadata.get('Orientation') in ['Rotate 90 CCW', 'Rotate 270 CW']:
-            image = image.rotate(90, expand=True)
-
-        image = np.asarray(image)
+        # Detects face bounding boxes. Converted to RGB and rotated if decalared in metadata.
+        image = np.asarray(decode_image(image_file).oriented)
         results = self.graph['mtcnn'].detect_faces(image)
         return list(filter(lambda f: f['confidence'] > min_score, results))
 
@@ -99,140 +90,114 @@ class FaceModel(BaseModel):
         return DeepFace.represent(np.asarray(image_data), model_name='Facenet', model=self.graph['facenet'])
 
     def find_closest_face_tag_by_ann(self, source_embedding):
-        # Use ANN index to do quick serach if it has been trained by retrain_face_similarity_index
-        from django.conf import settings
-        ann_path = Path(settings.MODEL_DIR) / 'face' / \
-            f'{self.library_id}_faces.ann'
-        tag_ids_path = Path(settings.MODEL_DIR) / 'face' / \
-            f'{self.library_id}_faces_tag_ids.json'
-
-        if os.path.exists(ann_path) and os.path.exists(tag_ids_path):
-            embedding_size = 128  # FaceNet output size
-            t = AnnoyIndex(embedding_size, 'euclidean')
-            # Ensure ANN index, tag IDs and version files can't be updated while we are reading
-            with Lock(redis.redis_connection, 'face_model_retrain'):
-                self.reload_retrained_model_version()
-                t.load(str(ann_path))
-                with open(tag_ids_path) as f:
-                    tag_ids = json.loads(f.read())
-            nearest = t.get_nns_by_vector(
-                source_embedding, 1, include_distances=True)
-            if nearest[0]:
-                return tag_ids[nearest[0][0]], nearest[1][0]
-
-        return (None, 999)
+        return self.find_closest_face_tags_by_ann([source_embedding])[0]
+
+    def find_closest_face_tags_by_ann(self, source_embeddings):
+        # Use ANN index to do quick serach if it has been trained by retrain_face_similarity_index. The index is loaded
+        # once per process and only reloaded when it has been retrained.
+        index = face_indexes.get(self.library_id)
+        if not index:
+            return [(None, 999) for _ in source_embeddings]
+        # Faces newer than the version of the index being used are left for brute force searching
+        self.retrained_version = index.version or self.retrained_version
+        return [index.nearest(source_embedding) for source_embedding in source_embeddings]
 
     def find_closest_face_tag_by_brute_force(self, source_embedding, oldest_date=None, target_data=None):
+        return self.find_closest_face_tags_by_brute_force([source_embedding], oldest_date, target_data)[0]
+
+    def find_closest_face_tags_by_brute_force(self, source_embeddings, oldest_date=None, target_data=None):
+        # Compares every embedding against all the library's faces at once using the in-memory embedding matrix
         if not self.library_id and not target_data:
             raise ValueError('No Library ID is set')
 
-        representations = []
         if target_data:  # Mainly as an option for testing
-            for id, embedding in target_data:
-                representations.append((id, embedding))
+            matrix = EmbeddingMatrix.from_data(target_data)
         else:
-            # Collect all previously generated embeddings
-            from photonix.photos.models import PhotoTag
-            photo_tags = PhotoTag.objects.filter(
-                photo__library_id=self.library_id, tag__type='F').select_related('tag')
-            if oldest_date:
-                photo_tags = photo_tags.filter(created_at__gt=oldest_date)
-            for photo_tag in photo_tags:
-                try:
-                    tag_embedding = json.loads(photo_tag.extra_data)[
-                        'facenet_embedding']
-                    representations.append(
-                        (str(photo_tag.tag.id), tag_embedding))
-                except (KeyError, json.decoder.JSONDecodeError):
-                    pass
-
-        # Calculate Euclidean distances
-        distances = []
-        for (_, target_embedding) in representations:
-            distance = findEuclideanDistance(
-                source_embedding, target_embedding)
-            distances.append(distance)
-
-        # Return closest match and distance value
-        if not distances:  # First face added has nothing to compare to
-            return (None, 999)
-        index = np.argmin(distances)
-        return (representations[index][0], distances[index])
+            matrix = embedding_matrices.get(self.library_id)
+
+        return matrix.nearest(source_embeddings, oldest_date=oldest_date)
 
     def find_closest_face_tag(self, source_embedding):
+        return self.find_closest_face_tags([source_embedding])[0]
+
+    def find_closest_face_tags(self, source_embeddings):
         if not self.library_id:
             raise ValueError('No Library ID is set')
 
-        ann_nearest, ann_distance = self.find_closest_face_tag_by_ann(
-            source_embedding)
+        ann_results = self.find_closest_face_tags_by_ann(source_embeddings)
 
         oldest_date = None
         if self.retrained_version:
             oldest_date = datetime.strptime(
                 str(self.retrained_version), '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
 
-        brute_force_nearest, brute_force_distance = self.find_closest_face_tag_by_brute_force(
-            source_embedding, oldest_date=oldest_date)
-
-        if ann_nearest and ann_distance < brute_force_distance:
-            return ann_nearest, ann_distance
-        else:
-            return brute_force_nearest, brute_force_distance
+        # Faces added since the ANN index was last trained are only found by brute force
+        brute_force_results = self.find_closest_face_tags_by_brute_force(
+            source_embeddings, oldest_date=oldest_date)
 
-    def retrain_face_similarity_index(self, training_data=None):
+        results = []
+        for (ann_nearest, ann_distance), (brute_force_nearest, brute_force_distance) in zip(ann_results, brute_force_results):
+            if ann_nearest and ann_distance < brute_force_distance:
+                results.append((ann_nearest, ann_distance))
+            else:
+                results.append((brute_force_nearest, brute_force_distance))
+        return results
+
+    def retrain_face_similarity_index(self, training_data=None, compact=False):
+        '''
+        Brings the library's face index up to date. Faces added, changed or deleted since the base segment was built
+        go into the delta segment so the cost depends on how much has changed. The delta is compacted into a new base
+        once it grows past a threshold or when compact is True.
+        '''
         if not self.library_id and not training_data:
             raise ValueError('No Library ID is set')
 
-        from django.conf import settings
+        from django.utils import timezone as django_timezone
 
         from photonix.photos.models import PhotoTag
-        ann_path = Path(settings.MODEL_DIR) / 'face' / \
-            f'{self.library_id}_faces.ann'
-        tag_ids_path = Path(settings.MODEL_DIR) / 'face' / \
-            f'{self.library_id}_faces_tag_ids.json'
-        version_file = Path(settings.MODEL_DIR) / 'face' / \
-            f'{self.library_id}_retrained_version.txt'
-
-        embedding_size = 128  # FaceNet output size
-        t = AnnoyIndex(embedding_size, 'euclidean')
+
         retrained_version = datetime.utcnow().strftime('%Y%m%d%H%M%S')
 
-        tag_ids = []
         if training_data:  # Mainly as an option for testing
-            for id, embedding in training_data:
-                t.add_item(len(tag_ids), embedding)
-                tag_ids.append(id)
-        else:
-            for photo_tag in PhotoTag.objects.filter(tag__type='F').select_related('tag').order_by('id'):
-                try:
-                    extra_data = json.loads(photo_tag.extra_data)
-                    embedding = extra_data['facenet_embedding']
-                    t.add_item(len(tag_ids), embedding)
-                    tag_ids.append(str(photo_tag.tag.id))
-                except (json.decoder.JSONDecodeError, KeyError, TypeError):
-                    pass
-
-        # Build the ANN index
-        t.build(3)  # Number of random forest trees
-
-        # Aquire lock to save ANN, tag IDs and version files atomically
-        with Lock(redis.redis_connection, 'face_model_retrain'):
-            # Save ANN index
-            t.save(str(ann_path))
-
-            # Save Tag IDs to JSON file as Annoy only supports integer IDs so we have to do the mapping ourselves
-            with open(tag_ids_path, 'w') as f:
-                f.write(json.dumps(tag_ids))
-
-            # Save version of retrained model to text file - used to save against on PhotoTag model and to determine whether retraining is required
-            with open(version_file, 'w') as f:
-                f.write(retrained_version)
+            items = [(None, id, embedding) for id, embedding in training_data]
+            save_segments(self.library_id, retrained_version, len(items),
+                          base=build_base(items), built_at=django_timezone.now())
+            return
+
+        photo_tags = PhotoTag.objects.filter(photo__library_id=self.library_id, tag__type='F')
+
+        def embedding_items(photo_tags):
+            for photo_tag_id, tag_id, data in photo_tags.filter(embedding__isnull=False).order_by('id').values_list('id', 'tag_id', 'embedding').iterator():
+                embedding = embedding_from_bytes(data)
+                if len(embedding) == EMBEDDING_SIZE:
+                    yield str(photo_tag_id), str(tag_id), embedding
+
+        base_info = load_base_info(self.library_id)
+        if base_info and not compact:
+            built_at = datetime.fromisoformat(base_info['built_at'])
+            delta_items = list(embedding_items(photo_tags.filter(updated_at__gte=built_at - REFRESH_OVERLAP)))
+            current_ids = set(str(photo_tag_id) for photo_tag_id in photo_tags.values_list('id', flat=True))
+            changed_ids = set(photo_tag_id for photo_tag_id, _, _ in delta_items)
+            # Base items for faces that have since changed or been deleted
+            removed = [
+                i for i, photo_tag_id in enumerate(base_info['photo_tag_ids'])
+                if photo_tag_id not in current_ids or photo_tag_id in changed_ids
+            ]
+            threshold = max(COMPACT_MIN_SIZE, len(base_info['photo_tag_ids']) * COMPACT_FRACTION)
+            if len(delta_items) + len(removed) <= threshold:
+                save_segments(self.library_id, retrained_version, len(current_ids),
+                              delta_items=delta_items, removed=removed)
+                return
+
+        # Faces updated while the base is being built are picked up by the next delta
+        built_at = django_timezone.now()
+        count = photo_tags.count()
+        save_segments(self.library_id, retrained_version, count,
+                      base=build_base(embedding_items(photo_tags)), built_at=built_at)
 
     def reload_retrained_model_version(self):
         if self.library_id:
-            from django.conf import settings
-            version_file = Path(settings.MODEL_DIR) / 'face' / \
-                f'{self.library_id}_retrained_version.txt'
+            version_file = index_paths(self.library_id)[2]
             version_date = None
             if os.path.exists(version_file):
                 with open(version_file) as f:
@@ -245,24 +210,29 @@ class FaceModel(BaseModel):
         return 0
 
 
-def run_on_photo(photo_id):
+def run_on_photo(photo_id, image=None):
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
     from photonix.classifiers.runners import (get_or_create_tag,
                                               get_photo_by_any_type,
                                               results_for_model_on_photo)
 
     photo = get_photo_by_any_type(photo_id)
-    model = FaceModel(library_id=photo and photo.library_id)
+    model = model_registry.get('face').for_library(photo and photo.library_id)
+
+    # Image is decoded once for both detecting faces and extracting them to create embeddings. Faces are detected the
+    # way up the user has rotated the photo to.
+    if photo:
+        image = decode_photo(photo, image)
+    else:
+        image = decode_image(image or photo_id)
 
     # Detect all faces in an image
-    photo, results = results_for_model_on_photo(model, photo_id)
+    photo, results = results_for_model_on_photo(model, photo_id, image)
 
-    # Read image data so we can extract faces and create embeddings
-    path = photo_id
     if photo:
-        path = photo.base_image_path
         model.library_id = photo.library_id
-    image_data = Image.open(path)
+    # Boxes are relative to the oriented image so faces are cropped from that too
+    image_data = image.oriented
 
     # Loop over each face that was detected above
     for result in results:
@@ -274,17 +244,20 @@ def run_on_photo(photo_id):
             embedding = model.get_face_embedding(face_image)
             # Add it to the results
             result['embedding'] = embedding
-            if photo:
-                closest_tag, closest_distance = model.find_closest_face_tag(
-                    embedding)
-                if closest_tag:
-                    print(f'Closest tag: {closest_tag}')
-                    print(f'Closest distance: {closest_distance}')
-                    result['closest_tag'] = closest_tag
-                    result['closest_distance'] = closest_distance
         except ValueError:
             pass
 
+    # All of the photo's faces are matched against the library in one go
+    embedded = [result for result in results if 'embedding' in result]
+    if photo and embedded:
+        closest = model.find_closest_face_tags([result['embedding'] for result in embedded])
+        for result, (closest_tag, closest_distance) in zip(embedded, closest):
+            if closest_tag:
+                print(f'Closest tag: {closest_tag}')
+                print(f'Closest distance: {closest_distance}')
+                result['closest_tag'] = closest_tag
+                result['closest_distance'] = closest_distance
+
     if photo:
         from django.utils import timezone
 
@@ -311,21 +284,25 @@ def run_on_photo(photo_id):
                         tag.save()
                         break
 
-            x = (result['box'][0] + (result['box'][2] / 2)) / \
-                photo.base_file.width
-            y = (result['box'][1] + (result['box'][3] / 2)) / \
-                photo.base_file.height
-            width = result['box'][2] / photo.base_file.width
-            height = result['box'][3] / photo.base_file.height
+            # Stored relative to the photo before the user rotated it as the UI rotates the boxes with the image
+            left, top, right, bottom = unrotate_box(
+                result['box'][0] / image_data.width,
+                result['box'][1] / image_data.height,
+                (result['box'][0] + result['box'][2]) / image_data.width,
+                (result['box'][1] + result['box'][3]) / image_data.height,
+                image.rotation)
+            x = (left + right) / 2
+            y = (top + bottom) / 2
+            width = right - left
+            height = bottom - top
             score = result['confidence']
 
-            extra_data = ''
+            embedding = None
             if 'embedding' in result:
-                extra_data = json.dumps(
-                    {'facenet_embedding': result['embedding']})
+                embedding = embedding_to_bytes(result['embedding'])
 
             PhotoTag(photo=photo, tag=tag, source='F', confidence=score, significance=score, position_x=x, position_y=y, size_x=width,
-                     size_y=height, model_version=model.version, retrained_model_version=model.retrained_version, extra_data=extra_data).save()
+                     size_y=height, model_version=model.version, retrained_model_version=model.retrained_version, embedding=embedding).save()
         photo.classifier_color_completed_at = timezone.now()
         photo.classifier_color_version = getattr(model, 'version', 0)
         photo.save()
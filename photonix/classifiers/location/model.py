@@ -1,18 +1,37 @@
 import csv
+import json
 import math
+import os
+import shutil
 import sys
+import tempfile
 from pathlib import Path
 
-import matplotlib.path as mpltPath
 import shapefile
+from redis_lock import Lock
 
 from photonix.classifiers.base_model import BaseModel
-from photonix.photos.utils.metadata import PhotoMetadata, parse_gps_location
+from photonix.classifiers.location.spatial import CityIndex, CountryIndex, StringTable, geohash
+from photonix.classifiers.registry import model_registry
+from photonix.photos.utils import redis
+from photonix.photos.utils.image import decode_image
+from photonix.photos.utils.metadata import parse_gps_location
 
 # http://thematicmapping.org/downloads/world_borders.php
 WORLD_FILE = Path('location') / 'TM_WORLD_BORDERS-0.3.shp'
 # http://download.geonames.org/export/dump/
 CITIES_FILE = Path('location') / 'cities1000.txt'
+# Cities further away than this (in meters) aren't used
+CITY_RADIUS = 10000
+# Used by haversine()
+EARTH_RADIUS = 6372800
+# Bump when the layout of the preprocessed data directory changes
+DATA_FORMAT_VERSION = 1
+# Results are shared by all locations in the same geohash cell (~150m square at this precision), e.g. photos taken
+# on the same walk. The model version is part of the key so a new version starts with an empty cache.
+GEOCODE_CACHE_KEY = 'location_geocode:{version}:{geohash}'
+GEOCODE_CACHE_PRECISION = 7
+GEOCODE_CACHE_EXPIRE = 60 * 60 * 24 * 90
 
 
 class LocationModel(BaseModel):
@@ -24,12 +43,57 @@ class LocationModel(BaseModel):
     def __init__(self, model_dir=None, world_file=WORLD_FILE, cities_file=CITIES_FILE, lock_name=None):
         super().__init__(model_dir=model_dir)
 
-        world_file = str(Path(self.model_dir) / world_file)
-        cities_file = str(Path(self.model_dir) / cities_file)
+        self.world_file = str(Path(self.model_dir) / world_file)
+        self.cities_file = str(Path(self.model_dir) / cities_file)
 
         if self.ensure_downloaded(lock_name=lock_name):
-            self.world = self.load_world(world_file)
-            self.cities = self.load_cities(cities_file)
+            self.country_index, self.country_names, self.cities = self.load_data()
+
+    @property
+    def data_dir(self):
+        return Path(self.model_dir) / 'location' / f'data-{self.version}-{DATA_FORMAT_VERSION}'
+
+    def load_data(self):
+        # The shapefile and cities TSV are preprocessed into .npy files the
+        # first time. After that every process memory-maps those (sharing them
+        # through the page cache) and keeps the indexes for its lifetime.
+        with Lock(redis.redis_connection, 'classifier_{}_load_data'.format(self.name)):
+            if self.graph_cache_key in self.graph_cache:
+                return self.graph_cache[self.graph_cache_key]
+
+            if not self.data_dir.exists():
+                self.build_data()
+
+            country_codes = StringTable.load(self.data_dir, 'country_codes')
+            country_names = StringTable.load(self.data_dir, 'country_names')
+            data = (
+                CountryIndex.load(self.data_dir),
+                dict(zip(country_codes, country_names)),
+                CityIndex.load(self.data_dir),
+            )
+            self.graph_cache[self.graph_cache_key] = data
+            return data
+
+    def build_data(self):
+        world = self.load_world(self.world_file)
+        # Written to a temporary directory and renamed into place so a
+        # half-written one is never used
+        temp_dir = tempfile.mkdtemp(dir=self.data_dir.parent)
+        try:
+            CountryIndex.from_shape_records(world, self.split_country_points).save(temp_dir)
+            StringTable.from_strings([row.record[1] for row in world]).save(temp_dir, 'country_codes')
+            StringTable.from_strings([row.record[4] for row in world]).save(temp_dir, 'country_names')
+            CityIndex.from_rows(self.load_cities(self.cities_file)).save(temp_dir)
+            os.chmod(temp_dir, 0o755)
+            os.rename(temp_dir, self.data_dir)
+        except Exception:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+
+        # Data built for previous versions of the model or format
+        for path in self.data_dir.parent.glob('data-*'):
+            if path != self.data_dir:
+                shutil.rmtree(path, ignore_errors=True)
 
     def load_world(self, world_file):
         return shapefile.Reader(world_file, encoding='latin1').shapeRecords()
@@ -46,7 +110,7 @@ class LocationModel(BaseModel):
         if location:
             lon, lat = location
         else:
-            metadata = PhotoMetadata(image_file)
+            metadata = decode_image(image_file).metadata
             location = metadata.get('GPS Position') and parse_gps_location(
                 metadata.get('GPS Position')) or None
             if location:
@@ -57,13 +121,37 @@ class LocationModel(BaseModel):
                     'city': None,
                 }
 
-        country = self.get_country(lon=lon, lat=lat)
-        if country:
-            city = self.get_city(
-                lon=lon, lat=lat, country_code=country['code'])
-        else:
-            city = self.get_city(lon=lon, lat=lat)
-
+        return self.predict_locations([(lon, lat)])[0]
+
+    def predict_locations(self, locations, use_cache=True):
+        # Batch version of predict() for a list of (lon, lat) locations,
+        # looking up all the countries and cities that aren't cached at once
+        results = [None] * len(locations)
+        keys = [self.geocode_cache_key(lon, lat) for lon, lat in locations]
+        if use_cache and keys:
+            for i, value in enumerate(redis.redis_connection.mget(keys)):
+                if value:
+                    results[i] = json.loads(value)
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            missing_locations = [locations[i] for i in missing]
+            countries = self.get_countries(missing_locations)
+            cities = self.get_cities(missing_locations, [country and country['code'] for country in countries])
+            pipeline = redis.redis_connection.pipeline()
+            for i, country, city in zip(missing, countries, cities):
+                results[i] = self.combine(country, city)
+                pipeline.set(keys[i], json.dumps(results[i]), ex=GEOCODE_CACHE_EXPIRE)
+            pipeline.execute()
+
+        return results
+
+    def geocode_cache_key(self, lon, lat):
+        # Locations are (latitude, longitude) from parse_gps_location() despite
+        # the names used in this class
+        return GEOCODE_CACHE_KEY.format(version=self.version, geohash=geohash(lon, lat, GEOCODE_CACHE_PRECISION))
+
+    def combine(self, country, city):
         if not country and city:
             country = {
                 'name': city['country_name'],
@@ -77,48 +165,51 @@ class LocationModel(BaseModel):
     def get_country(self, lon, lat):
         # Using country border polygons, returns the country that contains the
         # given point.
-        location = [[lat, lon]]
-        for shape_rec in self.world:
-            shape = shape_rec.shape
-            record = shape_rec.record
-            points = shape.points
-
-            if shape.shapeTypeName == 'POLYGON':
-                polygons = self.split_country_points(points)
-                for polygon in polygons:
-                    path = mpltPath.Path(polygon)
-                    inside = path.contains_points(location)[0]
-                    if inside:
-                        return {
-                            'name': record[4],
-                            'code': record[1],
-                        }
-        return None
+        return self.get_countries([(lon, lat)])[0]
+
+    def get_countries(self, locations):
+        # Looks up the countries of many (lon, lat) locations at once. Points
+        # are tested as [lat, lon] against the polygons as they always have been.
+        countries = self.country_index.lookup_many([(lat, lon) for lon, lat in locations])
+        return [country and {'name': country[0], 'code': country[1]} for country in countries]
 
     def get_city(self, lon, lat, country_code=None):
         # Gets the city within a 10km radius that has the highest population.
         # It can be limited to a particular country.
+        candidates = self.cities.within([lon, lat], CITY_RADIUS, EARTH_RADIUS)
+        return self.choose_city(lon, lat, candidates, country_code)
+
+    def get_cities(self, locations, country_codes=None):
+        # Batch version of get_city() for a list of (lon, lat) locations with
+        # one radius search for all of them.
+        if country_codes is None:
+            country_codes = [None] * len(locations)
+        all_candidates = self.cities.within_many(locations, CITY_RADIUS, EARTH_RADIUS)
+        return [
+            self.choose_city(lon, lat, candidates, country_code)
+            for (lon, lat), candidates, country_code in zip(locations, all_candidates, country_codes)
+        ]
+
+    def choose_city(self, lon, lat, candidates, country_code=None):
+        # The nearby candidates are measured exactly, in file order, so ties
+        # go the same way as when checking every city.
         nearest_distance = None
         largest_population = 0
         largest_city = None
         chosen_country_code = None
         chosen_country_name = None
-        countries = {row.record[1]: row.record[4] for row in self.world}
-
-        for row in self.cities:
-            if not country_code or country_code == row[8]:
-                longitude = float(row[4])
-                latitude = float(row[5])
 
+        for i in candidates:
+            if not country_code or country_code == self.cities.country_codes[i]:
                 distance = int(self.haversine(
-                    [lon, lat], [longitude, latitude]))
-                if distance < 10000:
-                    population = int(row[14])
+                    [lon, lat], [self.cities.latitudes[i], self.cities.longitudes[i]]))
+                if distance < CITY_RADIUS:
+                    population = int(self.cities.populations[i])
                     if population > largest_population:
                         largest_population = population
-                        largest_city = row[1]
-                        chosen_country_code = row[8]
-                        chosen_country_name = countries[chosen_country_code]
+                        largest_city = self.cities.names[i]
+                        chosen_country_code = self.cities.country_codes[i]
+                        chosen_country_name = self.country_names[chosen_country_code]
 
                 if nearest_distance is None or distance < nearest_distance:
                     nearest_distance = distance
@@ -155,7 +246,7 @@ class LocationModel(BaseModel):
         # Calculate distance in meters. This is a bit simplistic as it assumes
         # a sherical world but we believe this to not have much impact for how
         # we use it.
-        R = 6372800
+        R = EARTH_RADIUS
         lat1, lon1 = coord1
         lat2, lon2 = coord2
 
@@ -170,7 +261,7 @@ class LocationModel(BaseModel):
     def export_country_kml(self, country, path):
         # Useful for debugging country borders. The exported KML can be viewed
         # online.
-        for shape_rec in self.world.shapeRecords():
+        for shape_rec in self.load_world(self.world_file):
             shape = shape_rec.shape
             record = shape_rec.record
 
@@ -204,12 +295,12 @@ class LocationModel(BaseModel):
                 break
 
 
-def run_on_photo(photo_id):
-    model = LocationModel()
+def run_on_photo(photo_id, image=None):
+    model = model_registry.get('location')
     sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
     from photonix.classifiers.runners import (get_or_create_tag,
                                               results_for_model_on_photo)
-    photo, results = results_for_model_on_photo(model, photo_id)
+    photo, results = results_for_model_on_photo(model, photo_id, image)
 
     if photo and results['country']:
         from photonix.photos.models import PhotoTag
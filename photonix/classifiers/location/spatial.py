@@ -0,0 +1,242 @@
+import math
+from collections import defaultdict
+from pathlib import Path
+
+import matplotlib.path as mpltPath
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+# Size in degrees of the grid cells polygons are indexed by
+COUNTRY_GRID_CELL_SIZE = 5
+
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(latitude, longitude, precision):
+    # Standard geohash: alternately halves the longitude and latitude ranges, 5 bits per character
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    num_bits = 0
+    even = True
+    while len(chars) < precision:
+        value, value_range = (longitude, lon_range) if even else (latitude, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        num_bits += 1
+        if num_bits == 5:
+            chars.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            num_bits = 0
+    return ''.join(chars)
+
+
+class StringTable:
+    '''
+    A list of strings stored as one UTF-8 blob and an array of offsets into it, so it can be saved as .npy files and
+    memory-mapped back instead of creating a Python object per string up front.
+    '''
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(string) for string in encoded])
+        return cls(offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def save(self, directory, name):
+        np.save(Path(directory) / f'{name}_offsets.npy', self.offsets)
+        np.save(Path(directory) / f'{name}_data.npy', self.data)
+
+    @classmethod
+    def load(cls, directory, name, mmap_mode='r'):
+        return cls(np.load(Path(directory) / f'{name}_offsets.npy', mmap_mode=mmap_mode),
+                   np.load(Path(directory) / f'{name}_data.npy', mmap_mode=mmap_mode))
+
+
+class CountryIndex:
+    '''
+    Country border polygons prepared once so that looking up the country containing a point only tests the few
+    polygons whose bounding box contains it. Polygons are indexed by the grid cells their bounding boxes overlap and
+    candidates are always tested in shapefile order, so the first country containing a point wins as it always has.
+    '''
+
+    def __init__(self, polygons, countries, cell_size=COUNTRY_GRID_CELL_SIZE):
+        # polygons is a list of point lists, countries the (name, code) tuple for each one
+        self.paths = [mpltPath.Path(polygon) for polygon in polygons]
+        self.countries = countries
+        self.cell_size = cell_size
+        self.bboxes = np.array([
+            np.concatenate([np.min(polygon, axis=0), np.max(polygon, axis=0)]) for polygon in polygons
+        ]).reshape(-1, 4)
+
+        self.grid = defaultdict(list)
+        for i, (min_x, min_y, max_x, max_y) in enumerate(self.bboxes):
+            for cell_x in range(self.cell(min_x), self.cell(max_x) + 1):
+                for cell_y in range(self.cell(min_y), self.cell(max_y) + 1):
+                    self.grid[(cell_x, cell_y)].append(i)
+
+    @classmethod
+    def from_shape_records(cls, shape_records, split_points):
+        polygons = []
+        countries = []
+        for shape_rec in shape_records:
+            if shape_rec.shape.shapeTypeName == 'POLYGON':
+                for polygon in split_points(shape_rec.shape.points):
+                    polygons.append(polygon)
+                    countries.append((shape_rec.record[4], shape_rec.record[1]))
+        return cls(polygons, countries)
+
+    def save(self, directory):
+        vertices = [path.vertices for path in self.paths]
+        offsets = np.zeros(len(vertices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(polygon) for polygon in vertices])
+        np.save(Path(directory) / 'polygon_vertices.npy', np.concatenate(vertices) if vertices else np.zeros((0, 2)))
+        np.save(Path(directory) / 'polygon_offsets.npy', offsets)
+        StringTable.from_strings([name for name, _ in self.countries]).save(directory, 'polygon_country_names')
+        StringTable.from_strings([code for _, code in self.countries]).save(directory, 'polygon_country_codes')
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        vertices = np.load(Path(directory) / 'polygon_vertices.npy', mmap_mode=mmap_mode)
+        offsets = np.load(Path(directory) / 'polygon_offsets.npy')
+        polygons = [vertices[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        countries = list(zip(StringTable.load(directory, 'polygon_country_names'),
+                             StringTable.load(directory, 'polygon_country_codes')))
+        return cls(polygons, countries)
+
+    def cell(self, value):
+        return math.floor(value / self.cell_size)
+
+    def lookup(self, x, y):
+        return self.lookup_many([(x, y)])[0]
+
+    def lookup_many(self, points):
+        '''
+        Returns the (name, code) of the country containing each (x, y) point, or None. Points sharing a grid cell are
+        tested against each candidate polygon in one contains_points() call.
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        results = [None] * len(points)
+
+        points_by_cell = defaultdict(list)
+        for i, (x, y) in enumerate(points):
+            points_by_cell[(self.cell(x), self.cell(y))].append(i)
+
+        for cell, indexes in points_by_cell.items():
+            indexes = np.array(indexes)
+            for polygon in self.grid.get(cell, []):
+                min_x, min_y, max_x, max_y = self.bboxes[polygon]
+                cell_points = points[indexes]
+                in_bbox = (cell_points[:, 0] >= min_x) & (cell_points[:, 0] <= max_x) & \
+                    (cell_points[:, 1] >= min_y) & (cell_points[:, 1] <= max_y)
+                if not in_bbox.any():
+                    continue
+                inside = np.zeros(len(indexes), dtype=bool)
+                inside[in_bbox] = self.paths[polygon].contains_points(cell_points[in_bbox])
+                for i in indexes[inside]:
+                    results[i] = self.countries[polygon]
+                # Points that have found their country don't need testing against later polygons
+                indexes = indexes[~inside]
+                if not len(indexes):
+                    break
+        return results
+
+
+def unit_vectors(latitudes, longitudes):
+    # Points on a unit sphere so straight line distances between them can be searched with a KD-tree
+    latitudes = np.radians(latitudes)
+    longitudes = np.radians(longitudes)
+    return np.stack([
+        np.cos(latitudes) * np.cos(longitudes),
+        np.cos(latitudes) * np.sin(longitudes),
+        np.sin(latitudes),
+    ], axis=-1)
+
+
+class CityIndex:
+    '''
+    Cities held in contiguous arrays with a KD-tree over their positions on a unit sphere. within() narrows the ~140k
+    cities down to the handful that could be inside a radius, the caller then measures those exactly.
+    '''
+
+    def __init__(self, names, country_codes, latitudes, longitudes, populations):
+        # names and country_codes are StringTables (or lists)
+        self.names = names
+        self.country_codes = country_codes
+        self.latitudes = np.asarray(latitudes, dtype=np.float64)
+        self.longitudes = np.asarray(longitudes, dtype=np.float64)
+        self.populations = np.asarray(populations, dtype=np.int64)
+        self.tree = cKDTree(unit_vectors(self.latitudes, self.longitudes).reshape(-1, 3))
+
+    @classmethod
+    def from_rows(cls, rows):
+        # Rows of the GeoNames cities TSV
+        return cls(
+            StringTable.from_strings([row[1] for row in rows]),
+            StringTable.from_strings([row[8] for row in rows]),
+            [float(row[4]) for row in rows],
+            [float(row[5]) for row in rows],
+            [int(row[14]) for row in rows],
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def save(self, directory):
+        self.names.save(directory, 'city_names')
+        self.country_codes.save(directory, 'city_country_codes')
+        np.save(Path(directory) / 'city_latitudes.npy', self.latitudes)
+        np.save(Path(directory) / 'city_longitudes.npy', self.longitudes)
+        np.save(Path(directory) / 'city_populations.npy', self.populations)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        # The KD-tree is quick to rebuild from the positions so isn't stored
+        return cls(
+            StringTable.load(directory, 'city_names', mmap_mode),
+            StringTable.load(directory, 'city_country_codes', mmap_mode),
+            np.load(Path(directory) / 'city_latitudes.npy', mmap_mode=mmap_mode),
+            np.load(Path(directory) / 'city_longitudes.npy', mmap_mode=mmap_mode),
+            np.load(Path(directory) / 'city_populations.npy', mmap_mode=mmap_mode),
+        )
+
+    def chord(self, radius, earth_radius):
+        # Straight line distance through the unit sphere for a distance along its surface, with a little extra so
+        # rounding never leaves out a city that's exactly on the edge
+        return 2 * math.sin(min(radius / earth_radius, math.pi) / 2) * 1.001 + 1e-9
+
+    def within(self, coord, radius, earth_radius):
+        return self.within_many([coord], radius, earth_radius)[0]
+
+    def within_many(self, coords, radius, earth_radius):
+        '''
+        Indexes (in file order) of the cities that may be within radius metres of each (latitude, longitude) coord.
+        '''
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        if not len(self) or not len(coords):
+            return [[] for _ in coords]
+        points = unit_vectors(coords[:, 0], coords[:, 1])
+        return [sorted(indexes) for indexes in self.tree.query_ball_point(points, self.chord(radius, earth_radius))]
@@ -10,8 +10,10 @@ from redis_lock import Lock
 
 from photonix.classifiers.base_model import BaseModel
 from photonix.classifiers.object.utils import label_map_util
+from photonix.classifiers.registry import model_registry
 from photonix.photos.utils import redis
-from photonix.photos.utils.metadata import PhotoMetadata
+from photonix.photos.utils.image import decode_image, unrotate_box
+from photonix.web.utils import logger
 
 GRAPH_FILE = os.path.join(
     'object', 'ssd_mobilenet_v2_oid_v4_2018_12_12_frozen_inference_graph.pb')
@@ -22,6 +24,8 @@ class ObjectModel(BaseModel):
     name = 'object'
     version = 20190407
     approx_ram_mb = 2000
+    # The SSD MobileNet detector's fixed input size
+    input_size = (300, 300)
 
     def __init__(self, model_dir=None, graph_file=GRAPH_FILE, label_file=LABEL_FILE, lock_name=None):
         super().__init__(model_dir=model_dir)
@@ -57,57 +61,58 @@ class ObjectModel(BaseModel):
             label_map, max_num_classes=1000, use_display_name=True)
         return label_map_util.create_category_index(categories)
 
-    def load_image_into_numpy_array(self, image):
-        (im_width, im_height) = image.size
-        return np.array(image.getdata()).reshape((im_height, im_width, 3)).astype(np.uint8)
+    def load_image_into_numpy_array(self, image_file):
+        # The detector resizes whatever it's given to its input size anyway so doing it first keeps batches small and
+        # lets every image in one go through together. Boxes are relative so still fit the full size image.
+        image = decode_image(image_file).reduced(self.input_size, Image.BILINEAR, oriented=True)
+        return np.asarray(image, dtype=np.uint8)
 
     def run_inference_for_single_image(self, image):
-        with self.graph.as_default():
-            with tf.compat.v1.Session() as sess:
-                # Get handles to input and output tensors
-                ops = tf.compat.v1.get_default_graph().get_operations()
-                all_tensor_names = {
-                    output.name for op in ops for output in op.outputs}
-                tensor_dict = {}
-                for key in [
-                    'num_detections', 'detection_boxes', 'detection_scores',
-                    'detection_classes', 'detection_masks'
-                ]:
-                    tensor_name = key + ':0'
-                    if tensor_name in all_tensor_names:
-                        tensor_dict[key] = tf.compat.v1.get_default_graph(
-                        ).get_tensor_by_name(tensor_name)
-                if 'detection_masks' in tensor_dict:
-                    # The following processing is only for single image
-                    detection_boxes = tf.squeeze(
-                        tensor_dict['detection_boxes'], [0])
-                    # Reframe is required to translate mask from box coordinates to image coordinates and fit the image size.
-                    real_num_detection = tf.cast(
-                        tensor_dict['num_detections'][0], tf.int32)
-                    detection_boxes = tf.slice(detection_boxes, [0, 0], [
-                                               real_num_detection, -1])
-                image_tensor = tf.compat.v1.get_default_graph().get_tensor_by_name('image_tensor:0')
-
-                # Run inference
-                output_dict = sess.run(tensor_dict, feed_dict={
-                                       image_tensor: np.expand_dims(image, 0)})
-
-                # all outputs are float32 numpy arrays, so convert types as appropriate
-                output_dict['num_detections'] = int(
-                    output_dict['num_detections'][0])
-                output_dict['detection_classes'] = output_dict['detection_classes'][0].astype(
-                    np.uint16)
-                output_dict['detection_boxes'] = output_dict['detection_boxes'][0]
-                output_dict['detection_scores'] = output_dict['detection_scores'][0]
-        return output_dict
-
-    def format_output(self, output_dict, min_score):
+        return self.run_inference_for_batch(np.expand_dims(image, 0))[0]
+
+    def resolve_tensors(self, graph):
+        # Get handles to input and output tensors
+        all_tensor_names = {
+            output.name for op in graph.get_operations() for output in op.outputs}
+        tensor_dict = {}
+        for key in [
+            'num_detections', 'detection_boxes', 'detection_scores',
+            'detection_classes'
+        ]:
+            tensor_name = key + ':0'
+            if tensor_name in all_tensor_names:
+                tensor_dict[key] = graph.get_tensor_by_name(tensor_name)
+        return graph.get_tensor_by_name('image_tensor:0'), tensor_dict
+
+    def run_inference_for_batch(self, images):
+        # images is an array of shape [n, height, width, 3] so they all need to be the same size
+        sess, (image_tensor, tensor_dict) = self.get_session(self.resolve_tensors)
+
+        # Run inference
+        batch_output = sess.run(tensor_dict, feed_dict={image_tensor: images})
+
+        # all outputs are float32 numpy arrays, so convert types as appropriate
+        output_dicts = []
+        for i in range(len(images)):
+            output_dicts.append({
+                'num_detections': int(batch_output['num_detections'][i]),
+                'detection_classes': batch_output['detection_classes'][i].astype(np.uint16),
+                'detection_boxes': batch_output['detection_boxes'][i],
+                'detection_scores': batch_output['detection_scores'][i],
+            })
+        return output_dicts
+
+    def format_output(self, output_dict, min_score, rotation=0):
+        # Boxes are for the image as rotated by the user but stored relative to the unrotated one as that is what the
+        # UI rotates along with them
         results = []
         for i, score in enumerate(output_dict['detection_scores']):
             if score < min_score:
                 break
 
-            box = list(output_dict['detection_boxes'][i])
+            ymin, xmin, ymax, xmax = output_dict['detection_boxes'][i]
+            xmin, ymin, xmax, ymax = unrotate_box(xmin, ymin, xmax, ymax, rotation)
+            box = [ymin, xmin, ymax, xmax]
             width = box[3] - box[1]
             height = box[2] - box[0]
 
@@ -124,51 +129,86 @@ class ObjectModel(BaseModel):
         return results
 
     def predict(self, image_file, min_score=0.1):
-        image = Image.open(image_file)
-
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-
-        # Perform rotations if decalared in metadata
-        metadata = PhotoMetadata(image_file)
-        if metadata.get('Orientation') in ['Rotate 90 CW', 'Rotate 270 CCW']:
-            image = image.rotate(-90, expand=True)
-        elif metadata.get('Orientation') in ['Rotate 90 CCW', 'Rotate 270 CW']:
-            image = image.rotate(90, expand=True)
-
-        # the array based representation of the image will be used later in order to prepare the
-        # result image with boxes and labels on it.
+        # Converted to RGB and rotated if decalared in metadata or by the user
+        image = decode_image(image_file)
         image_np = self.load_image_into_numpy_array(image)
-        # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-        np.expand_dims(image_np, axis=0)
         # Actual detection.
         output_dict = self.run_inference_for_single_image(image_np)
-        return self.format_output(output_dict, min_score)
+        return self.format_output(output_dict, min_score, image.rotation)
+
+    def predict_batch(self, images, min_score=0.1):
+        # Images are all resized to the detector's input size so the whole batch is run through it at once. Any
+        # error only skips that image, leaving its result as None.
+        images = [decode_image(image_file) for image_file in images]
+        arrays = []
+        for image in images:
+            try:
+                arrays.append(self.load_image_into_numpy_array(image))
+            except Exception:
+                logger.exception(f'Skipping {image.path}, could not be read')
+                arrays.append(None)
+
+        indexes = [i for i, image_np in enumerate(arrays) if image_np is not None]
+        results = [None] * len(images)
+        if indexes:
+            output_dicts = self.run_inference_for_batch(np.stack([arrays[i] for i in indexes]))
+            for i, output_dict in zip(indexes, output_dicts):
+                results[i] = self.format_output(output_dict, min_score, images[i].rotation)
+        return results
 
 
-def run_on_photo(photo_id):
-    model = ObjectModel()
-    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-    from photonix.classifiers.runners import (get_or_create_tag,
-                                              results_for_model_on_photo)
-    photo, results = results_for_model_on_photo(model, photo_id)
+def tags_for_results(photo, results):
+    from photonix.classifiers.runners import get_or_create_tag
+    from photonix.photos.models import PhotoTag
+    photo.clear_tags(source='C', type='O')
+    tags = []
+    for result in results:
+        if result['label'] != 'Human face':  # We have a specialised face detector
+            tag = get_or_create_tag(
+                library=photo.library, name=result['label'], type='O', source='C')
+            tags.append(PhotoTag(photo=photo, tag=tag, source='C', confidence=result['score'], significance=result['significance'],
+                                 position_x=result['x'], position_y=result['y'], size_x=result['width'], size_y=result['height']))
+    return tags
 
-    if photo:
-        from photonix.photos.models import PhotoTag
-        photo.clear_tags(source='C', type='O')
-        for result in results:
-            if result['label'] != 'Human face':  # We have a specialised face detector
-                tag = get_or_create_tag(
-                    library=photo.library, name=result['label'], type='O', source='C')
-                PhotoTag(photo=photo, tag=tag, source='C', confidence=result['score'], significance=result['significance'],
-                         position_x=result['x'], position_y=result['y'], size_x=result['width'], size_y=result['height']).save()
+
+def mark_completed(model, photos):
+    for photo in photos:
         photo.classifier_object_completed_at = timezone.now()
         photo.classifier_object_version = getattr(model, 'version', 0)
         photo.save()
 
+
+def run_on_photo(photo_id, image=None):
+    model = model_registry.get('object')
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from photonix.classifiers.runners import bulk_create_photo_tags, results_for_model_on_photo
+    photo, results = results_for_model_on_photo(model, photo_id, image)
+
+    if photo:
+        bulk_create_photo_tags(tags_for_results(photo, results))
+        mark_completed(model, [photo])
+
     return photo, results
 
 
+def run_on_photos(photo_ids):
+    # Batched version of run_on_photo, writing all the photos' tags in one go
+    model = model_registry.get('object')
+    from photonix.classifiers.runners import bulk_create_photo_tags, results_for_model_on_photos
+    photos, results = results_for_model_on_photos(model, photo_ids)
+
+    tags = []
+    completed = []
+    for photo, photo_results in zip(photos, results):
+        if photo_results is not None:
+            tags.extend(tags_for_results(photo, photo_results))
+            completed.append(photo)
+    bulk_create_photo_tags(tags)
+    mark_completed(model, completed)
+
+    return photos, results
+
+
 if __name__ == '__main__':
     model = ObjectModel()
     if len(sys.argv) != 2:
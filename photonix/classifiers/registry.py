@@ -0,0 +1,53 @@
+import threading
+
+from django.utils.module_loading import import_string
+
+from photonix.web.utils import logger
+
+
+CLASSIFIER_MODELS = {
+    'color': 'photonix.classifiers.color.model.ColorModel',
+    'event': 'photonix.classifiers.event.model.EventModel',
+    'face': 'photonix.classifiers.face.model.FaceModel',
+    'location': 'photonix.classifiers.location.model.LocationModel',
+    'object': 'photonix.classifiers.object.model.ObjectModel',
+    'style': 'photonix.classifiers.style.model.StyleModel',
+}
+
+
+class ModelRegistry:
+    '''
+    One ready-made instance of each classifier model per process. Constructing a model checks its download and loads
+    its graph under Redis locks so that is only done the first time a model is asked for (or at worker startup by
+    warm()), after that get() is a dict lookup. Models must not hold per-photo state as the instances are shared.
+    '''
+
+    def __init__(self, model_classes):
+        self.model_classes = model_classes
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        model = self.models.get(name)
+        if model is None:
+            with self.lock:
+                model = self.models.get(name)
+                if model is None:
+                    model = import_string(self.model_classes[name])()
+                    self.models[name] = model
+        return model
+
+    def warm(self, names):
+        for name in names:
+            try:
+                self.get(name)
+                logger.info(f'Loaded {name} classifier model')
+            except Exception:
+                logger.exception(f'Failed to load {name} classifier model')
+
+    def clear(self):
+        with self.lock:
+            self.models = {}
+
+
+model_registry = ModelRegistry(CLASSIFIER_MODELS)
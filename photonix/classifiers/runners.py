@@ -21,6 +21,19 @@ def get_or_create_tag(library, name, type, source, parent=None, ordering=None):
     return tag
 
 
+def bulk_create_photo_tags(photo_tags):
+    # bulk_create() doesn't call save() so the timestamps VersionedModel would set need filling in here
+    from django.utils import timezone
+
+    from photonix.photos.models import PhotoTag
+
+    now = timezone.now()
+    for photo_tag in photo_tags:
+        photo_tag.created_at = photo_tag.created_at or now
+        photo_tag.updated_at = now
+    return PhotoTag.objects.bulk_create(photo_tags)
+
+
 def get_photo_by_any_type(photo_id, model=None):
     is_photo_instance = False
     photo = None
@@ -52,10 +65,31 @@ def get_photo_by_any_type(photo_id, model=None):
     return is_photo_instance and photo or None
 
 
-def results_for_model_on_photo(model, photo_id):
+def results_for_model_on_photos(model, photo_ids):
+    # Runs one batched prediction over several photos, skipping any that no longer exist or have no files
+    from photonix.photos.models import Photo
+    from photonix.photos.utils.image import decode_photo
+
+    photos_by_id = {str(photo.id): photo for photo in Photo.objects.filter(id__in=photo_ids).select_related('library')}
+    photos = []
+    images = []
+    for photo_id in photo_ids:
+        photo = photos_by_id.get(str(photo_id))
+        if photo and photo.base_file:
+            photos.append(photo)
+            # Nothing is read until the model prepares each image and it only keeps the downscaled version
+            images.append(decode_photo(photo))
+    return photos, model.predict_batch(images) if images else []
+
+
+def results_for_model_on_photo(model, photo_id, image=None):
+    # image is an optional DecodedImage shared with other classifiers so the file only gets read once
+    from photonix.photos.utils.image import decode_photo
+
     photo = get_photo_by_any_type(photo_id, model)
     if photo:
-        results = model.predict(photo.base_image_path)
-    else:
-        results = model.predict(photo_id)
+        image = decode_photo(photo, image)
+    elif image is None:
+        image = photo_id
+    results = model.predict(image)
     return photo, results
@@ -1 +1 @@
-from .model import StyleModel, run_on_photo
+from .model import StyleModel, run_on_photo, run_on_photos
@@ -4,10 +4,13 @@ from pathlib import Path
 
 import numpy as np
 import tensorflow as tf
+from PIL import Image
 from redis_lock import Lock
 
 from photonix.classifiers.base_model import BaseModel
+from photonix.classifiers.registry import model_registry
 from photonix.photos.utils import redis
+from photonix.photos.utils.image import decode_image
 from photonix.web.utils import logger
 
 GRAPH_FILE = os.path.join('style', 'graph.pb')
@@ -55,90 +58,108 @@ class StyleModel(BaseModel):
             labels.append(l.rstrip())
         return labels
 
+    def resolve_tensors(self, graph):
+        input_layer = "input"
+        output_layer = "final_result"
+        input_name = "import/" + input_layer
+        output_name = "import/" + output_layer
+        return graph.get_operation_by_name(input_name).outputs[0], graph.get_operation_by_name(output_name).outputs[0]
+
     def predict(self, image_file, min_score=0.66):
+        return self.predict_batch([image_file], min_score=min_score)[0]
+
+    def predict_batch(self, images, min_score=0.66):
+        # All images are resized to the same input size so go through the network as one batch
         input_height = 224
         input_width = 224
         input_mean = 128
         input_std = 128
-        input_layer = "input"
-        output_layer = "final_result"
-
-        t = self.read_tensor_from_image_file(
-            image_file,
-            input_height=input_height,
-            input_width=input_width,
-            input_mean=input_mean,
-            input_std=input_std)
 
-        if t is None:
-            logger.info(
-                f'Skipping {image_file}, file format not supported by Tensorflow')
+        tensors = []
+        for image_file in images:
+            t = self.preprocess_image(
+                image_file,
+                input_height=input_height,
+                input_width=input_width,
+                input_mean=input_mean,
+                input_std=input_std)
+            if t is None:
+                logger.info(
+                    f'Skipping {image_file}, could not be read')
+            tensors.append(t)
+
+        valid = [t for t in tensors if t is not None]
+        if not valid:
+            return [None] * len(images)
+
+        sess, (input_tensor, output_tensor) = self.get_session(self.resolve_tensors)
+        batch_results = sess.run(output_tensor, {input_tensor: np.concatenate(valid)})
+        batch_results = iter(batch_results)
+
+        responses = []
+        for t in tensors:
+            if t is None:
+                responses.append(None)
+                continue
+            results = next(batch_results)
+            response = []
+            top_k = results.argsort()[-5:][::-1]
+            for i in top_k:
+                if results[i] >= min_score:
+                    response.append((self.labels[i], results[i]))
+            responses.append(response)
+
+        return responses
+
+    def preprocess_image(self, image_file, input_height=299, input_width=299, input_mean=0, input_std=255):
+        # Resized from the shared decoded image with Pillow rather than adding decoding ops to the TensorFlow graph.
+        # Any error only skips this image, not the rest of a batch.
+        try:
+            image = decode_image(image_file).reduced((input_width, input_height), Image.BILINEAR)
+        except Exception:
             return None
+        normalized = (np.asarray(image, dtype=np.float32) - input_mean) / input_std
+        return np.expand_dims(normalized, 0)
 
-        input_name = "import/" + input_layer
-        output_name = "import/" + output_layer
-        input_operation = self.graph.get_operation_by_name(input_name)
-        output_operation = self.graph.get_operation_by_name(output_name)
 
-        with tf.compat.v1.Session(graph=self.graph) as sess:
-            results = sess.run(output_operation.outputs[0], {
-                               input_operation.outputs[0]: t})
-        results = np.squeeze(results)
+def tags_for_results(photo, results):
+    from photonix.classifiers.runners import get_or_create_tag
+    from photonix.photos.models import PhotoTag
+    photo.clear_tags(source='C', type='S')
+    tags = []
+    for name, score in results:
+        tag = get_or_create_tag(
+            library=photo.library, name=name, type='S', source='C')
+        tags.append(PhotoTag(photo=photo, tag=tag, source='C',
+                             confidence=score, significance=score))
+    return tags
 
-        response = []
-        top_k = results.argsort()[-5:][::-1]
-        for i in top_k:
-            if results[i] >= min_score:
-                response.append((self.labels[i], results[i]))
 
-        return response
+def run_on_photo(photo_id, image=None):
+    model = model_registry.get('style')
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    from photonix.classifiers.runners import bulk_create_photo_tags, results_for_model_on_photo
+    photo, results = results_for_model_on_photo(model, photo_id, image)
 
-    def read_tensor_from_image_file(self, file_name, input_height=299, input_width=299, input_mean=0, input_std=255):
-        input_name = "file_reader"
-        try:
+    if photo and results is not None:
+        bulk_create_photo_tags(tags_for_results(photo, results))
 
-            file_reader = tf.io.read_file(file_name, input_name)
-            if file_name.endswith(".png"):
-                image_reader = tf.image.decode_png(
-                    file_reader, channels=3, name='png_reader')
-            elif file_name.endswith(".gif"):
-                image_reader = tf.squeeze(
-                    tf.image.decode_gif(file_reader, name='gif_reader'))
-            elif file_name.endswith(".bmp"):
-                image_reader = tf.image.decode_bmp(
-                    file_reader, name='bmp_reader')
-            else:
-                image_reader = tf.image.decode_jpeg(
-                    file_reader, channels=3, name='jpeg_reader')
-            float_caster = tf.cast(image_reader, tf.float32)
-            dims_expander = tf.expand_dims(float_caster, 0)
-            resized = tf.image.resize(dims_expander, [
-                                      input_height, input_width], method=tf.image.ResizeMethod.BILINEAR, antialias=True)
-            normalized = tf.divide(tf.subtract(
-                resized, [input_mean]), [input_std])
-            sess = tf.compat.v1.Session()
-            return sess.run(normalized)
-        except:
-            return None
+    return photo, results
 
 
-def run_on_photo(photo_id):
-    model = StyleModel()
-    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
-    from photonix.classifiers.runners import (get_or_create_tag,
-                                              results_for_model_on_photo)
-    photo, results = results_for_model_on_photo(model, photo_id)
+def run_on_photos(photo_ids):
+    # Batched version of run_on_photo, writing all the photos' tags in one go
+    model = model_registry.get('style')
+    from photonix.classifiers.runners import bulk_create_photo_tags, results_for_model_on_photos
+    photos, results = results_for_model_on_photos(model, photo_ids)
 
-    if photo and results is not None:
-        from photonix.photos.models import PhotoTag
-        photo.clear_tags(source='C', type='S')
-        for name, score in results:
-            tag = get_or_create_tag(
-                library=photo.library, name=name, type='S', source='C')
-            PhotoTag(photo=photo, tag=tag, source='C',
-                     confidence=score, significance=score).save()
+    tags = []
+    for photo, photo_results in zip(photos, results):
+        if photo_results is not None:
+            tags.extend(tags_for_results(photo, photo_results))
+    bulk_create_photo_tags(tags)
 
-    return photo, results
+    return photos, results
 
 
 if __name__ == '__main__':
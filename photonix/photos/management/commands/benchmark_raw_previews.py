@@ -0,0 +1,72 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from photonix.photos.utils.metadata import get_mimetype
+from photonix.photos.utils.raw import NON_RAW_MIMETYPES, generate_jpeg
+from photonix.web.utils import logger
+
+
+class Command(BaseCommand):
+    help = 'Compares the time taken to get a JPEG out of raw files with generate_jpeg() against copying the file and running "dcraw -e" on it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paths', nargs='+', default=[], help='Raw files or directories containing them')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def find_raw_files(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for directory, _, filenames in os.walk(path):
+                    for fn in sorted(filenames):
+                        file_path = str(Path(directory) / fn)
+                        if get_mimetype(file_path) not in NON_RAW_MIMETYPES:
+                            yield file_path
+            else:
+                yield path
+
+    def time_generate_jpeg(self, path, output_path):
+        start = time.perf_counter()
+        _, _, process_params, _ = generate_jpeg(path, output_path)
+        return time.perf_counter() - start, process_params
+
+    def time_dcraw_extract(self, path):
+        # How the embedded JPEG used to be extracted, copying the raw file as dcraw writes next to its input
+        start = time.perf_counter()
+        temp_dir = tempfile.mkdtemp()
+        temp_input_path = Path(temp_dir) / os.path.basename(path)
+        shutil.copyfile(path, temp_input_path)
+        subprocess.run(['dcraw', '-e', temp_input_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        shutil.rmtree(temp_dir)
+        return time.perf_counter() - start
+
+    def benchmark(self, paths, repeat):
+        output_path = tempfile.mktemp(suffix='.jpg')
+        total_generate_jpeg = 0
+        total_dcraw = 0
+
+        for path in self.find_raw_files(paths):
+            generate_jpeg_times = []
+            dcraw_times = []
+            for _ in range(repeat):
+                duration, process_params = self.time_generate_jpeg(path, output_path)
+                generate_jpeg_times.append(duration)
+                dcraw_times.append(self.time_dcraw_extract(path))
+            generate_jpeg_time = min(generate_jpeg_times)
+            dcraw_time = min(dcraw_times)
+            total_generate_jpeg += generate_jpeg_time
+            total_dcraw += dcraw_time
+            logger.info(f'{path}: generate_jpeg ({process_params}) {generate_jpeg_time * 1000:.1f}ms, copy + dcraw -e {dcraw_time * 1000:.1f}ms')
+
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        if total_generate_jpeg:
+            logger.info(f'Total: generate_jpeg {total_generate_jpeg:.2f}s, copy + dcraw -e {total_dcraw:.2f}s ({total_dcraw / total_generate_jpeg:.1f}x)')
+
+    def handle(self, *args, **options):
+        self.benchmark(options['paths'], options['repeat'])
@@ -0,0 +1,60 @@
+import os
+import resource
+import time
+from itertools import cycle
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+
+from photonix.classifiers.style import StyleModel
+from photonix.web.utils import logger
+
+
+def current_rss_mb():
+    # Resident memory right now (not the peak) so growth shows up between reports
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = 'Runs the style classifier over the same images many times, reporting memory, graph size and latency so leaks show up as growth between reports.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paths', nargs='+', default=[str(Path(__file__).parents[4] / 'tests' / 'photos' / 'snow.jpg')],
+                            help='Images to cycle through')
+        parser.add_argument('--images', type=int, default=50000, help='Total number of predictions to make')
+        parser.add_argument('--report-every', type=int, default=1000)
+        parser.add_argument('--batch-size', type=int, default=1)
+
+    def soak(self, paths, num_images, report_every, batch_size):
+        model = StyleModel()
+        images = cycle(paths)
+        first_report = None
+        done = 0
+        interval_start = time.perf_counter()
+        interval_done = 0
+
+        while done < num_images:
+            batch = [next(images) for _ in range(min(batch_size, num_images - done))]
+            model.predict_batch(batch)
+            done += len(batch)
+            interval_done += len(batch)
+
+            if done % report_every < len(batch) or done == num_images:
+                latency_ms = (time.perf_counter() - interval_start) * 1000 / interval_done
+                report = (current_rss_mb(), len(model.graph.get_operations()), latency_ms)
+                if first_report is None:
+                    first_report = report
+                logger.info(f'{done} images: RSS {report[0]:.1f}MB, {report[1]} graph ops, {report[2]:.2f}ms per image')
+                interval_start = time.perf_counter()
+                interval_done = 0
+
+        if first_report:
+            logger.info(f'Change since first report: RSS {report[0] - first_report[0]:+.1f}MB, '
+                        f'{report[1] - first_report[1]:+d} graph ops, {report[2] - first_report[2]:+.2f}ms per image')
+
+    def handle(self, *args, **options):
+        self.soak(options['paths'], options['images'], options['report_every'], options['batch_size'])
@@ -3,23 +3,48 @@ from pathlib import Path
 from shutil import rmtree
 from time import sleep
 
+from celery import chain
 from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db.models import Q
 
-from photonix.photos.models import Photo, Task
-from photonix.photos.utils.thumbnails import THUMBNAILER_VERSION
+from photonix.photos.models import Photo, PhotoFile
+from photonix.photos.tasks import generate_thumbnails_task, process_raw_task
+from photonix.photos.utils.raw import NON_RAW_MIMETYPES, RAW_PROCESS_VERSION
+from photonix.photos.utils.thumbnails import (THUMBNAILER_VERSION,
+                                              hash_photo_files,
+                                              remove_unreferenced_thumbnails)
 from photonix.web.utils import logger
 
 
 class Command(BaseCommand):
     help = 'Makes sure that if there have been upgrades to thumbnailing or image analysis code then jobs get rescheduled.'
 
-    def housekeeping(self):
+    def add_arguments(self, parser):
+        parser.add_argument('--reprocess-outdated-raws', action='store_true', default=False,
+                            help='Regenerate JPEGs for raw files not yet processed by the current raw processing '
+                                 'version. Raw files modified since or whose JPEG has gone missing aren\'t picked up by '
+                                 'this, only when they are next imported.')
+        parser.add_argument('--hash-photo-files', action='store_true', default=False,
+                            help='Hash files imported before THUMBNAIL_CONTENT_ADDRESSED was enabled and move their '
+                                 'thumbnails to the content-addressed layout')
+
+    def reprocess_outdated_raws(self):
+        # One query for the photos with raw files that are unprocessed or processed by any other version, the same
+        # version check as PhotoFile.needs_raw_processing() (which also checks the files on disk)
+        photo_ids = list(PhotoFile.objects.exclude(mimetype__in=NON_RAW_MIMETYPES).filter(
+            Q(raw_processed=False) | ~Q(raw_version=int(RAW_PROCESS_VERSION))
+        ).values_list('photo_id', flat=True).distinct())
+        logger.info(f'Rescheduling {len(photo_ids)} photos to have their raw files reprocessed')
+        for photo_id in photo_ids:
+            chain(process_raw_task.si(photo_id), generate_thumbnails_task.si(photo_id)).apply_async()
+
+    def housekeeping(self, reprocess_outdated_raws=False, hash_files=False):
         # Remove old cache directories
         try:
             for directory in os.listdir(settings.THUMBNAIL_ROOT):
-                if directory not in ['photofile']:
-                    path = Path(settings.THUMBNAIL_ROOT) / directory
+                path = Path(settings.THUMBNAIL_ROOT) / directory
+                if directory not in ['photofile', 'content'] and path.is_dir():
                     logger.info(f'Removing old cache directory {path}')
                     rmtree(path)
         except FileNotFoundError:  # In case thumbnail dir hasn't been created yet
@@ -32,9 +57,22 @@ class Command(BaseCommand):
             logger.info(
                 f'Rescheduling {photos.count()} photos to have their thumbnails regenerated')
             for photo in photos:
-                Task(
-                    type='generate_thumbnails', subject_id=photo.id,
-                    library=photo.library).save()
+                generate_thumbnails_task.delay(photo.id)
+
+        # Reads every file without a hash so only done when asked for
+        if hash_files:
+            num_hashed = hash_photo_files()
+            logger.info(f'Hashed {num_hashed} photo files for content-addressed thumbnails')
+
+        # Content-addressed thumbnails outlive their PhotoFiles so they can be reused, clear out the unused ones along
+        # with PhotoFile ID keyed ones that have been replaced by them
+        num_removed = remove_unreferenced_thumbnails()
+        if num_removed:
+            logger.info(f'Removed {num_removed} thumbnails no longer used by any photo file')
+
+        # Not done by default as raw files that can't be processed would be retried on every run
+        if reprocess_outdated_raws:
+            self.reprocess_outdated_raws()
 
     def handle(self, *args, **options):
-        self.housekeeping()
+        self.housekeeping(options['reprocess_outdated_raws'], options['hash_photo_files'])
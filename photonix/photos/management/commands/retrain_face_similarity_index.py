@@ -1,13 +1,12 @@
-import json
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 from pathlib import Path
 from time import time
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.utils import timezone
 
+from photonix.classifiers.face.index import indexed_face_count
 from photonix.classifiers.face.model import FaceModel
 from photonix.photos.models import Library, PhotoTag
 from photonix.web.utils import logger
@@ -16,7 +15,11 @@ from photonix.web.utils import logger
 class Command(BaseCommand):
     help = 'Creates Approximate Nearest Neighbour (ANN) search index for quickly finding closest face without having to compare one-by-one.'
 
-    def retrain_face_similarity_index(self):
+    def add_arguments(self, parser):
+        parser.add_argument('--compact', action='store_true',
+                            help='Rebuild each library\'s whole index instead of adding changes to its delta segment')
+
+    def retrain_face_similarity_index(self, compact=False):
         for library in Library.objects.all():
             version_file = Path(settings.MODEL_DIR) / \
                 'face' / f'{library.id}_retrained_version.txt'
@@ -31,18 +34,22 @@ class Command(BaseCommand):
             start = time()
             logger.info(f'Updating ANN index for Library {library.id}')
 
-            if PhotoTag.objects.filter(tag__type='F').count() == 0:
+            photo_tags = PhotoTag.objects.filter(photo__library=library, tag__type='F')
+            count = photo_tags.count()
+            if count == 0:
                 logger.info(
                     '    No Face PhotoTags in Library so no point in creating face ANN index yet')
-                return
-            if version_date and PhotoTag.objects.filter(updated_at__gt=version_date, tag__type='F').count() == 0:
+                continue
+            # A different count to last time means faces have been deleted even if none have been updated
+            if not compact and version_date and count == indexed_face_count(library.id) and \
+                    not photo_tags.filter(updated_at__gt=version_date).exists():
                 logger.info(
                     '    No new Face PhotoTags in Library so no point in updating face ANN index')
-                return
+                continue
 
-            FaceModel(library_id=library.id).retrain_face_similarity_index()
+            FaceModel(library_id=library.id).retrain_face_similarity_index(compact=compact)
 
             logger.info(f'    Completed in {(time() - start):.3f}s')
 
     def handle(self, *args, **options):
-        self.retrain_face_similarity_index()
+        self.retrain_face_similarity_index(compact=options['compact'])
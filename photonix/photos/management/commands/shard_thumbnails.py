@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from redis_lock import Lock
+
+from photonix.photos.utils.redis import redis_connection
+from photonix.photos.utils.thumbnails import (get_thumbnail_layout,
+                                              migrate_thumbnail_layout)
+from photonix.web.utils import logger
+
+
+class Command(BaseCommand):
+    help = 'Moves existing thumbnails into the directory layout set by THUMBNAIL_SHARDED (sharded or flat).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only count the thumbnails that would be moved')
+        parser.add_argument('--force', action='store_true', default=False,
+                            help='Check every thumbnail even if they have already been moved to the configured layout')
+
+    def shard_thumbnails(self, dry_run, force=False):
+        layout = 'sharded' if settings.THUMBNAIL_SHARDED else 'flat'
+        # Run on every container start so the thumbnails are only walked when the setting has been changed
+        if not force and get_thumbnail_layout() == layout:
+            logger.info(f'Thumbnails are already in the {layout} layout')
+            return
+        num_moved = migrate_thumbnail_layout(dry_run=dry_run)
+        if dry_run:
+            logger.info(f'{num_moved} thumbnails would be moved to the {layout} layout')
+        else:
+            logger.info(f'Moved {num_moved} thumbnails to the {layout} layout')
+
+    def handle(self, *args, **options):
+        with Lock(redis_connection, 'shard_thumbnails'):
+            self.shard_thumbnails(options['dry_run'], options['force'])
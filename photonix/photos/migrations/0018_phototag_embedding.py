@@ -0,0 +1,68 @@
+import json
+
+import numpy as np
+from django.db import migrations, models
+
+
+BATCH_SIZE = 1000
+
+
+def convert_photo_tags(apps, convert):
+    PhotoTag = apps.get_model('photos', 'PhotoTag')
+    batch = []
+    for photo_tag in PhotoTag.objects.filter(tag__type='F').only('id', 'extra_data', 'embedding').iterator(chunk_size=BATCH_SIZE):
+        if convert(photo_tag):
+            batch.append(photo_tag)
+        if len(batch) >= BATCH_SIZE:
+            PhotoTag.objects.bulk_update(batch, ['extra_data', 'embedding'])
+            batch = []
+    if batch:
+        PhotoTag.objects.bulk_update(batch, ['extra_data', 'embedding'])
+
+
+def json_to_binary(photo_tag):
+    try:
+        extra_data = json.loads(photo_tag.extra_data)
+        embedding = extra_data.pop('facenet_embedding')
+    except (json.decoder.JSONDecodeError, KeyError, TypeError, AttributeError):
+        return False
+    photo_tag.embedding = np.asarray(embedding, dtype='<f4').tobytes()
+    photo_tag.extra_data = json.dumps(extra_data) if extra_data else ''
+    return True
+
+
+def binary_to_json(photo_tag):
+    if not photo_tag.embedding:
+        return False
+    try:
+        extra_data = json.loads(photo_tag.extra_data) if photo_tag.extra_data else {}
+    except json.decoder.JSONDecodeError:
+        extra_data = {}
+    extra_data['facenet_embedding'] = np.frombuffer(photo_tag.embedding, dtype='<f4').tolist()
+    photo_tag.extra_data = json.dumps(extra_data)
+    photo_tag.embedding = None
+    return True
+
+
+def forwards(apps, schema_editor):
+    convert_photo_tags(apps, json_to_binary)
+
+
+def backwards(apps, schema_editor):
+    convert_photo_tags(apps, binary_to_json)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('photos', '0017_photofile_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='phototag',
+            name='embedding',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(forwards, backwards),
+    ]
@@ -1,5 +1,8 @@
 from __future__ import unicode_literals
 
+import os
+from datetime import datetime
+from datetime import timezone as dt_timezone
 from pathlib import Path
 
 from django.conf import settings
@@ -182,7 +185,10 @@ class Photo(UUIDModel, VersionedModel):
         return '/thumbnails/{}x{}_{}_q{}/{}.jpg'.format(thumbnail[0], thumbnail[1], thumbnail[2], thumbnail[3], self.id)
 
     def thumbnail_path(self, thumbnail):
-        return str(Path(settings.THUMBNAIL_ROOT) / 'photofile' / '{}x{}_{}_q{}/{}.jpg'.format(thumbnail[0], thumbnail[1], thumbnail[2], thumbnail[3], self.base_file.id))
+        from photonix.photos.utils.thumbnails import (get_thumbnail_key,
+                                                      get_thumbnail_path)
+        key_type, key = get_thumbnail_key(self.base_file)
+        return str(get_thumbnail_path(key, thumbnail[0], thumbnail[1], thumbnail[2], thumbnail[3], key_type))
 
     @property
     def base_file(self):
@@ -242,6 +248,9 @@ class PhotoFile(UUIDModel, VersionedModel):
     raw_external_version = models.CharField(
         max_length=32, blank=True, null=True)
     rotation = models.PositiveIntegerField(null=True, default=0)
+    # SHA-256 of base_image_path, used to share thumbnails between identical files when THUMBNAIL_CONTENT_ADDRESSED is on
+    content_hash = models.CharField(
+        max_length=64, blank=True, null=True, db_index=True)
 
     def __str__(self):
         return str(self.path)
@@ -258,6 +267,25 @@ class PhotoFile(UUIDModel, VersionedModel):
             return str(Path(settings.PHOTO_RAW_PROCESSED_DIR) / str('{}.jpg'.format(self.id)))
         return self.path
 
+    def needs_raw_processing(self):
+        '''
+        Whether a JPEG needs (re)generating from this raw file. It doesn't if one was made by the current
+        RAW_PROCESS_VERSION, is still on disk and the raw file hasn't been modified since.
+        '''
+        from photonix.photos.utils.raw import NON_RAW_MIMETYPES, RAW_PROCESS_VERSION
+
+        if self.mimetype in NON_RAW_MIMETYPES:
+            return False
+        if not self.raw_processed or self.raw_version != int(RAW_PROCESS_VERSION):
+            return True
+        if not os.path.exists(self.base_image_path):
+            return True
+        try:
+            file_modified_at = datetime.fromtimestamp(os.stat(self.path).st_mtime, tz=dt_timezone.utc)
+        except FileNotFoundError:
+            return True
+        return file_modified_at != self.file_modified_at
+
 
 SOURCE_CHOICES = (
     ('C', 'Computer'),
@@ -317,6 +345,8 @@ class PhotoTag(UUIDModel, VersionedModel):
     size_y = models.FloatField(null=True)
     # A place to store extra JSON data such as face feature positions for eyes, nose and mouth
     extra_data = models.TextField(null=True)
+    # Face embedding from Facenet as 128 little-endian float32s
+    embedding = models.BinaryField(null=True)
     deleted = models.BooleanField(default=False)
 
     class Meta:
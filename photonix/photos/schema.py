@@ -16,7 +16,8 @@ from photonix.photos.utils.filter_photos import (filter_photos_queryset,
                                                  sort_photos_exposure)
 from photonix.photos.utils.metadata import PhotoMetadata
 from photonix.photos.utils.tasks import count_remaining_task
-from photonix.photos.tasks import generate_thumbnails_task
+from photonix.photos.tasks import (generate_thumbnails_task,
+                                   photo_file_rotated_task)
 
 from .models import (Camera, Lens, Library, LibraryPath, LibraryUser, Photo,
                      PhotoFile, PhotoTag, Tag)
@@ -47,7 +48,8 @@ class PhotoTagType(DjangoObjectType):
 
     class Meta:
         model = PhotoTag
-        fields = '__all__'
+        # Face embeddings are binary and only used internally for matching
+        exclude = ('embedding',)
 
     def resolve_show_verify_icon(self, info):
         if self.tag.type == 'F' and not self.verified and self.tag.photo_tags.filter(verified=True).exists():
@@ -1051,6 +1053,8 @@ class ChangePreferredPhotoFile(graphene.Mutation):
         """Mutation to update preferred_photo_file for photo."""
         user = info.context.user
         photo_obj = PhotoFile.objects.get(id=selected_photo_file_id, photo__library__users__user=user).photo
+        if str(photo_obj.preferred_photo_file_id) == str(selected_photo_file_id):
+            return ChangePreferredPhotoFile(ok=True)
         photo_obj.preferred_photo_file = PhotoFile.objects.get(
             id=selected_photo_file_id, photo__library__users__user=user)
         photo_obj.save()
@@ -1237,9 +1241,11 @@ class SavePhotoFileRotation(graphene.Mutation):
         user = info.context.user
         if photo_file_id and rotation in [0, 90, 180, 270]:
             photofile_obj = PhotoFile.objects.get(id=photo_file_id, photo__library__users__user=user)
+            previous_rotation = photofile_obj.rotation
             photofile_obj.rotation = rotation
             photofile_obj.save()
-            generate_thumbnails_task.delay(photofile_obj.photo.id)
+            if rotation != previous_rotation:
+                photo_file_rotated_task.delay(photofile_obj.id)
             return SavePhotoFileRotation(ok=True, rotation=rotation)
         return SavePhotoFileRotation(ok=False, rotation=rotation)
 
@@ -1,8 +1,6 @@
-import os
-import shutil
 from pathlib import Path
 
-from celery import shared_task, group
+from celery import shared_task
 from django.conf import settings
 
 from photonix.classifiers.color import run_on_photo as run_color
@@ -10,16 +8,29 @@ from photonix.classifiers.event import run_on_photo as run_event
 from photonix.classifiers.face import run_on_photo as run_face
 from photonix.classifiers.location import run_on_photo as run_location
 from photonix.classifiers.object import run_on_photo as run_object
+from photonix.classifiers.object import run_on_photos as run_object_batch
 from photonix.classifiers.style import run_on_photo as run_style
-from photonix.photos.models import Photo
+from photonix.classifiers.style import run_on_photos as run_style_batch
+from photonix.photos.models import Photo, PhotoFile
+from photonix.photos.utils.classifier_batch import (claim_batch_deadline, pending_batch_size, queue_for_batch,
+                                                    release_batch_deadline, take_batch)
+from photonix.photos.utils.image import decode_photo
 from photonix.photos.utils.metadata import get_dimensions
 from photonix.photos.utils.raw import NON_RAW_MIMETYPES, generate_jpeg
+from photonix.photos.utils.raw_scheduler import RawDevelopmentDeferred
 from photonix.photos.utils.thumbnails import generate_thumbnails_for_photo
 from photonix.web.utils import logger
 
 
-@shared_task
-def process_raw_task(photo_id):
+# How long to wait before trying again when the raw development memory budget is used up. Doubles with each retry up
+# to RAW_DEVELOPMENT_MAX_RETRY_DELAY, giving up after RAW_DEVELOPMENT_MAX_RETRIES (about 4 hours in all).
+RAW_DEVELOPMENT_RETRY_DELAY = 30
+RAW_DEVELOPMENT_MAX_RETRY_DELAY = 30 * 60
+RAW_DEVELOPMENT_MAX_RETRIES = 12
+
+
+@shared_task(bind=True, max_retries=RAW_DEVELOPMENT_MAX_RETRIES)
+def process_raw_task(self, photo_id):
     logger.info(f'Processing raw photos for photo {photo_id}')
     try:
         photo = Photo.objects.get(id=photo_id)
@@ -30,24 +41,38 @@ def process_raw_task(photo_id):
     for photo_file in photo.files.all():
         # TODO: Make raw photo detection better
         if photo_file.mimetype not in NON_RAW_MIMETYPES:
+            # Other files of the photo being modified (or only metadata changing) shouldn't redo a development
+            if not photo_file.needs_raw_processing():
+                logger.info(f'Raw file {photo_file.id} already processed')
+                continue
             logger.info(f'Processing raw file {photo_file.id}')
-            output_path, version, process_params, external_version = generate_jpeg(
-                photo_file.path)
+            # JPEG gets written straight to its final location
+            destination_path = Path(settings.PHOTO_RAW_PROCESSED_DIR) / \
+                str('{}.jpg'.format(photo_file.id))
+            try:
+                output_path, version, process_params, external_version = generate_jpeg(
+                    photo_file.path, str(destination_path))
+            except RawDevelopmentDeferred:
+                if self.request.retries >= self.max_retries:
+                    # Left unprocessed so housekeeping --reprocess-outdated-raws can pick it up again
+                    logger.error(f'Giving up on raw development of {photo_file.id} after {self.request.retries} '
+                                 f'retries as there has been no memory available')
+                    continue
+                # Frees up this worker for cheaper tasks (like other photos' embedded previews) in the meantime
+                countdown = min(RAW_DEVELOPMENT_RETRY_DELAY * 2 ** self.request.retries, RAW_DEVELOPMENT_MAX_RETRY_DELAY)
+                logger.info(f'Deferring raw development of {photo_file.id} for {countdown}s until there is memory '
+                            f'available')
+                raise self.retry(countdown=countdown)
 
             if not output_path:
                 logger.error(f'Could not generate JPEG for {photo_file.path}')
                 continue
 
-            if not os.path.isdir(settings.PHOTO_RAW_PROCESSED_DIR):
-                os.makedirs(settings.PHOTO_RAW_PROCESSED_DIR)
-            destination_path = Path(settings.PHOTO_RAW_PROCESSED_DIR) / \
-                str('{}.jpg'.format(photo_file.id))
-            shutil.move(output_path, str(destination_path))
-
             photo_file.raw_processed = True
             photo_file.raw_version = version
             photo_file.raw_external_params = process_params
             photo_file.raw_external_version = external_version
+            photo_file.content_hash = None
 
             if not photo_file.width or not photo_file.height:
                 width, height = get_dimensions(photo_file.base_image_path)
@@ -58,42 +83,151 @@ def process_raw_task(photo_id):
             logger.info(f'Processed raw file {photo_file.id}')
 
 
+# Classifiers that are shown the photo with the user's rotation applied (see decode_photo) so their results can change
+# when it's rotated. Style, color, location and event results don't depend on which way up the photo is.
+ORIENTATION_DEPENDENT_CLASSIFIERS = ['face', 'object']
+
+# Classifiers whose models can run several photos through one inference. When CLASSIFIER_BATCH_SIZE is more than 1
+# these are queued up and run by classify_batch_task rather than one photo at a time.
+BATCH_CLASSIFIERS = {
+    'object': run_object_batch,
+    'style': run_style_batch,
+}
+
+
 @shared_task
 def generate_thumbnails_task(photo_id):
     logger.info(f'Generating thumbnails for photo {photo_id}')
-    generate_thumbnails_for_photo(photo_id)
+    try:
+        photo = Photo.objects.select_related('library').get(id=photo_id)
+    except Photo.DoesNotExist:
+        logger.error(f'Photo {photo_id} not found')
+        return
+
+    # The base image is decoded once here and shared by the thumbnailer and all the classifiers
+    image = decode_photo(photo) if photo.base_file else None
+    generate_thumbnails_for_photo(photo, image=image)
+    analyse_photo(photo, image=image)
 
-    # Trigger classification tasks
+
+@shared_task
+def photo_file_rotated_task(photo_file_id):
+    # Rotation is applied by the UI when displaying thumbnails so there is nothing to re-render, only the classifiers
+    # that look at the orientation of the image need re-running.
+    logger.info(f'Handling rotation of photo file {photo_file_id}')
     try:
-        photo = Photo.objects.get(id=photo_id)
-        library = photo.library
+        photo_file = PhotoFile.objects.select_related('photo__library').get(id=photo_file_id)
+    except PhotoFile.DoesNotExist:
+        logger.error(f'Photo file {photo_file_id} not found')
+        return
 
-        tasks = []
-        if library.classification_color_enabled:
-            tasks.append(classify_color_task.s(photo_id))
+    photo = photo_file.photo
+    if photo.base_file != photo_file:
+        logger.info(f'Photo file {photo_file_id} is not the base file of photo {photo.id} so no analysis to redo')
+        return
 
-        if library.classification_event_enabled:
-            tasks.append(classify_event_task.s(photo_id))
+    classify_photo(photo, classifiers=ORIENTATION_DEPENDENT_CLASSIFIERS)
+
+
+def enabled_classifiers(photo, classifiers=None):
+    # Classifiers enabled on the photo's library, optionally limited to the given names
+    library = photo.library
+    classifier_runners = {
+        'color': (library.classification_color_enabled, run_color),
+        'event': (library.classification_event_enabled, run_event),
+        'face': (library.classification_face_enabled, run_face),
+        'location': (library.classification_location_enabled, run_location),
+        'object': (library.classification_object_enabled, run_object),
+        'style': (library.classification_style_enabled, run_style),
+    }
+    return {
+        name: run for name, (enabled, run) in classifier_runners.items()
+        if enabled and (classifiers is None or name in classifiers)
+    }
+
+
+def analyse_photo(photo, classifiers=None, image=None):
+    '''
+    Runs all the enabled classifiers on a photo in this process. The base image is decoded once and the same
+    DecodedImage (and the downscaled versions made from it) is handed to each classifier instead of each one reading
+    the file again. Classifiers in BATCH_CLASSIFIERS are queued to run with other photos instead. A classifier failing
+    is logged and doesn't stop the others.
+    '''
+    runners = enabled_classifiers(photo, classifiers)
+    names = list(runners)
+    if not runners or not photo.base_file:
+        return []
+
+    if settings.CLASSIFIER_BATCH_SIZE > 1:
+        for name in [name for name in runners if name in BATCH_CLASSIFIERS]:
+            del runners[name]
+            schedule_classifier_batch(name, queue_for_batch(name, photo.id))
+
+    image = decode_photo(photo, image)
+
+    for name, run in runners.items():
+        logger.info(f'Running {name} classification for photo {photo.id}')
+        try:
+            run(photo.id, image=image)
+        except Exception:
+            logger.exception(f'Failed to run {name} classification for photo {photo.id}')
+    return names
+
+
+def schedule_classifier_batch(name, pending):
+    # pending is the queue length after a photo was added. A task is queued each time another full batch has gathered,
+    # otherwise the first photo to arrive sets a deadline for whatever has gathered by then.
+    if not pending:
+        return
+    if pending % settings.CLASSIFIER_BATCH_SIZE == 0:
+        classify_batch_task.delay(name)
+    else:
+        schedule_batch_deadline(name)
 
-        if library.classification_face_enabled:
-            tasks.append(classify_face_task.s(photo_id))
 
-        if library.classification_location_enabled:
-            tasks.append(classify_location_task.s(photo_id))
+def schedule_batch_deadline(name):
+    if claim_batch_deadline(name, settings.CLASSIFIER_BATCH_MAX_WAIT):
+        classify_batch_task.apply_async((name, True), countdown=settings.CLASSIFIER_BATCH_MAX_WAIT)
 
-        if library.classification_object_enabled:
-            tasks.append(classify_object_task.s(photo_id))
 
-        if library.classification_style_enabled:
-            tasks.append(classify_style_task.s(photo_id))
+@shared_task
+def classify_batch_task(name, deadline=False):
+    # Only the task scheduled by the deadline releases it, full batches leave it for that task to flush the rest
+    if deadline:
+        release_batch_deadline(name)
+    photo_ids = take_batch(name, settings.CLASSIFIER_BATCH_SIZE)
+    if photo_ids:
+        logger.info(f'Running {name} classification for a batch of {len(photo_ids)} photos')
+        try:
+            BATCH_CLASSIFIERS[name](photo_ids)
+        except Exception:
+            logger.exception(f'Failed to run {name} classification for photos {photo_ids}')
+
+    # Photos that arrived while this batch was running. Any full batches among them had a task queued as they
+    # arrived so only the remainder needs a deadline.
+    if pending_batch_size(name):
+        schedule_batch_deadline(name)
 
-        if tasks:
-            group(tasks).apply_async()
 
+@shared_task
+def analyse_photo_task(photo_id, classifiers=None):
+    try:
+        photo = Photo.objects.select_related('library').get(id=photo_id)
     except Photo.DoesNotExist:
-        logger.error(f'Photo {photo_id} not found during classification dispatch')
+        logger.error(f'Photo {photo_id} not found')
+        return
+    analyse_photo(photo, classifiers)
+
+
+def classify_photo(photo, classifiers=None):
+    # Queues a single analysis job running each enabled classifier, optionally limited to the given names
+    names = list(enabled_classifiers(photo, classifiers))
+    if names:
+        analyse_photo_task.delay(photo.id, names)
+    return len(names)
 
 
+# Single classifier tasks, for running one classifier on its own and for messages queued before analyse_photo_task
 @shared_task
 def classify_color_task(photo_id):
     logger.info(f'Running color classification for photo {photo_id}')
@@ -0,0 +1,44 @@
+from photonix.photos.utils import redis
+
+
+# Photo IDs waiting to be run through a classifier in the next batch
+CLASSIFIER_BATCH_QUEUE_KEY = 'classifier_batch_queue:{}'
+# Set while a flush of the queue is scheduled so only the first photo to arrive schedules one
+CLASSIFIER_BATCH_DEADLINE_KEY = 'classifier_batch_deadline:{}'
+
+
+def queue_for_batch(name, photo_id):
+    '''
+    Adds a photo to the named classifier's batch queue. Returns the number of photos now waiting.
+    '''
+    return redis.redis_connection.rpush(CLASSIFIER_BATCH_QUEUE_KEY.format(name), str(photo_id))
+
+
+def pending_batch_size(name):
+    return redis.redis_connection.llen(CLASSIFIER_BATCH_QUEUE_KEY.format(name))
+
+
+def take_batch(name, size):
+    '''
+    Removes up to size photo IDs from the front of the named classifier's queue and returns them. Reading and trimming
+    happen in one transaction so two workers never take the same photos.
+    '''
+    key = CLASSIFIER_BATCH_QUEUE_KEY.format(name)
+    pipeline = redis.redis_connection.pipeline()
+    pipeline.lrange(key, 0, size - 1)
+    pipeline.ltrim(key, size, -1)
+    photo_ids, _ = pipeline.execute()
+    # Duplicates (e.g. a photo rotated twice in quick succession) only need classifying once
+    return list(dict.fromkeys(photo_id.decode('utf-8') for photo_id in photo_ids))
+
+
+def claim_batch_deadline(name, max_wait):
+    '''
+    Returns True if the caller should schedule a flush of the queue max_wait seconds from now, False if one is
+    already scheduled. The claim expires on its own in case the scheduled task never runs.
+    '''
+    return bool(redis.redis_connection.set(CLASSIFIER_BATCH_DEADLINE_KEY.format(name), 1, nx=True, ex=max_wait * 2 + 60))
+
+
+def release_batch_deadline(name):
+    redis.redis_connection.delete(CLASSIFIER_BATCH_DEADLINE_KEY.format(name))
@@ -206,6 +206,8 @@ def record_photo(path, library, inotify_event_type=None):
     photo_file.mimetype = mimetype
     photo_file.file_modified_at = file_modified_at
     photo_file.bytes = os.stat(path).st_size
+    photo_file.content_hash = None  # File has changed so gets re-hashed when thumbnailing
+    photo_file.raw_processed = False  # Likewise any JPEG generated from it is out of date
     photo_file.preferred = False  # TODO
     photo_file.save()
 
@@ -0,0 +1,122 @@
+from PIL import Image, ImageFile
+
+from photonix.photos.utils.metadata import PhotoMetadata
+
+
+class DecodedImage(object):
+    '''
+    A photo's base image and metadata, read once and shared between thumbnailing and all the classifiers that analyse
+    it. Nothing is read until it's first needed so metadata-only classifiers never decode the pixels, and derived
+    versions (RGB, oriented, resized) are cached so each is only made once. Treat the images as read-only.
+    '''
+
+    def __init__(self, path, rotation=0):
+        self.path = str(path)
+        # Degrees clockwise the user has rotated the photo by (PhotoFile.rotation). Only the oriented versions the
+        # classifiers look at have it applied, thumbnails are rotated by the UI.
+        self.rotation = rotation or 0
+        self.cache = {}
+
+    def __cached(self, key, make):
+        if key not in self.cache:
+            self.cache[key] = make()
+        return self.cache[key]
+
+    def __decode(self):
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+        image = Image.open(self.path)
+        image.load()
+        return image
+
+    @property
+    def image(self):
+        # As stored in the file, in its own color mode and without orientation applied
+        return self.__cached('image', self.__decode)
+
+    @property
+    def metadata(self):
+        return self.__cached('metadata', lambda: PhotoMetadata(self.path))
+
+    @property
+    def rgb(self):
+        return self.__cached('rgb', lambda: self.image if self.image.mode == 'RGB' else self.image.convert('RGB'))
+
+    def __orient(self, image):
+        # Perform rotations if decalared in metadata
+        if self.metadata.get('Orientation') in ['Rotate 90 CW', 'Rotate 270 CCW']:
+            image = image.rotate(-90, expand=True)
+        elif self.metadata.get('Orientation') in ['Rotate 90 CCW', 'Rotate 270 CW']:
+            image = image.rotate(90, expand=True)
+        # Then the user's rotation on top (PIL rotates anticlockwise)
+        if self.rotation:
+            image = image.rotate(-self.rotation, expand=True)
+        return image
+
+    @property
+    def oriented(self):
+        return self.__cached('oriented', lambda: self.__orient(self.rgb))
+
+    def resized(self, size, resample=Image.BICUBIC):
+        # Resized from the image as stored, e.g. the small version the color classifier counts pixels in
+        return self.__cached(('resized', size, resample), lambda: self.image.resize(size, resample))
+
+    def __reduce_to(self, size, resample, oriented):
+        if 'image' in self.cache:
+            image = self.rgb
+        else:
+            # Nothing else has needed the full size pixels so JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale.
+            # Either dimension may end up the width once oriented so both must stay at least as big as size.
+            ImageFile.LOAD_TRUNCATED_IMAGES = True
+            image = Image.open(self.path)
+            image.draft('RGB', (max(size), max(size)))
+            image.load()
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+        if oriented:
+            image = self.__orient(image)
+        return image.resize(size, resample)
+
+    def reduced(self, size, resample=Image.BILINEAR, oriented=False):
+        '''
+        An RGB version resized to exactly size (ignoring aspect ratio) for models with a fixed input size, without
+        holding the full size image in memory if it hasn't been decoded already.
+        '''
+        return self.__cached(('reduced', size, resample, oriented), lambda: self.__reduce_to(size, resample, oriented))
+
+
+def decode_photo(photo, image=None):
+    '''
+    DecodedImage of a Photo's base file with the user's rotation, reusing image if it's already exactly that.
+    '''
+    photo_file = photo.base_file
+    rotation = photo_file.rotation or 0
+    if image is not None and image.path == str(photo_file.base_image_path) and image.rotation == rotation:
+        return image
+    return DecodedImage(photo_file.base_image_path, rotation=rotation)
+
+
+def unrotate_box(left, top, right, bottom, rotation):
+    '''
+    Maps a box given as fractions of an image rotated clockwise by rotation degrees back onto the image before it was
+    rotated. Results are stored like this as the UI rotates the image and its boxes together.
+    '''
+    def unrotate_point(x, y):
+        if rotation == 90:
+            return y, 1 - x
+        elif rotation == 180:
+            return 1 - x, 1 - y
+        elif rotation == 270:
+            return 1 - y, x
+        return x, y
+
+    (x1, y1), (x2, y2) = unrotate_point(left, top), unrotate_point(right, bottom)
+    return min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)
+
+
+def decode_image(image_file):
+    '''
+    Classifiers accept either a path or an already DecodedImage, this gives them a DecodedImage either way.
+    '''
+    if isinstance(image_file, DecodedImage):
+        return image_file
+    return DecodedImage(image_file)
@@ -1,6 +1,7 @@
+import io
 import os
-import re
 import shutil
+import struct
 import subprocess
 import tempfile
 from pathlib import Path
@@ -9,7 +10,11 @@ from PIL import Image
 
 from photonix.web.utils import logger
 
-from .metadata import get_dimensions, get_mimetype
+from .metadata import PhotoMetadata
+from .raw_preview import copy_embedded_jpeg, find_embedded_jpegs
+from .raw_scheduler import raw_development_slot
+from .system import tools
+from .thumbnails import write_file_atomically
 
 RAW_PROCESS_VERSION = '20190305'
 NON_RAW_MIMETYPES = [
@@ -25,32 +30,9 @@ NON_RAW_MIMETYPES = [
 ]
 
 
-def __get_generated_image(temp_dir, basename):
-    for fn in os.listdir(temp_dir):
-        if fn != basename:
-            return Path(temp_dir) / fn
-
-
-def __get_exiftool_image(temp_dir, basename):
-    """
-    Exiftool outputs two files when copying the tags over, we
-    want the file that ends in .jpg and not .jpg_original, but
-    to keep the filesystem tidy we need to get the path.
-    """
-    exiftool_files = {}
-    for fn in os.listdir(temp_dir):
-        if fn.endswith('.jpg_original'):
-            exiftool_files['original']: Path(temp_dir) / fn
-        if fn.endswith('.jpg'):
-            exiftool_files['output']: Path(temp_dir) / fn
-    return exiftool_files
-
-
-def __has_acceptable_dimensions(original_image_path, new_image_path, accept_empty_original_dimensions=False):
+def __has_acceptable_dimensions(original_image_dimensions, new_image_dimensions, accept_empty_original_dimensions=False):
     logger.debug('Checking image dimensions')
-    original_image_dimensions = get_dimensions(original_image_path)
     logger.debug(f'Original image dimensions: {original_image_dimensions}')
-    new_image_dimensions = get_dimensions(new_image_path)
     logger.debug(f'New image dimensions: {new_image_dimensions}')
 
     # We don't know the original dimensions so have nothing to compare to
@@ -85,9 +67,11 @@ def __has_acceptable_dimensions(original_image_path, new_image_path, accept_empt
 
 
 def identified_as_jpeg(path):
-    output = subprocess.Popen(['file', path], stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].decode('utf-8')
-    return 'JPEG image data' in output
+    try:
+        with Image.open(path) as im:
+            return im.format == 'JPEG'
+    except (OSError, ValueError):
+        return False
 
 
 def bitmap_to_jpeg(input_path, output_path, quality=75):
@@ -96,161 +80,155 @@ def bitmap_to_jpeg(input_path, output_path, quality=75):
     im.save(output_path, format='JPEG', quality=quality)
 
 
-def __dcraw_version():
-    output = subprocess.Popen(['dcraw'], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                              stderr=subprocess.PIPE).communicate()[0].decode('utf-8')
-    for line in output.split('\n'):
-        if 'Raw photo decoder "dcraw"' in line:
-            try:
-                return re.search(r'v([0-9]+.[0-9]+)', line).group(1)
-            except AttributeError:
-                return
-
-
-def __heif_convert_version():
-    output = subprocess.Popen(['dpkg', '-s', 'libheif-examples'], stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].decode('utf-8')
-    for line in output.split('\n'):
-        if 'Version: ' in line:
-            try:
-                return re.search(r'([0-9]+.[0-9]+.[0-9]+)', line).group(1)
-            except AttributeError:
-                return
-
-
-def __exiftool_version():
-    output = subprocess.Popen(['dpkg', '-s', 'libimage-exiftool-perl'], stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0].decode('utf-8')
-    for line in output.split('\n'):
-        if 'Version: ' in line:
-            try:
-                return re.search(r'([0-9]+.[0-9]+.[0-9]+)', line).group(1)
-            except AttributeError:
-                return
-
-
-def __delete_file_silently(path):
+def __get_image_dimensions(image_data):
+    # Only reads the image header, pixel data isn't decoded
     try:
-        os.remove(path)
-    except FileNotFoundError:
-        pass
+        with Image.open(io.BytesIO(image_data)) as im:
+            return im.size
+    except (OSError, ValueError):
+        return (None, None)
 
 
-def generate_jpeg(path):
-    logger.debug(f'Generating JPEG for raw file {path}')
-    basename = os.path.basename(path)
-    temp_dir = tempfile.mkdtemp()
-    temp_input_path = Path(temp_dir) / basename
-    shutil.copyfile(path, temp_input_path)
-
-    valid_image = False
-    process_params = None
-    external_version = None
-
-    # Handle Canon's CR3 format since their thumbnails are proprietary.
-    mimetype = get_mimetype(temp_input_path)
-    if mimetype == 'image/x-canon-cr3':
-        logger.debug('File type detected as Canon Raw v3')
-        subprocess.Popen([
-            'exiftool', '-b', '-JpgFromRaw', '-w', 'jpg', '-ext', 'CR3',
-            temp_input_path, '-execute', '-tagsfromfile', temp_input_path,
-            '-ext', 'jpg', Path(temp_dir)],
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-            stderr=subprocess.PIPE).communicate()
-        exiftool_output = __get_exiftool_image(temp_dir, basename)
-        # Clean up the original file without tags.
-        if 'original' in exiftool_output:
-            os.remove(exiftool_output['original'])
-        # Set the input file.
-        if 'output' in exiftool_output:
-            temp_output_path = exiftool_output['output']
+def __get_image_format(image_data):
+    try:
+        with Image.open(io.BytesIO(image_data)) as im:
+            return im.format
+    except (OSError, ValueError):
+        return None
+
+
+def __image_data_result(image_data, process_params, external_version):
+    # Stages return (dimensions, function that writes the JPEG to a file object, process params, external version)
+    if not image_data:
+        return None
+
+    def write(f):
+        # JPEGs are written out untouched, anything else (e.g. dcraw's PPM output) gets encoded
+        if __get_image_format(image_data) == 'JPEG':
+            f.write(image_data)
         else:
-            temp_output_path = None
-        process_params = 'exiftool -b -JpgFromRaw'
-        external_version = __exiftool_version()
-    elif mimetype in ['image/heif', 'image/heic']:
-        logger.debug('File type detected as HIEF/HEIC')
+            logger.debug('Image isn\'t a JPEG, attempting bitmap conversion')
+            bitmap_to_jpeg(io.BytesIO(image_data), f)
+
+    return __get_image_dimensions(image_data), write, process_params, external_version
+
+
+def __run_dcraw(args, path):
+    # -c writes the output to stdout so nothing gets written next to the source file
+    return subprocess.run(['dcraw', '-c'] + args + [path], stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout
+
+
+def __extract_embedded_jpeg(path):
+    try:
+        jpegs, orientation = find_embedded_jpegs(path)
+    except (OSError, struct.error):
+        jpegs = None
+
+    if jpegs is None:
+        # Container we can't parse ourselves (e.g. RAF, RW2, ORF) so leave it to dcraw
+        logger.debug('Attempting to extract JPEG using dcraw')
+        return __image_data_result(__run_dcraw(['-e'], path), 'dcraw -e', tools.version('dcraw'))
+
+    logger.debug(f'Found {len(jpegs)} embedded JPEGs')
+    if not jpegs:
+        return None
+
+    # Dimensions come from the JPEG's frame header so nothing needs reading until we know it's the one we want
+    jpeg = max(jpegs, key=lambda jpeg: jpeg.width * jpeg.height)
+    return (jpeg.width, jpeg.height), lambda f: copy_embedded_jpeg(path, jpeg, f, orientation), 'embedded preview', None
+
+
+def __convert_heif(path):
+    temp_dir = tempfile.mkdtemp()
+    try:
         temp_output_path = Path(temp_dir) / 'out.jpg'
-        subprocess.run(['heif-convert', '-q', '90',
-                       temp_input_path, temp_output_path])
-        process_params = 'heif-convert -q 90'
-        external_version = __heif_convert_version()
+        subprocess.run(['heif-convert', '-q', '90', path, temp_output_path])
+        try:
+            with open(temp_output_path, 'rb') as f:
+                image_data = f.read()
+        except FileNotFoundError:
+            image_data = None
+    finally:
+        shutil.rmtree(temp_dir)
+    return __image_data_result(image_data, 'heif-convert -q 90', tools.version('heif-convert'))
+
+
+def __develop_with_embedded_profile(path):
+    logger.debug('Attempting to generate JPEG with dcraw using embedded color profile')
+    return __image_data_result(__run_dcraw(['-p embed'], path), 'dcraw -p embed', tools.version('dcraw'))
+
+
+def __develop_with_embedded_white_balance(path):
+    logger.debug('Attempting to generate JPEG with dcraw using embedded white balance')
+    return __image_data_result(__run_dcraw(['-w'], path), 'dcraw -w', tools.version('dcraw'))
+
+
+def __run_stage(stage, path, output_path, original_dimensions, accept_empty_original_dimensions):
+    result = stage(path)
+    if not result:
+        return None
+    dimensions, write, process_params, external_version = result
+
+    # Check the image's dimensions are close enough to the raw's dimensions
+    if not __has_acceptable_dimensions(original_dimensions, dimensions, accept_empty_original_dimensions):
+        return None
+
+    logger.debug('Image looks good so far')
+    destination_path = output_path
+    if not destination_path:
+        fd, destination_path = tempfile.mkstemp()
+        os.close(fd)
+    try:
+        write_file_atomically(destination_path, write)
+    except (OSError, ValueError):
+        logger.debug('Couldn\'t write JPEG')
+        if not output_path:
+            os.remove(destination_path)
+        return None
+
+    logger.debug(f'Returning info about JPEG which is located here: {destination_path}')
+    return (destination_path, RAW_PROCESS_VERSION, process_params, external_version)
+
+
+def generate_jpeg(path, output_path=None, development_timeout=10):
+    '''
+    Makes a JPEG version of a raw file by running it through a series of stages, from cheapest to most expensive, until
+    one produces an image of acceptable dimensions. The source file is read in place and intermediate images are kept
+    in memory. Embedded previews are copied straight from the raw file to output_path (a temporary file if not given).
+    Returns (path to the JPEG, RAW_PROCESS_VERSION, process params, external tool version). Raises
+    RawDevelopmentDeferred if a full development is needed but the memory budget is used up for development_timeout.
+    '''
+    logger.debug(f'Generating JPEG for raw file {path}')
+
+    # exiftool only gets run once, for the original file
+    metadata = PhotoMetadata(path)
+    mimetype = metadata.get('MIME Type')
+    original_dimensions = (None, None)
+    if metadata.get('Image Width') and metadata.get('Image Height'):
+        original_dimensions = (int(metadata.get('Image Width')), int(metadata.get('Image Height')))
+
+    # Cheap extractions run straight away, full developments have to be admitted by the raw development scheduler
+    if mimetype in ['image/heif', 'image/heic']:
+        logger.debug('File type detected as HIEF/HEIC')
+        stages = [(__convert_heif, False, False)]
     else:
-        logger.debug('Attempting to extract JPEG using dcraw')
-        # Try to extract the JPEG that might be inside the raw file
-        subprocess.run(['dcraw', '-e', temp_input_path])
-        temp_output_path = __get_generated_image(temp_dir, basename)
-        process_params = 'dcraw -e'
-        external_version = __dcraw_version()
-
-    # Check the JPEGs dimensions are close enough to the raw's dimensions
-    if temp_output_path:
-        if __has_acceptable_dimensions(temp_input_path, temp_output_path):
-            logger.debug('JPEG file looks good so far')
-            valid_image = True
+        stages = [(__extract_embedded_jpeg, False, False)]
+    stages += [
+        (__develop_with_embedded_profile, False, True),
+        (__develop_with_embedded_white_balance, True, True),
+    ]
+
+    for stage, accept_empty_original_dimensions, full_development in stages:
+        if full_development:
+            # Slot is held until the JPEG has been encoded as that needs the decoded image in memory too
+            with raw_development_slot(*original_dimensions, timeout=development_timeout):
+                result = __run_stage(stage, path, output_path, original_dimensions,
+                                     accept_empty_original_dimensions)
         else:
-            __delete_file_silently(temp_output_path)
-
-    # Next try to use embedded profile to generate an image
-    if not valid_image:
-        logger.debug(
-            'Attempting to generate JPEG with dcraw using embedded color profile')
-        subprocess.run(['dcraw', '-p embed', temp_input_path])
-        temp_output_path = __get_generated_image(temp_dir, basename)
-
-        if temp_output_path:
-            if __has_acceptable_dimensions(temp_input_path, temp_output_path):
-                logger.debug('JPEG file looks good so far')
-                valid_image = True
-                process_params = 'dcraw -p embed'
-            else:
-                __delete_file_silently(temp_output_path)
-
-    # Finally try to use the embedded whitebalance to generate an image
-    if not valid_image:
-        logger.debug(
-            'Attempting to generate JPEG with dcraw using embedded white balance')
-        subprocess.run(['dcraw', '-w', temp_input_path])
-        temp_output_path = __get_generated_image(temp_dir, basename)
-
-        if temp_output_path:
-            if __has_acceptable_dimensions(temp_input_path, temp_output_path, True):
-                logger.debug('JPEG file looks good so far')
-                valid_image = True
-                process_params = 'dcraw -w'
-            else:
-                __delete_file_silently(temp_output_path)
-
-    # If extracted image isn't a JPEG then we need to convert it
-    if valid_image:
-        valid_image = identified_as_jpeg(temp_output_path)
-
-        if not valid_image:
-            logger.debug(
-                'JPEG didn\'t pass test, attempting bitmap conversion')
-            jpeg_path = tempfile.mktemp()
-            bitmap_to_jpeg(temp_output_path, jpeg_path)
-
-            if identified_as_jpeg(jpeg_path):
-                logger.debug('JPEG file now passes test')
-                temp_output_path = jpeg_path
-                valid_image = True
-
-    # Move the outputted file to a new temporary location
-    if valid_image:
-        logger.debug('I\'m happy with the JPEG so moving it to a new location')
-        final_path = tempfile.mktemp()
-        os.rename(temp_output_path, final_path)
-
-    # Delete the temporary working directory
-    logger.debug('Deleting temporary files')
-    shutil.rmtree(temp_dir)
-
-    if valid_image:
-        logger.debug(
-            f'Returning info about JPEG which is temporarily located here: {final_path}')
-        return (final_path, RAW_PROCESS_VERSION, process_params, external_version)
+            result = __run_stage(stage, path, output_path, original_dimensions, accept_empty_original_dimensions)
+        if result:
+            return result
 
     logger.error('Couldn\'t make JPEG from raw file')
     return (None, RAW_PROCESS_VERSION, None, None)
@@ -0,0 +1,278 @@
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from PIL import Image
+
+
+EmbeddedJpeg = namedtuple('EmbeddedJpeg', ['offset', 'length', 'width', 'height'])
+
+TIFF_TAG_COMPRESSION = 0x0103
+TIFF_TAG_STRIP_OFFSETS = 0x0111
+TIFF_TAG_ORIENTATION = 0x0112
+TIFF_TAG_STRIP_BYTE_COUNTS = 0x0117
+TIFF_TAG_SUB_IFDS = 0x014a
+TIFF_TAG_JPEG_OFFSET = 0x0201  # JpgFromRaw / PreviewImage / ThumbnailImage depending on the IFD
+TIFF_TAG_JPEG_LENGTH = 0x0202
+TIFF_JPEG_COMPRESSIONS = [6, 7]  # Old-style and new-style JPEG
+TIFF_VALUE_FORMATS = {3: 'H', 4: 'I', 13: 'I'}  # SHORT, LONG and IFD
+MAX_IFDS = 64
+
+# Baseline, extended and progressive. Lossless JPEG (0xc3) is used for raw sensor data which we can't display.
+JPEG_DISPLAYABLE_SOF_MARKERS = [0xc0, 0xc1, 0xc2]
+JPEG_OTHER_SOF_MARKERS = [0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf]
+
+CANON_CR3_UUID = bytes.fromhex('85c0b687820f11e08111f4ce462b6a48')
+BMFF_CONTAINER_BOXES = [b'moov', b'trak', b'mdia', b'minf', b'stbl']
+
+
+def __jpeg_dimensions(f, offset, length):
+    # Walks the JPEG segments up to the frame header without decoding anything
+    f.seek(offset)
+    if f.read(2) != b'\xff\xd8':
+        return None
+    pos = offset + 2
+    end = offset + length
+    while pos + 4 <= end:
+        f.seek(pos)
+        segment = f.read(4)
+        if len(segment) < 4 or segment[0] != 0xff:
+            return None
+        marker = segment[1]
+        if marker == 0xff:  # Padding
+            pos += 1
+            continue
+        if marker in JPEG_DISPLAYABLE_SOF_MARKERS:
+            height, width = struct.unpack('>HH', f.read(5)[1:])
+            return (width, height)
+        if marker in JPEG_OTHER_SOF_MARKERS or marker == 0xda:
+            return None
+        pos += 2 + struct.unpack('>H', segment[2:])[0]
+    return None
+
+
+def __tiff_values(f, endian, base, entry):
+    value_type, count, value = entry
+    value_format = TIFF_VALUE_FORMATS.get(value_type)
+    if not value_format or count > 4096:
+        return []
+    size = struct.calcsize(value_format) * count
+    if size <= 4:
+        data = value[:size]
+    else:
+        f.seek(base + struct.unpack(endian + 'I', value)[0])
+        data = f.read(size)
+        if len(data) < size:
+            return []
+    return list(struct.unpack(endian + value_format * count, data))
+
+
+def __read_ifd(f, endian, base, offset):
+    f.seek(base + offset)
+    data = f.read(2)
+    if len(data) < 2:
+        return {}, 0
+    count = struct.unpack(endian + 'H', data)[0]
+    data = f.read(count * 12 + 4)
+    if len(data) < count * 12 + 4:
+        return {}, 0
+    entries = {}
+    for i in range(count):
+        tag, value_type, value_count, value = struct.unpack(endian + 'HHI4s', data[i * 12:(i + 1) * 12])
+        entries[tag] = (value_type, value_count, value)
+    return entries, struct.unpack(endian + 'I', data[-4:])[0]
+
+
+def __read_tiff(f, base=0):
+    '''
+    Returns a list of IFDs (as dicts of tag to raw entry) reachable from the TIFF header at `base`, following both the
+    IFD chain and any SubIFDs. Returns None if there isn't a TIFF header there.
+    '''
+    f.seek(base)
+    header = f.read(8)
+    if header[:4] == b'II*\x00':
+        endian = '<'
+    elif header[:4] == b'MM\x00*':
+        endian = '>'
+    else:
+        return None, None
+
+    ifds = []
+    pending = [struct.unpack(endian + 'I', header[4:])[0]]
+    seen = set()
+    while pending and len(ifds) < MAX_IFDS:
+        offset = pending.pop(0)
+        if not offset or offset in seen:
+            continue
+        seen.add(offset)
+        entries, next_offset = __read_ifd(f, endian, base, offset)
+        if not entries:
+            continue
+        ifds.append(entries)
+        pending.append(next_offset)
+        if TIFF_TAG_SUB_IFDS in entries:
+            pending.extend(__tiff_values(f, endian, base, entries[TIFF_TAG_SUB_IFDS]))
+    return ifds, endian
+
+
+def __tiff_orientation(f, ifds, endian, base=0):
+    if ifds and TIFF_TAG_ORIENTATION in ifds[0]:
+        values = __tiff_values(f, endian, base, ifds[0][TIFF_TAG_ORIENTATION])
+        if values:
+            return values[0]
+    return None
+
+
+def __find_tiff_jpegs(f):
+    ifds, endian = __read_tiff(f)
+    if ifds is None:
+        return None, None
+
+    ranges = []
+    for entries in ifds:
+        if TIFF_TAG_JPEG_OFFSET in entries and TIFF_TAG_JPEG_LENGTH in entries:
+            offset_tag, length_tag = TIFF_TAG_JPEG_OFFSET, TIFF_TAG_JPEG_LENGTH
+        elif TIFF_TAG_STRIP_OFFSETS in entries and TIFF_TAG_STRIP_BYTE_COUNTS in entries and \
+                TIFF_TAG_COMPRESSION in entries and \
+                __tiff_values(f, endian, 0, entries[TIFF_TAG_COMPRESSION])[:1] in [[c] for c in TIFF_JPEG_COMPRESSIONS]:
+            offset_tag, length_tag = TIFF_TAG_STRIP_OFFSETS, TIFF_TAG_STRIP_BYTE_COUNTS
+        else:
+            continue
+        offsets = __tiff_values(f, endian, 0, entries[offset_tag])
+        lengths = __tiff_values(f, endian, 0, entries[length_tag])
+        # Multi-strip images aren't a single JPEG stream
+        if len(offsets) == 1 and len(lengths) == 1:
+            ranges.append((offsets[0], lengths[0]))
+
+    return ranges, __tiff_orientation(f, ifds, endian)
+
+
+def __iter_bmff_boxes(f, start, end):
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size:
+            return
+        yield box_type, pos + header_size, pos + size
+        pos += size
+
+
+def __find_cr3_jpegs(f, start, end, state):
+    for box_type, box_start, box_end in __iter_bmff_boxes(f, start, end):
+        if box_type in BMFF_CONTAINER_BOXES:
+            if box_type == b'trak':
+                state['track'] = {}
+            __find_cr3_jpegs(f, box_start, box_end, state)
+            track = state.get('track', {})
+            if box_type == b'trak' and track.get('offset') and track.get('length'):
+                state['ranges'].append((track['offset'], track['length']))
+        elif box_type == b'uuid':
+            f.seek(box_start)
+            if f.read(16) == CANON_CR3_UUID:
+                __find_cr3_jpegs(f, box_start + 16, box_end, state)
+        elif box_type == b'CMT1':
+            # IFD0 of the camera's EXIF data is stored as a self-contained TIFF
+            ifds, endian = __read_tiff(f, box_start)
+            if ifds:
+                state['orientation'] = __tiff_orientation(f, ifds, endian, box_start)
+        elif box_type == b'stsz' and 'track' in state:
+            f.seek(box_start + 4)
+            sample_size, sample_count = struct.unpack('>II', f.read(8))
+            if not sample_size and sample_count:
+                sample_size = struct.unpack('>I', f.read(4))[0]
+            state['track']['length'] = sample_size
+        elif box_type in [b'co64', b'stco'] and 'track' in state:
+            f.seek(box_start + 4)
+            if struct.unpack('>I', f.read(4))[0]:
+                if box_type == b'co64':
+                    state['track']['offset'] = struct.unpack('>Q', f.read(8))[0]
+                else:
+                    state['track']['offset'] = struct.unpack('>I', f.read(4))[0]
+
+
+def find_embedded_jpegs(path):
+    '''
+    Parses the container of a raw file (TIFF-based formats such as CR2, NEF, ARW and DNG, or Canon's ISO BMFF based
+    CR3) to find the byte ranges of any displayable JPEGs stored inside it, without decoding any image data.
+    Returns a tuple of ([EmbeddedJpeg, ...], orientation) or (None, None) if the container isn't one we understand.
+    '''
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if header[4:12] == b'ftypcrx ':
+            f.seek(0, 2)
+            state = {'ranges': [], 'orientation': None}
+            __find_cr3_jpegs(f, 0, f.tell(), state)
+            ranges, orientation = state['ranges'], state['orientation']
+        else:
+            ranges, orientation = __find_tiff_jpegs(f)
+            if ranges is None:
+                return None, None
+
+        jpegs = []
+        for offset, length in ranges:
+            dimensions = __jpeg_dimensions(f, offset, length)
+            if dimensions:
+                jpegs.append(EmbeddedJpeg(offset, length, *dimensions))
+        return jpegs, orientation
+
+
+def jpeg_exif_header(orientation):
+    '''
+    APP1 segment carrying the raw file's orientation, for inserting after the SOI marker of an embedded JPEG that
+    doesn't have EXIF data of its own (same as `dcraw -e` does). Embedded JPEGs are never rotated themselves.
+    '''
+    exif = Image.Exif()
+    exif[TIFF_TAG_ORIENTATION] = orientation
+    payload = exif.tobytes()
+    return b'\xff\xe1' + struct.pack('>H', len(payload) + 2) + payload
+
+
+def read_embedded_jpeg(path, jpeg, orientation=None):
+    with open(path, 'rb') as f:
+        f.seek(jpeg.offset)
+        data = f.read(jpeg.length)
+    if orientation and data[6:10] != b'Exif':
+        data = data[:2] + jpeg_exif_header(orientation) + data[2:]
+    return data
+
+
+def copy_embedded_jpeg(path, jpeg, f, orientation=None):
+    '''
+    Writes an embedded JPEG to the file object f. The byte range is copied by the kernel with os.sendfile where
+    possible (falling back to slicing an mmap of the raw file) so the preview never passes through Python memory.
+    '''
+    with open(path, 'rb') as source:
+        source.seek(jpeg.offset)
+        header = source.read(10)
+        f.write(header[:2])
+        if orientation and header[6:10] != b'Exif':
+            f.write(jpeg_exif_header(orientation))
+        f.flush()
+
+        offset = jpeg.offset + 2
+        remaining = jpeg.length - 2
+        try:
+            while remaining > 0:
+                sent = os.sendfile(f.fileno(), source.fileno(), offset, remaining)
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+        except (AttributeError, OSError):
+            # Platforms where sendfile() can't write to regular files
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                f.write(m[offset:offset + remaining])
+                remaining = 0
+        if remaining:
+            raise OSError(f'Raw file truncated, {remaining} bytes of embedded JPEG missing')
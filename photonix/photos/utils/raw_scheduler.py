@@ -0,0 +1,73 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from redis_lock import Lock
+
+from photonix.photos.utils import redis
+from photonix.web.utils import logger
+
+
+# dcraw holds the raw data (2 bytes) and a 4 channel 16-bit image (8 bytes) per pixel, then we hold its 8-bit PPM
+# output (3 bytes) and Pillow's decoded copy (4 bytes) while encoding the JPEG
+RAW_DEVELOPMENT_BYTES_PER_PIXEL = 18
+# Used when the raw file doesn't tell us its dimensions
+RAW_DEVELOPMENT_DEFAULT_PIXELS = 50 * 1000 * 1000
+RAW_DEVELOPMENT_JOBS_KEY = 'raw_development_jobs'
+# Admissions left behind by a worker that was killed mid-development are dropped after this long
+RAW_DEVELOPMENT_JOB_EXPIRE = 60 * 10
+RAW_DEVELOPMENT_POLL_INTERVAL = 1
+
+
+class RawDevelopmentDeferred(Exception):
+    '''Raised when there isn't enough of the memory budget free to start a full raw development.'''
+
+
+def estimate_development_memory_mb(width=None, height=None):
+    pixels = width * height if width and height else RAW_DEVELOPMENT_DEFAULT_PIXELS
+    return int(pixels * RAW_DEVELOPMENT_BYTES_PER_PIXEL / (1024 * 1024)) + 1
+
+
+def __try_admit(job_id, memory_mb):
+    connection = redis.redis_connection
+    with Lock(connection, 'raw_development_scheduler', expire=10):
+        now = time.time()
+        used_mb = 0
+        num_running = 0
+        for other_job_id, value in connection.hgetall(RAW_DEVELOPMENT_JOBS_KEY).items():
+            other_memory_mb, expires = value.decode('utf-8').split(':')
+            if float(expires) < now:
+                connection.hdel(RAW_DEVELOPMENT_JOBS_KEY, other_job_id)
+                continue
+            used_mb += int(other_memory_mb)
+            num_running += 1
+
+        # A job bigger than the whole budget is still allowed to run on its own, otherwise it never would
+        if num_running >= settings.RAW_DEVELOPMENT_MAX_PROCESSES or \
+                (num_running and used_mb + memory_mb > settings.RAW_DEVELOPMENT_MEMORY_BUDGET_MB):
+            return False
+        connection.hset(RAW_DEVELOPMENT_JOBS_KEY, job_id, f'{memory_mb}:{now + RAW_DEVELOPMENT_JOB_EXPIRE}')
+        return True
+
+
+@contextmanager
+def raw_development_slot(width=None, height=None, timeout=10):
+    '''
+    Waits up to timeout seconds for a full raw development of an image this size to fit within
+    RAW_DEVELOPMENT_MEMORY_BUDGET_MB and RAW_DEVELOPMENT_MAX_PROCESSES, counted across all worker processes. Raises
+    RawDevelopmentDeferred if it doesn't so the caller can free up its worker and try again later.
+    '''
+    memory_mb = estimate_development_memory_mb(width, height)
+    job_id = str(uuid.uuid4())
+    deadline = time.time() + timeout
+    while not __try_admit(job_id, memory_mb):
+        if time.time() >= deadline:
+            raise RawDevelopmentDeferred(f'No room in raw development memory budget for {memory_mb}MB')
+        time.sleep(RAW_DEVELOPMENT_POLL_INTERVAL)
+
+    logger.debug(f'Admitted raw development needing an estimated {memory_mb}MB')
+    try:
+        yield memory_mb
+    finally:
+        redis.redis_connection.hdel(RAW_DEVELOPMENT_JOBS_KEY, job_id)
@@ -1,11 +1,89 @@
+import re
+import shutil
+import threading
+from collections import namedtuple
 from subprocess import PIPE, Popen
 
 
+Tool = namedtuple('Tool', ['path', 'version'])
+
+
+def __command_output(args):
+    try:
+        return Popen(args, stdout=PIPE, stdin=PIPE, stderr=PIPE).communicate()[0].decode('utf-8', 'ignore')
+    except OSError:
+        return ''
+
+
+def __dpkg_version(package):
+    for line in __command_output(['dpkg', '-s', package]).split('\n'):
+        if 'Version: ' in line:
+            try:
+                return re.search(r'([0-9]+.[0-9]+.[0-9]+)', line).group(1)
+            except AttributeError:
+                return
+
+
+def __dcraw_version(path):
+    for line in __command_output([path]).split('\n'):
+        if 'Raw photo decoder "dcraw"' in line:
+            try:
+                return re.search(r'v([0-9]+.[0-9]+)', line).group(1)
+            except AttributeError:
+                return
+
+
+TOOL_VERSION_PROBES = {
+    'dcraw': __dcraw_version,
+    'exiftool': lambda path: __dpkg_version('libimage-exiftool-perl'),
+    'heif-convert': lambda path: __dpkg_version('libheif-examples'),
+}
+
+
+class ToolRegistry(object):
+    '''
+    Process-wide record of where external tools live and which versions they are. Looking up binaries and versions
+    means running subprocesses so it is done once per process (at worker startup, or on first use) rather than for
+    every photo. Call refresh() to pick up tools that have been installed or upgraded since.
+    '''
+
+    def __init__(self, version_probes):
+        self.version_probes = version_probes
+        self.tools = None
+        self.lock = threading.Lock()
+
+    def __resolve(self, name):
+        path = shutil.which(name)
+        version = None
+        if path and name in self.version_probes:
+            version = self.version_probes[name](path)
+        return Tool(path, version)
+
+    def refresh(self):
+        tools = {name: self.__resolve(name) for name in self.version_probes}
+        with self.lock:
+            self.tools = tools
+        return tools
+
+    def get(self, name):
+        if self.tools is None:
+            self.refresh()
+        tool = self.tools.get(name)
+        if tool is None:
+            tool = self.__resolve(name)
+            with self.lock:
+                self.tools[name] = tool
+        return tool
+
+    def path(self, name):
+        return self.get(name).path
+
+    def version(self, name):
+        return self.get(name).version
+
+
+tools = ToolRegistry(TOOL_VERSION_PROBES)
+
+
 def missing_system_dependencies(commands):
-    missing = []
-    for dependency in commands:
-        result = Popen(['which', dependency], stdout=PIPE,
-                       stdin=PIPE, stderr=PIPE).communicate()[0]
-        if not result:
-            missing.append(dependency)
-    return missing
+    return [dependency for dependency in commands if not tools.path(dependency)]
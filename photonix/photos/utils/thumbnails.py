@@ -1,21 +1,33 @@
 
+import hashlib
 import io
 import math
 import os
+import re
+import tempfile
+import time
 from pathlib import Path
 
 import numpy as np
 from django.conf import settings
-from PIL import Image, ImageFile, ImageOps
+from PIL import Image, ImageOps
+from redis_lock import Lock
 
 from photonix.photos.models import Photo, PhotoFile
-from photonix.photos.utils.metadata import PhotoMetadata
+from photonix.photos.utils import redis
+from photonix.photos.utils.image import DecodedImage
 from photonix.web.utils import logger
 
 THUMBNAILER_VERSION = 20210321
+# Seconds before a thumbnail lock held by a crashed worker is released. Renewed automatically while rendering.
+THUMBNAIL_LOCK_EXPIRE = 60
+THUMBNAIL_SIZE_DIR_REGEX = re.compile(r'^([0-9]+)x([0-9]+)_(cover|contain)_q([0-9]+)$')
+# File in THUMBNAIL_ROOT recording which layout ('sharded' or 'flat') migrate_thumbnail_layout() last left it in
+THUMBNAIL_LAYOUT_FILE = '.layout'
 
 
-def generate_thumbnails_for_photo(photo):
+def generate_thumbnails_for_photo(photo, image=None):
+    # image is an optional DecodedImage of the photo's base file, shared with the classifiers that run afterwards
     if not isinstance(photo, Photo):
         try:
             photo = Photo.objects.get(id=photo)
@@ -23,11 +35,16 @@ def generate_thumbnails_for_photo(photo):
             logger.error(f'Photo instance does not exist with id={photo}')
             return
 
+    # Hashing reads the whole file so it's only done here in the background, web requests use the PhotoFile ID key
+    # until it has been set
+    if settings.THUMBNAIL_CONTENT_ADDRESSED and photo.base_file:
+        get_content_hash(photo.base_file)
+
     for thumbnail in settings.THUMBNAIL_SIZES:
         if thumbnail[4]:  # Required from the start
             try:
                 get_thumbnail(photo=photo, width=thumbnail[0], height=thumbnail[1], crop=thumbnail[2],
-                              quality=thumbnail[3], force_regenerate=True, force_accurate=thumbnail[5])
+                              quality=thumbnail[3], force_accurate=thumbnail[5], image=image)
             except (FileNotFoundError, IndexError):
                 logger.error(f'Failed to generate thumbnail for photo {photo.id}')
                 return
@@ -37,18 +54,82 @@ def generate_thumbnails_for_photo(photo):
         photo.save()
 
 
-def get_thumbnail_path(photo_file_id, width=256, height=256, crop='cover', quality=75):
-    directory = Path(
-        f'{settings.THUMBNAIL_ROOT}/photofile/{width}x{height}_{crop}_q{quality}')
-    directory.mkdir(parents=True, exist_ok=True)
-    return directory / f'{photo_file_id}.jpg'
+def get_content_hash(photo_file):
+    '''
+    SHA-256 of the image that thumbnails get rendered from. Stored on the PhotoFile so identical files (copies in
+    several folders, re-imports under a new ID) resolve to the same thumbnails.
+    '''
+    if photo_file.content_hash:
+        return photo_file.content_hash
+
+    sha256 = hashlib.sha256()
+    try:
+        with open(photo_file.base_image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+    except FileNotFoundError:
+        return None
+
+    photo_file.content_hash = sha256.hexdigest()
+    # Update just this column so we don't race with other fields being saved on the same PhotoFile
+    PhotoFile.objects.filter(id=photo_file.id).update(content_hash=photo_file.content_hash)
+    return photo_file.content_hash
+
 
+def get_thumbnail_key(photo_file):
+    '''
+    Returns the (key type, key) that a PhotoFile's thumbnails are stored under. This is the content hash if
+    settings.THUMBNAIL_CONTENT_ADDRESSED is enabled and generate_thumbnails_for_photo() has stored it, otherwise the
+    PhotoFile's ID. The hash is never calculated here as this gets called while handling web requests.
+    '''
+    if settings.THUMBNAIL_CONTENT_ADDRESSED and photo_file.content_hash:
+        return ('content', photo_file.content_hash)
+    return ('photofile', str(photo_file.id))
+
+
+def get_thumbnail_relative_path(key, width=256, height=256, crop='cover', quality=75, key_type='photofile',
+                                sharded=None):
+    '''
+    Path of a thumbnail within THUMBNAIL_ROOT. With sharding on, files are spread over two levels of directories
+    named after the first four hex characters of the key (e.g. photofile/256x256_cover_q50/3b/fc/3bfc122c-....jpg)
+    which keeps each directory down to a few thousand entries even for very large libraries. Keys are random UUIDs
+    or SHA-256 hashes so they are already evenly distributed.
+    '''
+    if sharded is None:
+        sharded = settings.THUMBNAIL_SHARDED
+    key = str(key)
+    relative_path = f'{key_type}/{width}x{height}_{crop}_q{quality}/'
+    if sharded:
+        relative_path += f'{key[0:2]}/{key[2:4]}/'
+    return f'{relative_path}{key}.jpg'
 
-def get_thumbnail_url(photo_file_id, width=256, height=256, crop='cover', quality=75):
-    return f'{settings.THUMBNAIL_URL}photofile/{width}x{height}_{crop}_q{quality}/{photo_file_id}.jpg'
 
+def get_thumbnail_path(key, width=256, height=256, crop='cover', quality=75, key_type='photofile', sharded=None):
+    # The directory isn't created here, write_file_atomically() does that only if it turns out to be missing
+    return Path(settings.THUMBNAIL_ROOT) / get_thumbnail_relative_path(
+        key, width, height, crop, quality, key_type, sharded)
 
-def get_thumbnail(photo_file=None, photo=None, width=256, height=256, crop='cover', quality=75, return_type='path', force_regenerate=False, force_accurate=False):
+
+def get_thumbnail_url(key, width=256, height=256, crop='cover', quality=75, key_type='photofile'):
+    return f'{settings.THUMBNAIL_URL}{get_thumbnail_relative_path(key, width, height, crop, quality, key_type)}'
+
+
+def parse_thumbnail_path(path):
+    '''
+    Reverse of get_thumbnail_relative_path(), works for both flat and sharded layouts. Returns a tuple of
+    (key_type, key, width, height, crop, quality) or None if the path isn't a thumbnail.
+    '''
+    parts = Path(path).parts
+    for i, part in enumerate(parts[1:], 1):
+        matched = THUMBNAIL_SIZE_DIR_REGEX.match(part)
+        if matched:
+            width, height, crop, quality = matched.groups()
+            key = Path(parts[-1]).stem
+            return (parts[i - 1], key, int(width), int(height), crop, int(quality))
+    return None
+
+
+def get_thumbnail(photo_file=None, photo=None, width=256, height=256, crop='cover', quality=75, return_type='path', force_accurate=False, image=None):
     if not photo_file:
         if not isinstance(photo, Photo):
             photo = Photo.objects.get(id=photo)
@@ -56,33 +137,46 @@ def get_thumbnail(photo_file=None, photo=None, width=256, height=256, crop='cove
     elif not isinstance(photo_file, PhotoFile):
         photo_file = PhotoFile.objects.get(id=photo_file)
 
-    # If thumbnail image was previously generated and we weren't told to re-generate, return that one
-    output_path = get_thumbnail_path(
-        photo_file.id, width, height, crop, quality)
-    output_url = get_thumbnail_url(photo_file.id, width, height, crop, quality)
+    # If thumbnail image was previously generated, return that one
+    key_type, key = get_thumbnail_key(photo_file)
+    output_path = get_thumbnail_path(key, width, height, crop, quality, key_type)
+    output_url = get_thumbnail_url(key, width, height, crop, quality, key_type)
 
     if os.path.exists(output_path):
-        if return_type == 'bytes':
-            return open(output_path, 'rb').read()
-        elif return_type == 'url':
-            return output_url
-        else:
-            return output_path
+        return __existing_thumbnail(output_path, output_url, return_type)
 
-    # Read base image and metadata
-    input_path = photo_file.base_image_path
-    ImageFile.LOAD_TRUNCATED_IMAGES = True
-    im = Image.open(input_path)
+    # Web workers and Celery can all ask for the same thumbnail at once (e.g. a grid of newly imported photos). Only
+    # the holder of this lock renders it, everyone else waits and then reads the finished file.
+    lock_name = f'thumbnail_{key}_{width}x{height}_{crop}_q{quality}'
+    with Lock(redis.redis_connection, lock_name, expire=THUMBNAIL_LOCK_EXPIRE, auto_renewal=True):
+        if os.path.exists(output_path):
+            return __existing_thumbnail(output_path, output_url, return_type)
 
-    if im.mode != 'RGB':
-        im = im.convert('RGB')
+        return __generate_thumbnail(photo_file, output_path, output_url, width, height, crop, quality, return_type,
+                                    force_accurate, image)
 
-    metadata = PhotoMetadata(input_path)
 
-    # Perform rotations if decalared in metadata
-    if force_regenerate:
-        im = im.rotate(photo_file.rotation, expand=True)
-    elif metadata.get('Orientation') in ['Rotate 90 CW', 'Rotate 270 CCW']:
+def __existing_thumbnail(output_path, output_url, return_type):
+    if return_type == 'bytes':
+        with open(output_path, 'rb') as f:
+            return f.read()
+    elif return_type == 'url':
+        return output_url
+    return output_path
+
+
+def __generate_thumbnail(photo_file, output_path, output_url, width, height, crop, quality, return_type,
+                         force_accurate, image=None):
+    # Read base image and metadata, unless they have already been read for another size
+    input_path = photo_file.base_image_path
+    if image is None or image.path != str(input_path):
+        image = DecodedImage(input_path)
+    im = image.rgb
+    metadata = image.metadata
+
+    # Perform rotations if decalared in metadata. PhotoFile.rotation is never applied as it's not part of the content
+    # the thumbnail is keyed on, the UI rotates thumbnails when displaying them.
+    if metadata.get('Orientation') in ['Rotate 90 CW', 'Rotate 270 CCW']:
         im = im.rotate(-90, expand=True)
     elif metadata.get('Orientation') in ['Rotate 90 CCW', 'Rotate 270 CW']:
         im = im.rotate(90, expand=True)
@@ -94,16 +188,18 @@ def get_thumbnail(photo_file=None, photo=None, width=256, height=256, crop='cove
         if crop == 'cover':
             im = ImageOps.fit(im, (width, height), Image.BICUBIC)
         else:
+            # Resizes in place so mustn't touch the shared decoded image
+            if im is image.rgb:
+                im = im.copy()
             im.thumbnail((width, height), Image.BICUBIC)
 
     # Save to disk (keeping the bytes in memory if we need to return them)
     if return_type == 'bytes':
         img_byte_array = io.BytesIO()
         im.save(img_byte_array, format='JPEG', quality=quality)
-        with open(output_path, 'wb') as f:
-            f.write(img_byte_array.getvalue())
+        write_file_atomically(output_path, img_byte_array.getvalue())
     else:
-        im.save(output_path, format='JPEG', quality=quality)
+        write_file_atomically(output_path, lambda f: im.save(f, format='JPEG', quality=quality))
 
     # Update PhotoFile DB model with version of thumbnailer
     if photo_file.thumbnailed_version != THUMBNAILER_VERSION:
@@ -118,6 +214,161 @@ def get_thumbnail(photo_file=None, photo=None, width=256, height=256, crop='cove
     return output_path
 
 
+def remove_unreferenced_thumbnails(min_age_seconds=60 * 60):
+    '''
+    Deletes content-addressed thumbnails that no PhotoFile refers to any more. Thumbnails are left in place when files
+    are deleted so a move or re-import can pick them up again, this reclaims the space afterwards. PhotoFile ID keyed
+    thumbnails are deleted once their PhotoFile is gone, or has been hashed so its thumbnails are content-addressed.
+    Recently written files are skipped in case their PhotoFile is still being recorded.
+    '''
+    referenced_keys = {
+        'content': set(PhotoFile.objects.exclude(
+            content_hash=None).values_list('content_hash', flat=True).distinct()),
+    }
+    photo_files = PhotoFile.objects.all()
+    if settings.THUMBNAIL_CONTENT_ADDRESSED:
+        photo_files = photo_files.filter(content_hash=None)
+    referenced_keys['photofile'] = set(str(id) for id in photo_files.values_list('id', flat=True))
+    cutoff = time.time() - min_age_seconds
+    num_removed = 0
+
+    for key_type, keys in referenced_keys.items():
+        for directory, _, filenames in os.walk(Path(settings.THUMBNAIL_ROOT) / key_type):
+            for fn in filenames:
+                path = os.path.join(directory, fn)
+                key = fn.split('.', 1)[0]
+                try:
+                    if key in keys or os.stat(path).st_mtime > cutoff:
+                        continue
+                    os.remove(path)
+                    num_removed += 1
+                except FileNotFoundError:
+                    pass
+
+    return num_removed
+
+
+def hash_photo_files():
+    '''
+    Sets content_hash on PhotoFiles that don't have one yet, e.g. ones imported before THUMBNAIL_CONTENT_ADDRESSED was
+    enabled. Their existing thumbnails are moved over to the content-addressed layout rather than being rendered again,
+    or dropped if another file with the same content already has them. Returns the number of files hashed.
+    '''
+    if not settings.THUMBNAIL_CONTENT_ADDRESSED:
+        return 0
+
+    photofile_root = Path(settings.THUMBNAIL_ROOT) / 'photofile'
+    sizes = []
+    if photofile_root.is_dir():
+        for directory in os.listdir(photofile_root):
+            matched = THUMBNAIL_SIZE_DIR_REGEX.match(directory)
+            if matched:
+                width, height, crop, quality = matched.groups()
+                sizes.append((int(width), int(height), crop, int(quality)))
+
+    num_hashed = 0
+    for photo_file in PhotoFile.objects.filter(content_hash=None).iterator():
+        content_hash = get_content_hash(photo_file)
+        if not content_hash:  # File missing, e.g. raw file not processed yet
+            continue
+        num_hashed += 1
+        for width, height, crop, quality in sizes:
+            path = get_thumbnail_path(photo_file.id, width, height, crop, quality, 'photofile')
+            new_path = get_thumbnail_path(content_hash, width, height, crop, quality, 'content')
+            try:
+                if new_path.exists():
+                    os.remove(path)
+                else:
+                    new_path.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(path, new_path)
+            except FileNotFoundError:
+                pass
+
+    return num_hashed
+
+
+def get_thumbnail_layout():
+    # Layout recorded by the last migrate_thumbnail_layout(), None if it has never been run
+    try:
+        with open(Path(settings.THUMBNAIL_ROOT) / THUMBNAIL_LAYOUT_FILE) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def migrate_thumbnail_layout(sharded=None, dry_run=False):
+    '''
+    Moves existing thumbnails into the flat or sharded layout (settings.THUMBNAIL_SHARDED by default). Files already in
+    the right place are left alone so it is safe to run repeatedly. Returns the number of files moved.
+    '''
+    if sharded is None:
+        sharded = settings.THUMBNAIL_SHARDED
+    layout = 'sharded' if sharded else 'flat'
+    num_moved = 0
+
+    for key_type in ['photofile', 'content']:
+        key_type_root = Path(settings.THUMBNAIL_ROOT) / key_type
+        if not key_type_root.is_dir():
+            continue
+
+        for directory, _, filenames in os.walk(key_type_root, topdown=False):
+            for fn in filenames:
+                if fn.startswith('.'):  # Temporary file from write_file_atomically()
+                    continue
+                path = Path(directory) / fn
+                parsed = parse_thumbnail_path(path.relative_to(settings.THUMBNAIL_ROOT))
+                if not parsed:
+                    continue
+                _, key, width, height, crop, quality = parsed
+                new_path = get_thumbnail_path(key, width, height, crop, quality, key_type, sharded)
+                if new_path == path:
+                    continue
+                if not dry_run:
+                    new_path.parent.mkdir(parents=True, exist_ok=True)
+                    os.replace(path, new_path)
+                num_moved += 1
+
+            # Tidy up shard directories left empty after flattening
+            if not dry_run and not os.listdir(directory) and \
+                    not THUMBNAIL_SIZE_DIR_REGEX.match(os.path.basename(directory)) and Path(directory) != key_type_root:
+                os.rmdir(directory)
+
+    # Thumbnails only get written in the new layout from now on so there's no need to look through them again
+    if not dry_run:
+        write_file_atomically(Path(settings.THUMBNAIL_ROOT) / THUMBNAIL_LAYOUT_FILE, layout.encode())
+
+    return num_moved
+
+
+def write_file_atomically(path, data):
+    '''
+    Writes to a uniquely named file in the same directory and renames it into place so readers never see a partially
+    written file. data can be bytes or a function that writes to the file object it is given.
+    '''
+    directory = os.path.dirname(path)
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    except FileNotFoundError:
+        # Directories are only created when first needed rather than checked on every call
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        # mkstemp creates files only readable by the owner but the web server needs to be able to serve them
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
 def srgbResize(im, size, crop, resample):
     '''
     More accurate method of generating thumbnails as it is sRGB aware and has gamma correction
@@ -1,13 +1,16 @@
-from photonix.photos.models import PhotoFile
+import os
 from pathlib import Path
 
 from django.conf import settings
-from django.http import (HttpResponse, HttpResponseNotFound,
+from django.http import (FileResponse, HttpResponse, HttpResponseNotFound,
                          HttpResponseRedirect, JsonResponse)
 from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 
-from photonix.photos.models import Library
-from photonix.photos.utils.thumbnails import get_thumbnail
+from photonix.photos.models import Library, PhotoFile
+from photonix.photos.utils.thumbnails import (get_thumbnail,
+                                              parse_thumbnail_path)
 
 
 def thumbnailer(request, type, id, width, height, crop, quality):
@@ -33,9 +36,52 @@ def thumbnailer(request, type, id, width, height, crop, quality):
     elif type == 'photofile':
         photo_file_id = id
 
+    if settings.THUMBNAIL_RESPONSE_MODE == 'redirect':
+        path = get_thumbnail(photo_file=photo_file_id, photo=photo_id, width=width, height=height,
+                             crop=crop, quality=quality, return_type='url', force_accurate=force_accurate)
+        return HttpResponseRedirect(path)
+
     path = get_thumbnail(photo_file=photo_file_id, photo=photo_id, width=width, height=height,
-                         crop=crop, quality=quality, return_type='url', force_accurate=force_accurate)
-    return HttpResponseRedirect(path)
+                         crop=crop, quality=quality, return_type='path', force_accurate=force_accurate)
+    try:
+        return thumbnail_file_response(request, path, settings.THUMBNAIL_RESPONSE_MODE)
+    except FileNotFoundError:
+        # Removed since get_thumbnail() found it (e.g. by housekeeping or shard_thumbnails) so generate it again
+        path = get_thumbnail(photo_file=photo_file_id, photo=photo_id, width=width, height=height,
+                             crop=crop, quality=quality, return_type='url', force_accurate=force_accurate)
+        return HttpResponseRedirect(path)
+
+
+def thumbnail_file_response(request, path, mode='sendfile'):
+    '''
+    Returns the thumbnail at path without a redirect. Conditional requests are answered with a 304 if the file's ETag
+    or modification time hasn't changed. In 'x-accel-redirect' mode the body is left empty and Nginx sends the bytes,
+    also taking care of the ETag, Last-Modified and conditional requests from the file itself (and Cache-Control from
+    its internal location's expires) so none of that is done here. Raises FileNotFoundError if there is no file.
+    '''
+    if mode == 'x-accel-redirect':
+        # Checked here as a missing file would otherwise only become a 404 from Nginx
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        relative_path = Path(path).relative_to(settings.THUMBNAIL_ROOT).as_posix()
+        response = HttpResponse(content_type='image/jpeg')
+        response['X-Accel-Redirect'] = f'{settings.THUMBNAIL_ACCEL_REDIRECT_URL}{relative_path}'
+        return response
+
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        # FileResponse hands the open file to the WSGI server's file_wrapper so Gunicorn can use sendfile()
+        response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+        response['Content-Length'] = stat.st_size
+
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, max_age=settings.THUMBNAIL_CACHE_MAX_AGE)
+    return response
 
 
 def upload(request):
@@ -57,16 +103,19 @@ def dummy_thumbnail_response(request, path):
     # Only used during testing to return thumbnail images. Everywhere else, Nginx handles these requests.
     filepath = str(Path(settings.THUMBNAIL_ROOT) / path)
     try:
-        with open(filepath, 'rb') as f:
-            return HttpResponse(f.read(), content_type='image/jpeg')
+        return thumbnail_file_response(request, filepath)
     except FileNotFoundError:
-        # e.g. photofile/256x256_cover_q50/3bfc122c-cbb1-4f21-843a-db79f1d9229d.jpg
-        parts = path.split('/')
-        photo_file_id = parts[-1].split('.')[0]
-        width, height, crop, quality = parts[-2].split('_')
-        width, height = [int(x) for x in width.split('x')]
-        quality = int(quality[1:])
-        get_thumbnail(photo_file=photo_file_id, width=width,
+        # e.g. photofile/256x256_cover_q50/3b/fc/3bfc122c-cbb1-4f21-843a-db79f1d9229d.jpg or content/.../<sha256>.jpg
+        parsed = parse_thumbnail_path(path)
+        if not parsed:
+            return HttpResponseNotFound('Not a thumbnail path')
+        key_type, key, width, height, crop, quality = parsed
+        if key_type == 'content':
+            photo_file = PhotoFile.objects.filter(content_hash=key).first()
+        else:
+            photo_file = PhotoFile.objects.filter(id=key).first()
+        if not photo_file:
+            return HttpResponseNotFound('No photo file for this thumbnail')
+        get_thumbnail(photo_file=photo_file, width=width,
                       height=height, crop=crop, quality=quality, return_type='path')
-        with open(filepath, 'rb') as f:
-            return HttpResponse(f.read(), content_type='image/jpeg')
+        return thumbnail_file_response(request, filepath)
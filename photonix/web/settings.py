@@ -196,6 +196,19 @@ THUMBNAIL_SIZES = [
     (3840, 3840, 'contain', 75, False, False),  # 4k
 ]
 
+# How the thumbnailer view hands back the generated image:
+#   'redirect'         - 302 to THUMBNAIL_URL (extra round-trip but works without any web server configuration)
+#   'x-accel-redirect' - Nginx serves the file from the internal location declared in system/nginx_*.conf (set by
+#                        default in the production Docker image)
+#   'sendfile'         - Django streams the file itself, letting the WSGI server use zero-copy sendfile
+THUMBNAIL_RESPONSE_MODE = os.environ.get('THUMBNAIL_RESPONSE_MODE', 'redirect')
+# Store thumbnails by a hash of the image content instead of PhotoFile ID so duplicate files share them
+THUMBNAIL_CONTENT_ADDRESSED = os.environ.get('THUMBNAIL_CONTENT_ADDRESSED', '') in ['1', 'true', 'True']
+# Spread thumbnails over two levels of sub-directories. Run the shard_thumbnails command after changing this.
+THUMBNAIL_SHARDED = os.environ.get('THUMBNAIL_SHARDED', '1') in ['1', 'true', 'True']
+THUMBNAIL_ACCEL_REDIRECT_URL = '/thumbnails-internal/'
+THUMBNAIL_CACHE_MAX_AGE = 60 * 60 * 24
+
 
 PHOTO_INPUT_DIRS = [str(Path(BASE_DIR).parent.parent / 'photos_to_import')]
 PHOTO_OUTPUT_DIRS = [
@@ -209,6 +222,23 @@ PHOTO_OUTPUT_DIRS = [
     },
 ]
 PHOTO_RAW_PROCESSED_DIR = '/data/raw-photos-processed'
+# Full raw developments with dcraw need roughly RAW_DEVELOPMENT_BYTES_PER_PIXEL of memory each. Across all workers
+# they are only started while the total estimate fits in this budget and there are fewer than the maximum running.
+RAW_DEVELOPMENT_MEMORY_BUDGET_MB = int(os.environ.get('RAW_DEVELOPMENT_MEMORY_BUDGET_MB', '1536'))
+RAW_DEVELOPMENT_MAX_PROCESSES = int(os.environ.get('RAW_DEVELOPMENT_MAX_PROCESSES', '2'))
+
+# Classifiers that support it (object and style) run this many photos through one inference, waiting at most
+# CLASSIFIER_BATCH_MAX_WAIT seconds for a batch to fill up. 1 classifies each photo on its own as soon as it arrives.
+# The trade-off is that batched classifiers read each photo again rather than sharing the image already decoded for
+# thumbnailing and the other classifiers. Only a downscaled copy is decoded but it still adds roughly 0.1-0.2s of CPU
+# per large JPEG (object also re-reads the metadata for orientation), against running the model once per batch.
+# Set this to 1 where decoding dominates, e.g. on slow CPUs with few photos arriving at once.
+CLASSIFIER_BATCH_SIZE = int(os.environ.get('CLASSIFIER_BATCH_SIZE', '8'))
+CLASSIFIER_BATCH_MAX_WAIT = int(os.environ.get('CLASSIFIER_BATCH_MAX_WAIT', '5'))
+
+# Classifier models (e.g. "location,object,style,face") each worker process loads when it starts rather than when the
+# first photo needs them. Models not listed are still only loaded once per process, on first use.
+CLASSIFIER_PRELOAD_MODELS = [name for name in os.environ.get('CLASSIFIER_PRELOAD_MODELS', '').split(',') if name]
 
 MODEL_INFO_URL = 'https://photonix.org/models.json'
 
@@ -25,6 +25,9 @@ fi
 >&2 echo "Resetting Redis lock"
 python /srv/photonix/manage.py reset_redis_locks
 
+>&2 echo "Moving thumbnails into the configured directory layout"
+python /srv/photonix/manage.py shard_thumbnails
+
 >&2 echo "Rescheduling any required upgrade-related tasks"
 python /srv/photonix/manage.py housekeeping
 
@@ -1,6 +1,6 @@
 import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
 from unittest import mock
 
@@ -44,6 +44,26 @@ def test_color_predict():
     assert expected == actual
 
 
+def test_color_predict_batch():
+    from colorsys import rgb_to_hsv
+
+    import numpy as np
+
+    from photonix.classifiers.color.model import ColorModel, rgb_to_hsv_array
+
+    # Vectorised conversion gives exactly the same values as colorsys, including greys and primaries
+    pixels = np.array([[0, 0, 0], [124, 124, 124], [255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 0, 255], [120, 4, 20], [17, 200, 99]])
+    assert rgb_to_hsv_array(pixels).tolist() == [list(rgb_to_hsv(*(c / 255 for c in pixel))) for pixel in pixels.tolist()]
+
+    model = ColorModel()
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    tree = str(Path(__file__).parent / 'photos' / 'tree.jpg')
+    results = model.predict_batch([snow, tree])
+    assert results == [model.predict(snow), model.predict(tree)]
+    assert results[0][0][0] == 'Red'
+    assert results[1] != results[0]
+
+
 @mock.patch('photonix.classifiers.color.model.ColorModel.predict')
 def test_color_predict_mock(mock_predict):
     from photonix.classifiers.color.model import ColorModel
@@ -96,6 +116,120 @@ def test_location_predict():
     assert result['city']['name'] == 'Téteghem'
 
 
+def test_country_index():
+    from photonix.classifiers.location.spatial import CountryIndex
+
+    square = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+    island = [[20, 20], [22, 20], [22, 22], [20, 20]]
+    overlapping = [[5, 5], [30, 5], [30, 30], [5, 30], [5, 5]]
+    index = CountryIndex([square, island, overlapping], [('A', 'AA'), ('A', 'AA'), ('B', 'BB')], cell_size=4)
+
+    # Where polygons overlap the earlier one in the shapefile wins
+    points = [(1, 1), (7, 7), (21.5, 20.5), (25, 25), (-1, -1), (11, 2)]
+    expected = [('A', 'AA'), ('A', 'AA'), ('A', 'AA'), ('B', 'BB'), None, None]
+    assert index.lookup_many(points) == expected
+    assert [index.lookup(x, y) for x, y in points] == expected
+
+
+def test_city_index():
+    from photonix.classifiers.location.model import CITY_RADIUS, EARTH_RADIUS, LocationModel
+    from photonix.classifiers.location.spatial import CityIndex
+
+    def row(name, lat, lon, country_code, population):
+        row = [''] * 19
+        row[1], row[4], row[5], row[8], row[14] = name, str(lat), str(lon), country_code, str(population)
+        return row
+
+    rows = [
+        row('London', 51.50853, -0.12574, 'GB', 7556900),
+        row('Camden Town', 51.54057, -0.14334, 'GB', 0),
+        row('Croydon', 51.38333, -0.1, 'GB', 192064),
+        row('Paris', 48.85341, 2.3488, 'FR', 2138551),
+    ]
+    cities = CityIndex.from_rows(rows)
+    assert cities.within([51.5304213, -0.1286445], CITY_RADIUS, EARTH_RADIUS) == [0, 1]
+    assert cities.within_many([[48.85, 2.35], [0, 0]], CITY_RADIUS, EARTH_RADIUS) == [[3], []]
+
+    with mock.patch.object(LocationModel, '__init__', return_value=None):
+        model = LocationModel()
+    model.cities = cities
+    model.country_names = {'GB': 'United Kingdom', 'FR': 'France'}
+
+    # Most populous city within the radius, with the distance to the nearest one
+    city = model.get_city(51.5304213, -0.1286445)
+    assert (city['name'], city['population'], city['country_name']) == ('London', 7556900, 'United Kingdom')
+    assert city['distance'] == int(model.haversine([51.5304213, -0.1286445], [51.54057, -0.14334]))
+    assert model.get_city(51.5304213, -0.1286445, country_code='FR') is None
+    assert model.get_cities([(51.5304213, -0.1286445), (48.85, 2.35)], ['GB', None]) == \
+        [city, model.get_city(48.85, 2.35)]
+
+
+def test_location_data_cache(tmpdir):
+    import shapefile
+
+    from photonix.classifiers.base_model import graph_cache
+    from photonix.classifiers.location.model import LocationModel
+
+    # Tiny stand-ins for the world borders shapefile and GeoNames cities
+    location_dir = Path(tmpdir) / 'location'
+    location_dir.mkdir()
+    with open(location_dir / 'version.txt', 'w') as f:
+        f.write(f'{LocationModel.version}\n')
+    with shapefile.Writer(str(location_dir / 'TM_WORLD_BORDERS-0.3.shp'), shapeType=shapefile.POLYGON) as writer:
+        for field in ['FIPS', 'ISO2', 'ISO3', 'UN', 'NAME']:
+            writer.field(field, 'C')
+        writer.poly([[[-8, 50], [2, 50], [2, 59], [-8, 59], [-8, 50]]])
+        writer.record('UK', 'GB', 'GBR', '826', 'United Kingdom')
+    with open(location_dir / 'cities1000.txt', 'w') as f:
+        f.write('\t'.join(['1', 'London', '', '', '51.50853', '-0.12574', '', '', 'GB', '', '', '', '', '', '7556900'] + [''] * 4) + '\n')
+        f.write('\t'.join(['2', 'Ōita', '', '', '33.23333', '131.6', '', '', 'JP', '', '', '', '', '', '0'] + [''] * 4) + '\n')
+
+    model = LocationModel(model_dir=str(tmpdir))
+    result = model.predict(location=[51.5304213, -0.1286445])
+    assert result['country'] == {'name': 'United Kingdom', 'code': 'GB'}
+    assert (result['city']['name'], result['city']['population']) == ('London', 7556900)
+    assert model.cities.names[1] == 'Ōita'
+    assert (location_dir / f'data-{LocationModel.version}-1' / 'city_latitudes.npy').exists()
+
+    # Other instances in the process reuse the loaded data
+    with mock.patch('photonix.classifiers.location.model.CityIndex.load') as mock_city_index_load:
+        assert LocationModel(model_dir=str(tmpdir)).cities is model.cities
+        mock_city_index_load.assert_not_called()
+
+    # A new process loads the preprocessed data without parsing the originals
+    del graph_cache[model.graph_cache_key]
+    with mock.patch.object(LocationModel, 'load_world') as mock_load_world, \
+            mock.patch.object(LocationModel, 'load_cities') as mock_load_cities:
+        assert LocationModel(model_dir=str(tmpdir)).predict(location=[51.5304213, -0.1286445]) == result
+        mock_load_world.assert_not_called()
+        mock_load_cities.assert_not_called()
+
+
+def test_geocode_cache():
+    from photonix.classifiers.location.model import LocationModel
+
+    with mock.patch.object(LocationModel, '__init__', return_value=None):
+        model = LocationModel()
+    city = {'name': 'London', 'distance': 1405, 'population': 7556900, 'country_code': 'GB', 'country_name': 'United Kingdom'}
+    model.get_countries = mock.Mock(side_effect=lambda locations: [{'name': 'United Kingdom', 'code': 'GB'}] * len(locations))
+    model.get_cities = mock.Mock(side_effect=lambda locations, country_codes: [city] * len(locations))
+
+    result = model.predict(location=[51.5304213, -0.1286445])
+    assert result['city'] == city
+    assert model.get_countries.call_count == 1
+
+    # A photo taken a few metres away is answered from the cache, one further away isn't
+    assert model.predict(location=[51.5304500, -0.1286000]) == result
+    assert model.get_countries.call_count == 1
+    assert model.predict_locations([(51.5304213, -0.1286445), (51.6, -0.2)]) == [result, result]
+    assert model.get_countries.call_args == mock.call([(51.6, -0.2)])
+
+    # A new version of the model doesn't use results cached by the old one
+    model.version = LocationModel.version + 1
+    model.predict(location=[51.5304213, -0.1286445])
+    assert model.get_countries.call_count == 3
+
+
 @mock.patch('photonix.classifiers.object.model.ObjectModel.predict')
 def test_object_predict(mock_predict):
     from photonix.classifiers.object.model import ObjectModel
@@ -125,6 +259,62 @@ def test_object_predict(mock_predict):
     assert '{0:.3f}'.format(result[2]['significance']) == '0.025'
 
 
+def test_batch_skips_unreadable_images(tmpdir):
+    import numpy as np
+    from PIL import Image as PILImage
+
+    from photonix.classifiers.object.model import ObjectModel
+    from photonix.classifiers.style.model import StyleModel
+    from photonix.photos.utils.image import DecodedImage
+
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    tree = str(Path(__file__).parent / 'photos' / 'tree.jpg')
+    corrupt = str(tmpdir / 'corrupt.jpg')
+    with open(corrupt, 'wb') as f:
+        f.write(b'not an image')
+    bomb = str(tmpdir / 'bomb.jpg')
+    with open(bomb, 'wb') as f:
+        f.write(open(snow, 'rb').read())
+    images = [snow, corrupt, bomb, tree]
+
+    reduced = DecodedImage.reduced
+
+    def reduced_or_bomb(self, *args, **kwargs):
+        if self.path == bomb:
+            raise PILImage.DecompressionBombError('Image size exceeds limit')
+        return reduced(self, *args, **kwargs)
+
+    object_model = ObjectModel.__new__(ObjectModel)
+    object_model.labels = {1: {'name': 'Tree'}}
+    stacked = []
+
+    def run_inference_for_batch(arrays):
+        stacked.append(arrays)
+        return [{'detection_scores': [0.9], 'detection_boxes': [[0.1, 0.2, 0.5, 0.6]], 'detection_classes': [1]}] * len(arrays)
+
+    style_model = StyleModel.__new__(StyleModel)
+    style_model.labels = ['serene', 'bright']
+    session = mock.Mock()
+    session.run.side_effect = lambda output, feed: np.tile([0.9, 0.1], (len(next(iter(feed.values()))), 1))
+
+    with mock.patch.object(DecodedImage, 'reduced', reduced_or_bomb), \
+            mock.patch.object(object_model, 'run_inference_for_batch', side_effect=run_inference_for_batch), \
+            mock.patch.object(style_model, 'get_session', return_value=(session, ('input', 'output'))):
+        object_results = object_model.predict_batch(images)
+        style_results = style_model.predict_batch(images)
+
+    # Only the unreadable images are skipped, the rest of the batch still gets results
+    assert [results is None for results in object_results] == [False, True, True, False]
+    assert object_results[0][0]['label'] == 'Tree'
+    assert [results is None for results in style_results] == [False, True, True, False]
+    assert style_results[3][0][0] == 'serene'
+    # Images are reduced to the detector's input size so one batch of photos of any size stays small
+    assert len(stacked) == 1 and stacked[0].shape == (2, 300, 300, 3) and stacked[0].dtype == np.uint8
+    decoded = DecodedImage(snow)
+    assert decoded.reduced((300, 300), oriented=True).size == (300, 300)
+    assert 'image' not in decoded.cache
+
+
 @mock.patch('photonix.classifiers.style.model.StyleModel.predict')
 def test_style_predict(mock_predict):
     from photonix.classifiers.style.model import StyleModel
@@ -237,3 +427,239 @@ def test_face_predict(mock_find_input_shape, mock_find_euclidean_distance, mock_
             os.remove(Path(settings.MODEL_DIR) / 'face' / fn)
         except:
             pass
+
+
+def test_style_session_reused():
+    import tensorflow as tf
+
+    from photonix.classifiers.style.model import StyleModel
+
+    # Stand-in for the real graph with the same input and output names
+    graph = tf.Graph()
+    with graph.as_default():
+        input_tensor = tf.compat.v1.placeholder(tf.float32, [None, 224, 224, 3], name='import/input')
+        tf.nn.softmax(tf.reduce_mean(input_tensor, axis=[1, 2]), name='import/final_result')
+
+    with mock.patch.object(StyleModel, '__init__', return_value=None):
+        model = StyleModel()
+    model.model_dir = 'test'
+    model.session_cache = {}
+    model.graph = graph
+    model.labels = ['red', 'green', 'blue']
+
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    num_ops = len(graph.get_operations())
+    with mock.patch('tensorflow.compat.v1.Session', wraps=tf.compat.v1.Session) as mock_session:
+        results = [model.predict(snow, min_score=0) for _ in range(3)]
+
+    # One session for all predictions and no ops added to the graph by preprocessing or inference
+    assert mock_session.call_count == 1
+    assert len(graph.get_operations()) == num_ops
+    assert graph.finalized
+    assert results[0] == results[2]
+    assert len(model.predict_batch([snow, snow], min_score=0)) == 2
+
+
+def test_face_model_loaded_once():
+    from photonix.classifiers.base_model import graph_cache
+    from photonix.classifiers.face.model import FaceModel, run_on_photo
+    from photonix.classifiers.registry import model_registry
+
+    from photonix.photos.utils.image import DecodedImage
+
+    # Decoded once up front so the loop only measures the model
+    snow = DecodedImage(Path(__file__).parent / 'photos' / 'snow.jpg')
+    model_registry.clear()
+    graph_cache.pop(f'face:{settings.MODEL_DIR}', None)
+
+    with mock.patch.object(FaceModel, 'ensure_downloaded', autospec=True, side_effect=FaceModel.ensure_downloaded) as mock_ensure_downloaded, \
+            mock.patch.object(FaceModel, 'get_model_info') as mock_get_model_info, \
+            mock.patch('photonix.classifiers.face.model.MTCNN') as mock_mtcnn, \
+            mock.patch('photonix.classifiers.face.model.build_model') as mock_build_model:
+        mock_mtcnn.return_value.detect_faces.return_value = []
+        # Pretend the model files are already downloaded
+        mock_version_file = mock.mock_open(read_data=str(FaceModel.version))
+        with mock.patch('photonix.classifiers.base_model.open', mock_version_file):
+            for _ in range(100):
+                assert run_on_photo(snow.path, image=snow)[1] == []
+
+            # Instances created outside the registry (e.g. for retraining) share the same networks
+            for _ in range(10):
+                assert FaceModel(library_id=None).graph['mtcnn'] is mock_mtcnn.return_value
+
+        assert mock_mtcnn.call_count == 1
+        assert mock_build_model.call_count == 1
+        mock_get_model_info.assert_not_called()
+        # Only the first instance reads the version file, the rest find the loaded model in the cache
+        assert mock_ensure_downloaded.call_count == 11
+        assert mock_version_file.call_count == 1
+
+    graph_cache.pop(f'face:{settings.MODEL_DIR}', None)
+    model_registry.clear()
+
+
+def test_face_embedding_matrix(db):
+    import numpy as np
+
+    from photonix.classifiers.face.deepface.commons.distance import \
+        findEuclideanDistance
+    from photonix.classifiers.face.embeddings import (EmbeddingMatrixCache,
+                                                      embedding_to_bytes)
+    from photonix.classifiers.face.model import FaceModel
+
+    from .factories import LibraryFactory, PhotoFactory, PhotoTagFactory, TagFactory
+
+    library = LibraryFactory()
+    photo = PhotoFactory(library=library)
+    rng = np.random.RandomState(0)
+
+    def add_face(embedding):
+        tag = TagFactory(library=library, type='F')
+        return PhotoTagFactory(photo=photo, tag=tag, source='C', confidence=1, embedding=embedding_to_bytes(embedding))
+
+    embeddings = rng.normal(size=(50, 128)).tolist()
+    photo_tags = [add_face(embedding) for embedding in embeddings]
+    # Faces without embeddings are skipped
+    PhotoTagFactory(photo=photo, tag=TagFactory(library=library, type='F'), source='C', confidence=1)
+
+    def closest_by_loop(source, targets):
+        distances = [findEuclideanDistance(source, target) for _, target in targets]
+        return targets[int(np.argmin(distances))][0], min(distances)
+
+    cache = EmbeddingMatrixCache()
+    model = FaceModel.__new__(FaceModel)
+    model.library_id = library.id
+    sources = rng.normal(size=(5, 128)).tolist()
+    with mock.patch('photonix.classifiers.face.model.embedding_matrices', cache):
+        targets = [(str(photo_tag.tag_id), photo_tag_embedding) for photo_tag, photo_tag_embedding in zip(photo_tags, embeddings)]
+        for source, (nearest, distance) in zip(sources, model.find_closest_face_tags_by_brute_force(sources)):
+            expected_nearest, expected_distance = closest_by_loop(source, targets)
+            assert nearest == expected_nearest
+            assert abs(distance - expected_distance) < 1e-4
+
+        # New faces are picked up without reloading the rest
+        new_photo_tag = add_face(sources[0])
+        with mock.patch.object(cache.matrices[library.id], 'clear') as mock_clear:
+            assert model.find_closest_face_tag_by_brute_force(sources[0]) == (str(new_photo_tag.tag_id), 0.0)
+        mock_clear.assert_not_called()
+        assert len(cache.matrices[library.id]) == 51
+
+        # Deleted faces are dropped without reloading the rest either, as happens when a photo is classified again
+        matrix = cache.matrices[library.id]
+        new_photo_tag.delete()
+        photo_tags[0].delete()
+        replacement = add_face(embeddings[0])
+        targets[0] = (str(replacement.tag_id), embeddings[0])
+        with mock.patch.object(matrix, 'clear') as mock_clear, \
+                mock.patch.object(matrix, 'load', wraps=matrix.load) as mock_load:
+            for source, (nearest, distance) in zip(sources, model.find_closest_face_tags_by_brute_force(sources)):
+                expected_nearest, expected_distance = closest_by_loop(source, targets)
+                assert nearest == expected_nearest
+                assert abs(distance - expected_distance) < 1e-4
+        mock_clear.assert_not_called()
+        assert mock_load.call_count == 1
+        assert len(matrix) == 50
+        assert len(matrix.rows) == 51
+        assert all(matrix.photo_tag_ids[row] == photo_tag_id for photo_tag_id, row in matrix.rows.items() if row is not None)
+
+
+def test_face_index_cached(tmpdir, settings):
+    import numpy as np
+
+    from photonix.classifiers.face.index import FaceIndex, FaceIndexCache
+    from photonix.classifiers.face.model import FaceModel
+
+    settings.MODEL_DIR = str(tmpdir)
+    os.makedirs(Path(settings.MODEL_DIR) / 'face')
+    model = FaceModel.__new__(FaceModel)
+    model.library_id = '00000000-0000-0000-0000-000000000000'
+    rng = np.random.RandomState(0)
+    embeddings = rng.normal(size=(20, 128)).tolist()
+    cache = FaceIndexCache()
+
+    with mock.patch('photonix.classifiers.face.model.face_indexes', cache), \
+            mock.patch.object(FaceIndex, 'load', side_effect=FaceIndex.load) as mock_load:
+        # Nothing to search until the index has been trained
+        assert model.find_closest_face_tag_by_ann(embeddings[0]) == (None, 999)
+
+        model.retrain_face_similarity_index(training_data=[('a', embeddings[0]), ('b', embeddings[1])])
+        for _ in range(100):
+            nearest, distance = model.find_closest_face_tag_by_ann(embeddings[1])
+            assert (nearest, distance) == ('b', 0)
+        assert mock_load.call_count == 1
+        assert model.retrained_version == model.reload_retrained_model_version()
+
+        # Queries carry on against the index they were given while a retrained one is swapped in
+        old_index = cache.get(model.library_id)
+        time.sleep(0.01)
+        model.retrain_face_similarity_index(training_data=[('c', embeddings[1])])
+        assert [nearest for nearest, _ in model.find_closest_face_tags_by_ann(embeddings[:2])] == ['c', 'c']
+        assert mock_load.call_count == 2
+        assert old_index.nearest(embeddings[1]) == ('b', 0)
+
+
+# Everything here was updated in the last minute so would otherwise be re-checked in the delta
+@mock.patch('photonix.classifiers.face.model.REFRESH_OVERLAP', timedelta(0))
+def test_face_index_segments(db, tmpdir, settings):
+    import numpy as np
+
+    from photonix.classifiers.face.embeddings import embedding_to_bytes
+    from photonix.classifiers.face.index import (FaceIndex, index_paths,
+                                                 indexed_face_count)
+    from photonix.classifiers.face.model import FaceModel
+
+    from .factories import LibraryFactory, PhotoFactory, PhotoTagFactory, TagFactory
+
+    settings.MODEL_DIR = str(tmpdir)
+    os.makedirs(Path(settings.MODEL_DIR) / 'face')
+    library = LibraryFactory()
+    photo = PhotoFactory(library=library)
+    rng = np.random.RandomState(0)
+    embeddings = rng.normal(size=(40, 128))
+
+    def add_face(embedding, library=library, photo=photo):
+        tag = TagFactory(library=library, type='F')
+        return PhotoTagFactory(photo=photo, tag=tag, source='C', confidence=1, embedding=embedding_to_bytes(embedding))
+
+    photo_tags = [add_face(embedding) for embedding in embeddings[:30]]
+    # Faces in other libraries aren't included
+    other_library = LibraryFactory()
+    add_face(embeddings[39], other_library, PhotoFactory(library=other_library))
+
+    model = FaceModel.__new__(FaceModel)
+    model.library_id = library.id
+    ann_path = index_paths(library.id)[0]
+
+    model.retrain_face_similarity_index()
+    index = FaceIndex.load(library.id)
+    assert index.index.get_n_items() == 30
+    assert index.nearest(embeddings[5]) == (str(photo_tags[5].tag_id), 0)
+    base_inode = os.stat(ann_path).st_ino
+
+    # Changes go into the delta segment, leaving the base as it is
+    new_photo_tags = [add_face(embedding) for embedding in embeddings[30:32]]
+    photo_tags[1].tag = TagFactory(library=library, type='F')
+    photo_tags[1].save()
+    deleted_tag_id = str(photo_tags[2].tag_id)
+    photo_tags[2].delete()
+    assert indexed_face_count(library.id) == 30
+
+    model.retrain_face_similarity_index()
+    assert os.stat(ann_path).st_ino == base_inode
+    assert indexed_face_count(library.id) == 31
+    index = FaceIndex.load(library.id)
+    assert len(index.delta) == 3
+    assert len(index.removed) == 2
+    assert index.nearest(embeddings[30]) == (str(new_photo_tags[0].tag_id), 0)
+    assert index.nearest(embeddings[1]) == (str(photo_tags[1].tag_id), 0)
+    assert index.nearest(embeddings[2])[0] != deleted_tag_id
+    assert index.nearest(embeddings[5]) == (str(photo_tags[5].tag_id), 0)
+
+    # Once the delta grows past the threshold it is compacted into a new base
+    with mock.patch('photonix.classifiers.face.model.COMPACT_MIN_SIZE', 2):
+        model.retrain_face_similarity_index()
+    assert os.stat(ann_path).st_ino != base_inode
+    index = FaceIndex.load(library.id)
+    assert index.index.get_n_items() == 31
+    assert len(index.delta) == 0 and not index.removed
+    assert index.nearest(embeddings[1]) == (str(photo_tags[1].tag_id), 0)
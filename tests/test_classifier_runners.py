@@ -1,6 +1,8 @@
 from pathlib import Path
 from unittest import mock
+from uuid import uuid4
 
+import numpy as np
 import pytest
 
 from .factories import LibraryFactory
@@ -132,3 +134,119 @@ def test_style_via_runner(mock_predict, photo_fixture_snow):
     assert photo_fixture_snow.photo_tags.all()[0].tag.type == 'S'
     assert '{0:.3f}'.format(photo_fixture_snow.photo_tags.all()[
                             0].significance) == '0.962'
+
+
+def test_batched_classification(photo_fixture_snow, photo_fixture_tree, settings):
+    from photonix.photos import tasks
+    from photonix.photos.utils.classifier_batch import pending_batch_size, queue_for_batch
+
+    settings.CLASSIFIER_BATCH_SIZE = 2
+    for photo in [photo_fixture_snow, photo_fixture_tree]:
+        photo.library.classification_style_enabled = True
+        photo.library.save()
+
+    mock_run_style_batch = mock.Mock()
+    with mock.patch.dict(tasks.BATCH_CLASSIFIERS, {'style': mock_run_style_batch}), \
+            mock.patch.object(tasks.classify_batch_task, 'apply_async') as mock_apply_async:
+        # First photo waits for the batch to fill up, with a flush scheduled in case it doesn't
+        assert tasks.analyse_photo(photo_fixture_snow) == ['style']
+        mock_apply_async.assert_called_once_with(('style', True), countdown=settings.CLASSIFIER_BATCH_MAX_WAIT)
+        mock_run_style_batch.assert_not_called()
+
+        # Second photo fills it so the batch is run straight away, with both photos classified by one call
+        tasks.analyse_photo(photo_fixture_tree)
+        assert mock_apply_async.call_args == mock.call(('style',), {})
+        tasks.classify_batch_task('style')
+        mock_run_style_batch.assert_called_once_with([str(photo_fixture_snow.id), str(photo_fixture_tree.id)])
+        assert pending_batch_size('style') == 0
+        assert mock_apply_async.call_count == 2
+
+        # Flush scheduled by the first photo finds nothing left to do
+        tasks.classify_batch_task('style', True)
+        assert mock_run_style_batch.call_count == 1
+
+        # A bulk import queues one task per full batch plus a single flush for the remainder, not one per photo
+        mock_apply_async.reset_mock()
+        photo_ids = [str(uuid4()) for _ in range(5)]
+        for photo_id in photo_ids:
+            tasks.schedule_classifier_batch('style', queue_for_batch('style', photo_id))
+        assert mock_apply_async.call_args_list == [
+            mock.call(('style', True), countdown=settings.CLASSIFIER_BATCH_MAX_WAIT),
+            mock.call(('style',), {}),
+            mock.call(('style',), {}),
+        ]
+        tasks.classify_batch_task('style')
+        tasks.classify_batch_task('style')
+        tasks.classify_batch_task('style', True)
+        assert mock_apply_async.call_count == 3
+        assert [call.args[0] for call in mock_run_style_batch.call_args_list[1:]] == \
+            [photo_ids[0:2], photo_ids[2:4], photo_ids[4:]]
+
+
+def test_model_registry():
+    from photonix.classifiers.color.model import ColorModel, run_on_photo
+    from photonix.classifiers.registry import model_registry
+
+    model_registry.clear()
+    snow = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    with mock.patch.object(ColorModel, '__init__', autospec=True, side_effect=ColorModel.__init__) as mock_init:
+        # Loaded at worker startup, unknown names are logged rather than stopping the worker
+        model_registry.warm(['color', 'unknown'])
+        results = [run_on_photo(snow)[1] for _ in range(20)]
+        assert mock_init.call_count == 1
+
+    assert model_registry.get('color') is model_registry.get('color')
+    assert results[0] == results[-1]
+    model_registry.clear()
+
+
+def test_style_batch_runner(photo_fixture_snow, photo_fixture_tree):
+    from photonix.classifiers.style.model import run_on_photos
+
+    mock_model = mock.Mock()
+    mock_model.predict_batch.return_value = [[('serene', 0.99)], None]
+    with mock.patch('photonix.classifiers.style.model.model_registry') as mock_registry:
+        mock_registry.get.return_value = mock_model
+        photos, results = run_on_photos([str(photo_fixture_snow.id), str(photo_fixture_tree.id)])
+
+    assert [photo.id for photo in photos] == [photo_fixture_snow.id, photo_fixture_tree.id]
+    photo_tag = photo_fixture_snow.photo_tags.get(tag__type='S')
+    assert (photo_tag.tag.name, photo_tag.confidence) == ('serene', 0.99)
+    assert photo_tag.created_at and photo_tag.updated_at
+    assert not photo_fixture_tree.photo_tags.filter(tag__type='S').exists()
+
+
+def test_object_boxes_follow_rotation(photo_fixture_snow):
+    from photonix.classifiers.object.model import ObjectModel, run_on_photo
+
+    model = ObjectModel.__new__(ObjectModel)
+    model.labels = {1: {'name': 'Tree'}}
+    inputs = []
+
+    def run_inference_for_batch(images):
+        inputs.append(images[0])
+        # A box in the left half of whatever the detector was shown, [ymin, xmin, ymax, xmax]
+        return [{'detection_scores': [0.9], 'detection_classes': [1], 'detection_boxes': [[0.1, 0.2, 0.5, 0.6]]}]
+
+    model.run_inference_for_batch = run_inference_for_batch
+
+    def position():
+        photo_tag = photo_fixture_snow.photo_tags.get(tag__type='O')
+        return tuple(round(value, 3) for value in (photo_tag.position_x, photo_tag.position_y, photo_tag.size_x, photo_tag.size_y))
+
+    with mock.patch('photonix.classifiers.object.model.model_registry') as mock_registry:
+        mock_registry.get.return_value = model
+        run_on_photo(photo_fixture_snow.id)
+        assert position() == (0.4, 0.3, 0.4, 0.4)
+
+        # Rotated 90° clockwise by the user the detector sees the rotated image. The box it finds is mapped back onto
+        # the unrotated photo as the UI rotates boxes along with the image.
+        base_file = photo_fixture_snow.base_file
+        base_file.rotation = 90
+        base_file.save()
+        run_on_photo(photo_fixture_snow.id)
+        assert position() == (0.3, 0.6, 0.4, 0.4)
+
+    assert inputs[0].shape == inputs[1].shape == (300, 300, 3)
+    assert not (inputs[0] == inputs[1]).all()
+    assert (inputs[1] == np.rot90(inputs[0], k=-1)).mean() > 0.9
@@ -437,6 +437,41 @@ class TestGraphQL(unittest.TestCase):
         self.assertEqual(tuple(tuple(tuple(data.values())[0].values())[0].values())[
                          0].get('aperture'), str(self.defaults['snow_photo'].aperture))
 
+    def test_save_photo_file_rotation_mutation(self):
+        """Test rotation only re-runs the classifiers that depend on orientation."""
+        mutation = """
+            mutation savePhotoFileRotation($id: ID!, $rotation: Int!) {
+                savePhotofileRotation(photoFileId: $id, rotation: $rotation) {
+                    ok
+                    rotation
+                }
+            }
+        """
+        photo_file = self.defaults['snow_photo'].base_file
+        self._library.classification_color_enabled = True
+        self._library.classification_face_enabled = True
+        self._library.save()
+
+        with mock.patch('photonix.photos.tasks.analyse_photo_task') as mock_analyse, \
+                mock.patch('photonix.photos.tasks.generate_thumbnails_for_photo') as mock_thumbnails:
+            response = self.api_client.post_graphql(
+                mutation, {'id': str(photo_file.id), 'rotation': 90})
+            data = get_graphql_content(response)
+            assert data['data']['savePhotofileRotation'] == {'ok': True, 'rotation': 90}
+            photo_file.refresh_from_db()
+            assert photo_file.rotation == 90
+
+            # Thumbnails are rotated by the UI so shouldn't be touched. Face detection is re-run but not color.
+            mock_thumbnails.assert_not_called()
+            mock_analyse.delay.assert_called_once_with(photo_file.photo.id, ['face'])
+
+            # Saving the same rotation again shouldn't queue anything
+            mock_analyse.reset_mock()
+            response = self.api_client.post_graphql(
+                mutation, {'id': str(photo_file.id), 'rotation': 90})
+            assert get_graphql_content(response)['data']['savePhotofileRotation']['ok']
+            mock_analyse.delay.assert_not_called()
+
     def test_create_generic_tag_mutation(self):
         """Test create_generic_tag mutation response."""
         mutation = """
@@ -1,4 +1,6 @@
+import io
 import os
+import struct
 from pathlib import Path
 
 import pytest
@@ -8,12 +10,13 @@ from django.utils import timezone
 from photonix.photos.models import PhotoFile
 from photonix.photos.utils.fs import download_file
 from photonix.photos.utils.raw import (generate_jpeg, identified_as_jpeg)
+from photonix.photos.utils.raw_preview import copy_embedded_jpeg, find_embedded_jpegs, read_embedded_jpeg
 
 from .factories import LibraryFactory
 
 PHOTOS = [
-    # -e argument to dcraw means JPEG was extracted without any processing
-    ('Adobe DNG Converter - Canon EOS 5D Mark III - Lossy JPEG compression (3_2).DNG',  'dcraw -e', 1236950,
+    # Embedded preview means JPEG was extracted from the raw file's container without any processing
+    ('Adobe DNG Converter - Canon EOS 5D Mark III - Lossy JPEG compression (3_2).DNG',  'embedded preview', 1236950,
      ['https://epixstudios.co.uk/uploads/filer_public/36/fa/36fad1f0-8032-45da-bad8-7d9b7d490d99/adobe_dng_converter_-_canon_eos_5d_mark_iii_-_lossy_jpeg_compression_3_2.dng', 'https://raw.pixls.us/getfile.php/1023/nice/Adobe%20DNG%20Converter%20-%20Canon%20EOS%205D%20Mark%20III%20-%20Lossy%20JPEG%20compression%20(3:2).DNG']),
     ('Apple - iPhone 8 - 16bit (4_3).dng',                                              'dcraw -w', 772618,
      # No embedded JPEG
@@ -21,7 +24,7 @@ PHOTOS = [
     ('Canon - Canon PowerShot SX20 IS.DNG',                                             'dcraw -w', 1828344,
      # Embedded image but low resolution and not a JPEG
      ['https://epixstudios.co.uk/uploads/filer_public/4e/28/4e28cab6-0523-48e3-a70b-e5bdaf041bb1/canon_-_canon_powershot_sx20_is.dng', 'https://raw.pixls.us/getfile.php/861/nice/Canon%20-%20Canon%20PowerShot%20SX20%20IS.DNG']),
-    ('Canon - EOS 7D - sRAW2 (sRAW) (3:2).CR2',                                         'dcraw -e', 2264602,
+    ('Canon - EOS 7D - sRAW2 (sRAW) (3:2).CR2',                                         'embedded preview', 2264602,
      ['https://epixstudios.co.uk/uploads/filer_public/7f/a2/7fa2e9d6-a1fc-4ca6-bb19-306c1320c9c4/canon_-_eos_7d_-_sraw2_sraw_32.cr2', 'https://raw.pixls.us/getfile.php/129/nice/Canon%20-%20EOS%207D%20-%20sRAW2%20(sRAW)%20(3:2).CR2']),
     ('Canon - Powershot SX110IS - CHDK.CR2',                                            'dcraw -w', 1493825,
      # No embedded JPEG, No metadata about image dimensions for us to compare against
@@ -29,7 +32,7 @@ PHOTOS = [
     ('Leica - D-LUX 5 - 16_9.RWL',                                                      'dcraw -w', 1478207, ['https://epixstudios.co.uk/uploads/filer_public/a5/0f/a50f6ddb-ab72-4e78-8e68-f6131e3a7dcd/leica_-_d-lux_5_-_16_9.rwl',
      # Less common aspect ratio, fairly large embedded JPEG but not similar enough to the raw's dimensions
                                                                                                               'https://raw.pixls.us/getfile.php/2808/nice/Leica%20-%20D-LUX%205%20-%2016:9.RWL']),
-    ('Nikon - 1 J1 - 12bit compressed (Lossy (type 2)) (3_2).NEF',                      'dcraw -e', 635217,
+    ('Nikon - 1 J1 - 12bit compressed (Lossy (type 2)) (3_2).NEF',                      'embedded preview', 635217,
      ['https://epixstudios.co.uk/uploads/filer_public/a6/7c/a67c538f-254d-4793-862c-4b3dc3bda0ef/nikon_-_1_j1_-_12bit_compressed_lossy_type_2_3_2.nef', 'https://raw.pixls.us/getfile.php/2956/nice/Nikon%20-%201%20J1%20-%2012bit%20compressed%20(Lossy%20(type%202))%20(3:2).NEF']),
     ('Sony - SLT-A77 - 12bit compressed (3_2).ARW',                                     'dcraw -w', 859814, ['https://epixstudios.co.uk/uploads/filer_public/42/a6/42a6b056-7e33-4100-b652-5b96aff8bc22/sony_-_slt-a77_-_12bit_compressed_3_2.arw',
      # Large embedded JPEG but not the right aspect ratio and smaller than raw
@@ -122,3 +125,230 @@ def test_task_raw_processing(photo_fixture_raw):
         if thumbnail[4]:
             path = photo_fixture_raw.thumbnail_path(thumbnail)
             os.remove(path)
+
+
+def make_jpeg(width, height):
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), (255, 0, 0)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def make_tiff_ifd(entries, next_offset=0):
+    # Entries are (tag, type, count, value) with values small enough to fit inline
+    data = struct.pack('<H', len(entries))
+    for tag, value_type, count, value in entries:
+        value = struct.pack('<H', value) + b'\x00\x00' if value_type == 3 else struct.pack('<I', value)
+        data += struct.pack('<HHI', tag, value_type, count) + value
+    return data + struct.pack('<I', next_offset)
+
+
+def test_find_embedded_jpegs_tiff(tmpdir):
+    thumbnail = make_jpeg(160, 120)
+    preview = make_jpeg(600, 400)
+
+    # IFD0 (orientation, SubIFDs) -> IFD1 (thumbnail); SubIFD (preview)
+    ifd0_offset = 8
+    ifd1_offset = ifd0_offset + 2 + 2 * 12 + 4
+    sub_ifd_offset = ifd1_offset + 2 + 2 * 12 + 4
+    thumbnail_offset = sub_ifd_offset + 2 + 2 * 12 + 4
+    preview_offset = thumbnail_offset + len(thumbnail)
+    data = b'II*\x00' + struct.pack('<I', ifd0_offset)
+    data += make_tiff_ifd([(0x0112, 3, 1, 6), (0x014a, 4, 1, sub_ifd_offset)], ifd1_offset)
+    data += make_tiff_ifd([(0x0201, 4, 1, thumbnail_offset), (0x0202, 4, 1, len(thumbnail))])
+    data += make_tiff_ifd([(0x0201, 4, 1, preview_offset), (0x0202, 4, 1, len(preview))])
+    data += thumbnail + preview
+    path = str(tmpdir / 'test.nef')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    jpegs, orientation = find_embedded_jpegs(path)
+    assert orientation == 6
+    assert sorted([(jpeg.width, jpeg.height) for jpeg in jpegs]) == [(160, 120), (600, 400)]
+
+    # Orientation gets carried over to the extracted JPEG so thumbnails come out the right way up
+    from PIL import Image
+    jpeg = max(jpegs, key=lambda jpeg: jpeg.width)
+    im = Image.open(io.BytesIO(read_embedded_jpeg(path, jpeg, orientation)))
+    assert im.size == (600, 400)
+    assert im.getexif()[0x0112] == 6
+
+
+def test_find_embedded_jpegs_cr3(tmpdir):
+    def box(box_type, payload):
+        return struct.pack('>I', len(payload) + 8) + box_type + payload
+
+    jpeg_data = make_jpeg(600, 400)
+    cmt1 = b'II*\x00' + struct.pack('<I', 8) + make_tiff_ifd([(0x0112, 3, 1, 8)])
+    canon_uuid = box(b'uuid', bytes.fromhex('85c0b687820f11e08111f4ce462b6a48') + box(b'CMT1', cmt1))
+    ftyp = box(b'ftyp', b'crx ' + b'\x00\x00\x00\x01' + b'crx isom')
+
+    # Offset of the JPEG inside mdat depends on the size of moov, which is the same whatever the offset value is
+    def moov(offset):
+        stbl = box(b'stsz', struct.pack('>III', 0, 0, 1) + struct.pack('>I', len(jpeg_data))) + \
+            box(b'co64', struct.pack('>II', 0, 1) + struct.pack('>Q', offset))
+        trak = box(b'trak', box(b'mdia', box(b'minf', box(b'stbl', stbl))))
+        return box(b'moov', canon_uuid + trak)
+
+    offset = len(ftyp) + len(moov(0)) + 8
+    data = ftyp + moov(offset) + box(b'mdat', jpeg_data)
+    path = str(tmpdir / 'test.cr3')
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    jpegs, orientation = find_embedded_jpegs(path)
+    assert orientation == 8
+    assert jpegs == [(offset, len(jpeg_data), 600, 400)]
+    assert read_embedded_jpeg(path, jpegs[0]) == jpeg_data
+
+    # Copied with sendfile() it should be the same as reading it
+    output_path = str(tmpdir / 'out.jpg')
+    with open(output_path, 'wb') as f:
+        copy_embedded_jpeg(path, jpegs[0], f, orientation)
+    with open(output_path, 'rb') as f:
+        assert f.read() == read_embedded_jpeg(path, jpegs[0], orientation)
+
+
+def test_find_embedded_jpegs_unsupported(tmpdir):
+    path = str(tmpdir / 'test.rw2')
+    with open(path, 'wb') as f:
+        f.write(b'IIU\x00' + b'\x00' * 100)
+    assert find_embedded_jpegs(path) == (None, None)
+
+
+def test_tool_registry_probes_once():
+    from unittest import mock
+
+    from photonix.photos.utils.system import ToolRegistry
+
+    probe = mock.Mock(return_value='9.28')
+    registry = ToolRegistry({'dcraw': probe})
+    with mock.patch('photonix.photos.utils.system.shutil.which', return_value='/usr/bin/dcraw') as mock_which:
+        for _ in range(3):
+            assert registry.version('dcraw') == '9.28'
+            assert registry.path('dcraw') == '/usr/bin/dcraw'
+        assert probe.call_count == 1
+        assert mock_which.call_count == 1
+
+        # Versions are only looked up again when asked to
+        registry.refresh()
+        assert probe.call_count == 2
+
+    with mock.patch('photonix.photos.utils.system.shutil.which', return_value=None):
+        registry.refresh()
+        assert registry.path('dcraw') is None
+        assert registry.get('not-a-tool').path is None
+
+
+def test_raw_development_scheduler(settings):
+    from photonix.photos.utils.raw_scheduler import (RawDevelopmentDeferred, estimate_development_memory_mb,
+                                                     raw_development_slot)
+
+    settings.RAW_DEVELOPMENT_MEMORY_BUDGET_MB = 1000
+    settings.RAW_DEVELOPMENT_MAX_PROCESSES = 3
+    assert estimate_development_memory_mb(6000, 4000) == 412
+    assert estimate_development_memory_mb() == estimate_development_memory_mb(10000, 5000)
+
+    # Two 24MP developments fit in the budget but a third doesn't
+    with raw_development_slot(6000, 4000, timeout=0):
+        with raw_development_slot(6000, 4000, timeout=0):
+            with pytest.raises(RawDevelopmentDeferred):
+                with raw_development_slot(6000, 4000, timeout=0):
+                    pass
+            # Something small still fits
+            with raw_development_slot(2000, 1500, timeout=0):
+                pass
+
+    # Memory is given back afterwards and a job bigger than the budget can run on its own
+    with raw_development_slot(10000, 10000, timeout=0):
+        with pytest.raises(RawDevelopmentDeferred):
+            with raw_development_slot(1000, 1000, timeout=0):
+                pass
+
+    # Limit on the number of processes applies regardless of memory
+    settings.RAW_DEVELOPMENT_MAX_PROCESSES = 1
+    with raw_development_slot(1000, 1000, timeout=0):
+        with pytest.raises(RawDevelopmentDeferred):
+            with raw_development_slot(1000, 1000, timeout=0):
+                pass
+
+
+def test_raw_processing_skipped_when_up_to_date(db):
+    from datetime import datetime
+    from datetime import timezone as dt_timezone
+    from unittest import mock
+
+    from django.core.management import call_command
+
+    from photonix.photos.tasks import process_raw_task
+    from photonix.photos.utils.raw import RAW_PROCESS_VERSION
+
+    from .factories import PhotoFileFactory
+
+    path = str(Path(__file__).parent / 'photos' / 'snow.jpg')
+    photo_file = PhotoFileFactory(
+        path=path, mimetype='image/x-canon-cr2', raw_processed=True, raw_version=int(RAW_PROCESS_VERSION),
+        file_modified_at=datetime.fromtimestamp(os.stat(path).st_mtime, tz=dt_timezone.utc))
+    unprocessed_photo_file = PhotoFileFactory(path=path, mimetype='image/x-canon-cr2')
+    # Processed by a newer version before it was rolled back
+    newer_photo_file = PhotoFileFactory(
+        path=path, mimetype='image/x-canon-cr2', raw_processed=True, raw_version=int(RAW_PROCESS_VERSION) + 1)
+    PhotoFileFactory(path=path)  # Not raw
+    os.makedirs(settings.PHOTO_RAW_PROCESSED_DIR, exist_ok=True)
+    with open(photo_file.base_image_path, 'wb') as f:
+        f.write(b'\xff\xd8')
+
+    with mock.patch('photonix.photos.tasks.generate_jpeg', return_value=(None, None, None, None)) as mock_generate_jpeg:
+        process_raw_task(photo_file.photo.id)
+        assert mock_generate_jpeg.call_count == 0
+
+        # Raw processing code has been updated since
+        photo_file.raw_version = int(RAW_PROCESS_VERSION) - 1
+        photo_file.save()
+        process_raw_task(photo_file.photo.id)
+        assert mock_generate_jpeg.call_count == 1
+
+    # Housekeeping only reschedules photos with outdated or unprocessed raw files
+    with mock.patch('photonix.photos.management.commands.housekeeping.chain') as mock_chain, \
+            mock.patch('photonix.photos.management.commands.housekeeping.generate_thumbnails_task'):
+        call_command('housekeeping', reprocess_outdated_raws=True)
+    assert mock_chain.call_count == 3
+    assert {str(call.args[0].args[0]) for call in mock_chain.call_args_list} == \
+        {str(photo_file.photo.id), str(unprocessed_photo_file.photo.id), str(newer_photo_file.photo.id)}
+    assert newer_photo_file.needs_raw_processing()
+
+    os.remove(photo_file.base_image_path)
+
+
+def test_raw_development_deferral_gives_up(db):
+    from unittest import mock
+
+    from celery.exceptions import Retry
+
+    from photonix.photos.tasks import RAW_DEVELOPMENT_MAX_RETRIES, process_raw_task
+    from photonix.photos.utils.raw_scheduler import RawDevelopmentDeferred
+
+    from .factories import PhotoFileFactory
+
+    photo_file = PhotoFileFactory(mimetype='image/x-canon-cr2')
+
+    # Retried with increasing delays while there's no memory for developing, then left for housekeeping
+    countdowns = []
+    with mock.patch('photonix.photos.tasks.generate_jpeg', side_effect=RawDevelopmentDeferred), \
+            mock.patch.object(process_raw_task, 'retry', side_effect=lambda countdown: Retry(when=countdown)), \
+            mock.patch('photonix.photos.tasks.logger') as mock_logger:
+        for retries in range(RAW_DEVELOPMENT_MAX_RETRIES + 1):
+            process_raw_task.push_request(retries=retries)
+            try:
+                process_raw_task(photo_file.photo.id)
+            except Retry as e:
+                countdowns.append(e.when)
+            finally:
+                process_raw_task.pop_request()
+
+    assert len(countdowns) == RAW_DEVELOPMENT_MAX_RETRIES
+    assert countdowns[:3] == [30, 60, 120]
+    assert countdowns[-1] == 30 * 60
+    mock_logger.error.assert_called_once()
+    photo_file.refresh_from_db()
+    assert not photo_file.raw_processed
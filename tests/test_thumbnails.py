@@ -34,8 +34,9 @@ def test_generate_thumbnail(photo_fixture_snow):
     path = get_thumbnail_path(
         photo_fixture_snow.base_file.id, width, height, crop, quality)
     assert os.path.exists(path)
-    assert str(path).endswith(str(Path('cache') / 'thumbnails' / 'photofile' /
-                                  '256x256_cover_q50' / '{}.jpg'.format(str(photo_fixture_snow.base_file.id))))
+    photo_file_id = str(photo_fixture_snow.base_file.id)
+    assert str(path).endswith(str(Path('cache') / 'thumbnails' / 'photofile' / '256x256_cover_q50' /
+                                  photo_file_id[0:2] / photo_file_id[2:4] / '{}.jpg'.format(photo_file_id)))
     assert len(result) == os.stat(path).st_size
     assert os.stat(path).st_size > 5929 * 0.8
     assert os.stat(path).st_size < 5929 * 1.2
@@ -62,16 +63,19 @@ def test_view(photo_fixture_snow):
     # We should get a 302 redirect back
     assert response.status_code == 302
     redirect_url = response['Location']
-    assert redirect_url == f'/thumbnails/photofile/256x256_cover_q50/{photo_fixture_snow.base_file.id}.jpg'
+    photo_file_id = str(photo_fixture_snow.base_file.id)
+    assert redirect_url == \
+        f'/thumbnails/photofile/256x256_cover_q50/{photo_file_id[0:2]}/{photo_file_id[2:4]}/{photo_file_id}.jpg'
 
     # Follow the redirect
     response = client.get(url, follow=True)
 
     # Now we should get the actual thumbnail image file
     assert response.status_code == 200
-    assert response.content[:10] == b'\xff\xd8\xff\xe0\x00\x10JFIF'
+    content = response.getvalue()
+    assert content[:10] == b'\xff\xd8\xff\xe0\x00\x10JFIF'
     assert response['Content-Type'] == 'image/jpeg'
-    response_length = len(response.content)
+    response_length = len(content)
     assert response_length > 5929 * 0.8
     assert response_length < 5929 * 1.2
 
@@ -86,5 +90,254 @@ def test_view(photo_fixture_snow):
     # Get and check the new file length
     redirect_url = response.request['PATH_INFO']
     response = client.get(redirect_url, follow=True)
-    assert len(response.content) == (response_length + 4)
+    assert len(response.getvalue()) == (response_length + 4)
     os.remove(path)
+
+
+def test_view_sendfile(photo_fixture_snow, settings):
+    settings.THUMBNAIL_RESPONSE_MODE = 'sendfile'
+    client = Client()
+    url = '/thumbnailer/photo/256x256_cover_q50/{}/'.format(
+        photo_fixture_snow.id)
+
+    # Image should be returned directly rather than by redirect
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response['Content-Type'] == 'image/jpeg'
+    content = response.getvalue()
+    assert content[:10] == b'\xff\xd8\xff\xe0\x00\x10JFIF'
+    assert int(response['Content-Length']) == len(content)
+    assert 'max-age=86400' in response['Cache-Control']
+    etag = response['ETag']
+    last_modified = response['Last-Modified']
+
+    # Conditional requests with matching validators shouldn't send the body again
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    response = client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+    assert response.status_code == 304
+
+    # A stale ETag gets the full image
+    response = client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize('mode', ['sendfile', 'x-accel-redirect'])
+def test_view_thumbnail_removed(photo_fixture_snow, settings, mode):
+    from unittest import mock
+
+    from photonix.photos import views
+
+    settings.THUMBNAIL_RESPONSE_MODE = mode
+    client = Client()
+    url = '/thumbnailer/photo/256x256_cover_q50/{}/'.format(
+        photo_fixture_snow.id)
+    path = get_thumbnail_path(photo_fixture_snow.base_file.id, 256, 256, 'cover', 50)
+
+    # Thumbnail deleted between being found and being sent gets generated again rather than causing an error
+    def get_thumbnail_then_remove(*args, **kwargs):
+        result = get_thumbnail(*args, **kwargs)
+        if kwargs['return_type'] == 'path':
+            os.remove(result)
+        return result
+
+    with mock.patch.object(views, 'get_thumbnail', side_effect=get_thumbnail_then_remove):
+        response = client.get(url)
+    assert response.status_code == 302
+    assert response['Location'].endswith(f'{photo_fixture_snow.base_file.id}.jpg')
+    assert os.path.exists(path)
+
+
+def test_view_x_accel_redirect(photo_fixture_snow, settings):
+    settings.THUMBNAIL_RESPONSE_MODE = 'x-accel-redirect'
+    client = Client()
+    url = '/thumbnailer/photo/256x256_cover_q50/{}/'.format(
+        photo_fixture_snow.id)
+
+    # Nginx is left to send the bytes from its internal location
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == b''
+    photo_file_id = str(photo_fixture_snow.base_file.id)
+    assert response['X-Accel-Redirect'] == \
+        f'/thumbnails-internal/photofile/256x256_cover_q50/{photo_file_id[0:2]}/{photo_file_id[2:4]}/{photo_file_id}.jpg'
+    # Nginx sets the caching headers and answers conditional requests from the file it sends
+    assert 'ETag' not in response
+
+
+def test_concurrent_requests_generate_once(photo_fixture_snow):
+    from threading import Thread
+    from unittest import mock
+
+    from PIL import Image
+
+    width, height, crop, quality, _, _ = settings.THUMBNAIL_SIZES[0]
+    photo_file = photo_fixture_snow.base_file
+    path = get_thumbnail_path(photo_file.id, width, height, crop, quality)
+    if os.path.exists(path):
+        os.remove(path)
+
+    # Several callers asking for the same thumbnail should only cause one of them to decode and render it
+    results = []
+    with mock.patch('photonix.photos.utils.thumbnails.Image.open', wraps=Image.open) as mock_open:
+        threads = [Thread(target=lambda: results.append(get_thumbnail(
+            photo_file, width=width, height=height, crop=crop, quality=quality, return_type='bytes'))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert mock_open.call_count == 1
+    assert len(results) == 4
+    assert all(result == results[0] for result in results)
+    assert results[0][:10] == b'\xff\xd8\xff\xe0\x00\x10JFIF'
+
+    # No temporary files should be left behind from the atomic write
+    assert not [fn for fn in os.listdir(path.parent) if fn.endswith('.tmp')]
+    os.remove(path)
+
+
+def test_content_addressed_thumbnails(db, settings, tmpdir):
+    from unittest import mock
+
+    from PIL import Image
+
+    from photonix.photos.utils.thumbnails import (generate_thumbnails_for_photo,
+                                                  get_content_hash,
+                                                  remove_unreferenced_thumbnails)
+
+    from .factories import PhotoFileFactory
+
+    settings.THUMBNAIL_CONTENT_ADDRESSED = True
+    settings.THUMBNAIL_ROOT = str(tmpdir)
+    width, height, crop, quality, _, _ = settings.THUMBNAIL_SIZES[0]
+
+    # Until the thumbnail task has hashed the file, requests use the PhotoFile ID rather than reading it all to hash it
+    photo_file_1 = PhotoFileFactory()
+    photo_file_2 = PhotoFileFactory()
+    with mock.patch('photonix.photos.utils.thumbnails.hashlib.sha256') as mock_sha256:
+        path = get_thumbnail(photo_file_1.id, width=width, height=height, crop=crop, quality=quality)
+        assert photo_file_1.photo.thumbnail_path(settings.THUMBNAIL_SIZES[0]) == str(path)
+    mock_sha256.assert_not_called()
+    assert str(path).endswith(f'{photo_file_1.id}.jpg')
+
+    generate_thumbnails_for_photo(photo_file_1.photo)
+    get_content_hash(photo_file_2)
+
+    # The PhotoFile ID keyed thumbnail isn't used once the file has been hashed
+    assert remove_unreferenced_thumbnails(min_age_seconds=0) == 1
+    assert not os.path.exists(path)
+
+    # Two separate PhotoFiles with identical content should then share one thumbnail that only gets rendered once
+    photo_file_1.refresh_from_db()
+    os.remove(get_thumbnail_path(photo_file_1.content_hash, width, height, crop, quality, 'content'))
+    with mock.patch('photonix.photos.utils.thumbnails.Image.open', wraps=Image.open) as mock_open:
+        path_1 = get_thumbnail(photo_file_1.id, width=width, height=height, crop=crop, quality=quality)
+        path_2 = get_thumbnail(photo_file_2.id, width=width, height=height, crop=crop, quality=quality)
+    assert mock_open.call_count == 1
+    assert path_1 == path_2
+
+    photo_file_1.refresh_from_db()
+    assert len(photo_file_1.content_hash) == 64
+    content_hash = photo_file_1.content_hash
+    assert str(path_1).endswith(str(Path('content') / '256x256_cover_q50' / content_hash[0:2] / content_hash[2:4] /
+                                    f'{content_hash}.jpg'))
+
+    # Thumbnail is kept while any PhotoFile still refers to it
+    photo_file_1.delete()
+    assert remove_unreferenced_thumbnails(min_age_seconds=0) == 0
+    assert os.path.exists(path_1)
+
+    photo_file_2.delete()
+    assert remove_unreferenced_thumbnails(min_age_seconds=0) == 1
+    assert not os.path.exists(path_1)
+
+
+def test_hash_photo_files(db, settings, tmpdir):
+    from unittest import mock
+
+    from django.core.management import call_command
+
+    from .factories import PhotoFileFactory
+
+    settings.THUMBNAIL_ROOT = str(tmpdir)
+    width, height, crop, quality, _, _ = settings.THUMBNAIL_SIZES[0]
+
+    # Thumbnails made before content addressing was turned on
+    photo_file_1 = PhotoFileFactory()
+    photo_file_2 = PhotoFileFactory()
+    path_1 = get_thumbnail(photo_file_1.id, width=width, height=height, crop=crop, quality=quality)
+    path_2 = get_thumbnail(photo_file_2.id, width=width, height=height, crop=crop, quality=quality)
+    deleted_path = get_thumbnail_path(photo_file_1.id, width, height, crop, quality).with_name('deleted.jpg')
+    os.link(path_1, deleted_path)
+
+    # Without hashing, thumbnails of existing files are left alone and those of deleted ones removed
+    settings.THUMBNAIL_CONTENT_ADDRESSED = True
+    with mock.patch('photonix.photos.management.commands.housekeeping.generate_thumbnails_task'), \
+            mock.patch('photonix.photos.utils.thumbnails.time.time', return_value=os.stat(path_1).st_mtime + 3600):
+        call_command('housekeeping')
+        assert os.path.exists(path_1) and os.path.exists(path_2)
+        assert not os.path.exists(deleted_path)
+
+        # Hashing moves one copy of the identical files' thumbnails over to the content key and drops the other
+        call_command('housekeeping', hash_photo_files=True)
+    photo_file_1.refresh_from_db()
+    assert not os.path.exists(path_1) and not os.path.exists(path_2)
+    content_path = get_thumbnail_path(photo_file_1.content_hash, width, height, crop, quality, 'content')
+    assert os.path.exists(content_path)
+    assert get_thumbnail(photo_file_2.id, width=width, height=height, crop=crop, quality=quality) == content_path
+
+
+def test_thumbnails_ignore_user_rotation(photo_fixture_snow, settings):
+    from PIL import Image
+
+    from photonix.photos.utils.thumbnails import generate_thumbnails_for_photo
+
+    # Thumbnails can be shared between photo files so the user's rotation is left for the UI to apply
+    settings.THUMBNAIL_SIZES = [(200, 200, 'contain', 75, True, False)]
+    photo_file = photo_fixture_snow.base_file
+    photo_file.rotation = 90
+    photo_file.save()
+    path = get_thumbnail_path(photo_file.id, 200, 200, 'contain', 75)
+    if os.path.exists(path):
+        os.remove(path)
+
+    generate_thumbnails_for_photo(photo_fixture_snow)
+    assert Image.open(path).size == (200, 150)
+    os.remove(path)
+
+
+def test_shard_thumbnails_command(photo_fixture_snow, settings):
+    from unittest import mock
+
+    from django.core.management import call_command
+
+    width, height, crop, quality, _, _ = settings.THUMBNAIL_SIZES[0]
+    photo_file_id = str(photo_fixture_snow.base_file.id)
+    sharded_path = get_thumbnail(photo_file_id, width=width, height=height, crop=crop, quality=quality)
+    flat_path = get_thumbnail_path(photo_file_id, width, height, crop, quality, sharded=False)
+    assert sharded_path != flat_path
+
+    # Moving back to the flat layout removes the now empty shard directories
+    settings.THUMBNAIL_SHARDED = False
+    call_command('shard_thumbnails')
+    assert os.path.exists(flat_path)
+    assert not os.path.exists(sharded_path)
+    assert not os.path.exists(sharded_path.parent)
+
+    # Dry run leaves everything where it is
+    settings.THUMBNAIL_SHARDED = True
+    call_command('shard_thumbnails', dry_run=True)
+    assert os.path.exists(flat_path)
+
+    call_command('shard_thumbnails')
+    assert os.path.exists(sharded_path)
+    assert not os.path.exists(flat_path)
+
+    # Once the thumbnails are in the configured layout they aren't looked through again unless forced
+    with mock.patch('photonix.photos.management.commands.shard_thumbnails.migrate_thumbnail_layout') as mock_migrate:
+        call_command('shard_thumbnails')
+        mock_migrate.assert_not_called()
+        call_command('shard_thumbnails', force=True)
+        mock_migrate.assert_called_once()